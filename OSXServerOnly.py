@@ -15,22 +15,52 @@
 # limitations under the License.
 
 import os
-import platform
-import plistlib
-
-from distutils import version
+import sys
 
 from autopkglib import Processor, ProcessorError
 
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import serverprobe
+from processor_utils import tracing
+from processor_utils import versions
+
 __all__ = ["OSXServerOnly"]
 
 
 class OSXServerOnly(Processor):
-    description = ("Fail if the recipe isn't run on OS X Server. The process don't check if the server is actually configured")
+    description = ("Fail if the recipe isn't run on OS X Server. The process don't check if the server is actually configured. "
+                   "The probe is cached in memory and on disk, and done again only when the files it reads change.")
     input_variables = {
         "minimum_system_version": {
             "required": True,
-            "description": ("Execute sed commands against this file."),
+            "description": ("Oldest OS X version supported, like 10.7 or 10.9.3."),
+        },
+        "maximum_system_version": {
+            "required": False,
+            "description": ("Newest OS X version supported, its updates included: 10.9 accepts 10.9.5. Unset by default."),
+        },
+        "os_x_root": {
+            "required": False,
+            "description": ("Folder where the system is looked for, / by default. Other values are meant for tests against a fake tree."),
+        },
+        "os_x_system_version_plist": {
+            "required": False,
+            "description": ("Plist read for the system version, System/Library/CoreServices/SystemVersion.plist in os_x_root by default."),
+        },
+        "os_x_probe_cache": {
+            "required": False,
+            "description": ("JSON file keeping the probe result between runs, OSXServerOnly-probe.json in CACHE_DIR by default. "
+                            "Set to an empty string to keep it in memory only."),
+        },
+        "processor_trace": {
+            "required": False,
+            "description": ("Set to true to time the phases of the run in processor_trace_spans. False by default."),
+        },
+        "processor_trace_file": {
+            "required": False,
+            "description": ("File the spans are appended to as JSON lines, tracing is enabled when set. Unset by default."),
         },
     }
     output_variables = {
@@ -46,37 +76,60 @@ class OSXServerOnly(Processor):
         "is_a_modern_os_x_server": {
             "description": ("Is true is only if Server.app is here"),
         },
+        "processor_trace_spans": {
+            "description": ("With processor_trace or processor_trace_file, one dictionary per timed phase with name, id, parent, start, duration, thread, error and metadata."),
+        },
     }
     
     __doc__ = description
     
         
+    tracer = tracing.DISABLED
+    
+    @tracing.traced
     def main(self):
         minimum_system_version = self.env.get('minimum_system_version', None)
-        server_app_info_plist_path = "/Applications/Server.app/Contents/Info.plist"
-        server_app_library_folder = "/Library/Server"
-        snow_server_serveradmin_path = "/usr/sbin/serveradmin"
+        maximum_system_version = self.env.get('maximum_system_version', None)
+        os_x_root = self.env.get('os_x_root', '/')
+        os_x_system_version_plist = self.env.get('os_x_system_version_plist', None)
+        os_x_probe_cache = self.env.get('os_x_probe_cache', None)
+        if os_x_probe_cache is None and self.env.get('CACHE_DIR'):
+            os_x_probe_cache = os.path.join(self.env['CACHE_DIR'], 'OSXServerOnly-probe.json')
+        
+        try:
+            with self.tracer.span('probe', root=os_x_root, cache=os_x_probe_cache):
+                facts = serverprobe.probe(os_x_root, os_x_system_version_plist, os_x_probe_cache)
+        except serverprobe.ProbeError as err:
+            raise ProcessorError(str(err))
         
         is_an_os_x_server = False
         is_a_modern_os_x_server = False
         
-        os_x_system_version = platform.mac_ver()[0]
+        os_x_system_version = facts['system_version']
+        if not os_x_system_version:
+            raise ProcessorError("Current system isn't OS X")
         
         os_x_server_version = None
-        if version.StrictVersion(os_x_system_version) >= version.StrictVersion('10.7') and os.path.exists(server_app_info_plist_path) and os.path.exists(server_app_library_folder):
-            server_info = plistlib.readPlist(server_app_info_plist_path)
-            os_x_server_version = server_info['CFBundleShortVersionString']
+        try:
+            is_lion_or_later = versions.at_least(os_x_system_version, '10.7')
+            is_too_old = minimum_system_version and not versions.at_least(os_x_system_version, minimum_system_version)
+            is_too_new = maximum_system_version and not versions.at_most(os_x_system_version, maximum_system_version)
+        except versions.VersionError as err:
+            raise ProcessorError(str(err))
+        if is_lion_or_later and facts['has_server_app']:
+            os_x_server_version = facts['server_version']
             is_an_os_x_server = True
             is_a_modern_os_x_server = True
-        elif os.path.exists(snow_server_serveradmin_path):
+        elif facts['has_serveradmin']:
             is_an_os_x_server = True
         
         if not is_an_os_x_server:
             raise ProcessorError("Current system isn't an OS X Server")
         
-        if minimum_system_version:
-            if version.StrictVersion(os_x_system_version)  < version.StrictVersion(minimum_system_version):
-                raise ProcessorError("Minimum supported OS X version is %s" % minimum_system_version)
+        if is_too_old:
+            raise ProcessorError("Minimum supported OS X version is %s" % minimum_system_version)
+        if is_too_new:
+            raise ProcessorError("Maximum supported OS X version is %s" % maximum_system_version)
                 
         self.env['os_x_system_version'] = os_x_system_version
         self.env['os_x_server_version'] = os_x_server_version
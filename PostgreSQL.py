@@ -15,12 +15,20 @@
 # limitations under the License.
 
 import os
-import subprocess
-import random
-import string
+import re
+import sys
+import threading
+import time
 
 from autopkglib import Processor, ProcessorError
 
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import psql
+from processor_utils import runner
+from processor_utils import tracing
+
 __all__ = ["PostgreSQL"]
 
 
@@ -31,6 +39,8 @@ class PostgreSQL(Processor):
                    ""
                    "The process use the postgre_sql_host (and postgre_sql_port) server to work, if not set, the process will try to find the default local one."
                    "If you're on recent OS X Server, you can use postgre_sql_start_os_x_server_service to start the builtin PostgreSQL Server."
+                   "The service is only started if its status isn't RUNNING, then the process waits up to postgre_sql_ready_timeout seconds"
+                   "for the server to accept connexions. postgre_sql_service_controller replaces serveradmin for these calls."
                    ""
                    "The process will use the postgre_sql_admin_name and postgre_sql_admin_password credentials if provided,"
                    "if not, it will try to act as the current user. You can force a sudo to a custom unix user with postgre_sql_sudo_account."
@@ -46,8 +56,34 @@ class PostgreSQL(Processor):
                    ""
                    "If the database already exist and not droped by the process, the postgre_sql_update_input file is used if exist as an update procedure."
                    "Otherwise, if the database has beem created during the process, postgre_sql_creation_input file is used as SQL input file for new database."
+                   "With postgre_sql_template_cache, the creation file is loaded once into a template database named after its content hash"
+                   "and new databases are cloned from it, postgre_sql_template_cache_limit bounds the number of cached templates."
+                   "With postgre_sql_ledger, applied update files are recorded with their checksum in a ledger table of the target database"
+                   "and skipped while unchanged. Ordered migration files from postgre_sql_update_directory always go through the ledger."
+                   "With postgre_sql_stream_batch_size, creation and update files are streamed in transactions of that many statements"
+                   "with progress output, and an interrupted creation load resumes from its last committed batch on the next run."
+                   ""
+                   "To provision several databases in one call, pass postgre_sql_databases, a list of dictionaries with database, role_name and optionally"
+                   "role_password, always_replace_role_password, drop_db_if_exist, creation_input, update_input and update_directory keys"
+                   "(missing keys fall back to the matching postgre_sql_ input). Roles are handled first, then databases in parallel"
+                   "with up to postgre_sql_max_workers workers, the outcome of each item is in postgre_sql_results."
+                   "A failed item stops the recipe unless postgre_sql_allow_partial_failure is true."
+                   "A database created by a run whose creation load fails is dropped, unless the streamed load can resume."
                    ""
-                   "Ut's possible to set postgre_sql_psql_path if you need to specify a custom psql path.")
+                   "Each run follows a plan, the actions its inputs and the server state call for, returned in postgre_sql_plan."
+                   "With postgre_sql_dry_run, the plan is printed and nothing is changed on the server."
+                   "After a successful run, a fingerprint of the inputs (roles, databases, SQL file checksums) is saved in postgre_sql_plan_cache,"
+                   "and a later run with the same fingerprint returns the outputs of that run, for up to postgre_sql_plan_max_age seconds,"
+                   "after a single query checking that the server wasn't restarted and still has its roles and databases."
+                   "Role passwords aren't saved, only those given as inputs are returned then."
+                   "Runs dropping databases, loading update files without the ledger or replacing generated passwords are never skipped."
+                   ""
+                   "Ut's possible to set postgre_sql_psql_path if you need to specify a custom psql path."
+                   ""
+                   "By default all statements go through a single psql process connected to postgre_sql_initial_connexion_database,"
+                   "set postgre_sql_session_mode to subprocess to run one psql process per statement instead."
+                   "command_timeout bounds each command and each exchange with the psql session, command_deadline all of them,"
+                   "every command run is listed in command_log with its duration and exit status.")
     input_variables = {
         "postgre_sql_host": {
             "required": False,
@@ -66,8 +102,20 @@ class PostgreSQL(Processor):
             "description": ("The PostgreSQL admin password to use."),
         },
         "postgre_sql_database": {
-            "required": True,
-            "description": ("The PostgreSQL database to create or use."),
+            "required": False,
+            "description": ("The PostgreSQL database to create or use. Required unless postgre_sql_databases is set."),
+        },
+        "postgre_sql_databases": {
+            "required": False,
+            "description": ("List of dictionaries (database, role_name, role_password, always_replace_role_password, drop_db_if_exist, creation_input, update_input, update_directory) to provision in parallel instead of postgre_sql_database."),
+        },
+        "postgre_sql_max_workers": {
+            "required": False,
+            "description": ("Maximum number of databases of postgre_sql_databases provisioned at the same time, 4 by default."),
+        },
+        "postgre_sql_allow_partial_failure": {
+            "required": False,
+            "description": ("If true, the items of postgre_sql_databases that failed are only reported in postgre_sql_results and the recipe goes on with the outputs of the others. (False by default)"),
         },
         "postgre_sql_role_name": {
             "required": False,
@@ -85,6 +133,14 @@ class PostgreSQL(Processor):
             "required": False,
             "description": ("Start the OS X Server PostgreSQL service if needed. True by default, will fail the process if the service can't be started."),
         },
+        "postgre_sql_service_controller": {
+            "required": False,
+            "description": ("Command used to get the status of and start the postgres service, called with 'status postgres' and 'start postgres'. Default is serveradmin."),
+        },
+        "postgre_sql_ready_timeout": {
+            "required": False,
+            "description": ("Number of seconds to wait for a freshly started server to accept connexions, 30 by default."),
+        },
         "postgre_sql_drop_db_if_exist": {
             "required": False,
             "description": ("If the target base already exist, the process will drop it and start from fresh one. (False by default)"),
@@ -97,6 +153,30 @@ class PostgreSQL(Processor):
             "required": False,
             "description": ("PostgreSQL command file to use against the target database if the database don't exist."),
         },
+        "postgre_sql_ledger": {
+            "required": False,
+            "description": ("If true, postgre_sql_update_input runs in a transaction, is recorded in the ledger table and is skipped while its checksum doesn't change. (False by default)"),
+        },
+        "postgre_sql_ledger_table": {
+            "required": False,
+            "description": ("Name of the ledger table created in the target database, default is autopkg_sql_ledger."),
+        },
+        "postgre_sql_update_directory": {
+            "required": False,
+            "description": ("Directory of .sql migration files applied in name order, each in its own transaction, unless the ledger shows it has already been applied with the same checksum. The ledger knows them by file name, so the directory can move."),
+        },
+        "postgre_sql_stream_batch_size": {
+            "required": False,
+            "description": ("If set, creation and update files are streamed to the server in transactions of this many statements instead of being loaded with a single \\i. COPY ... FROM STDIN blocks are passed through."),
+        },
+        "postgre_sql_stream_checkpoint_dir": {
+            "required": False,
+            "description": ("Where streamed loads save the offset of their last committed batch, default is a PostgreSQL folder in RECIPE_CACHE_DIR. No checkpoint is kept if none is available."),
+        },
+        "postgre_sql_stream_progress_interval": {
+            "required": False,
+            "description": ("Minimum number of seconds between two progress messages of a streamed load, 5 by default."),
+        },
         "postgre_sql_psql_path": {
             "required": False,
             "description": ("PostgreSQL psql binary path, default value is just 'psql'."),
@@ -109,88 +189,572 @@ class PostgreSQL(Processor):
             "required": False,
             "description": ("Default database for the connexion to the server. Default is template1."),
         },
+        "postgre_sql_template_cache": {
+            "required": False,
+            "description": ("If true, new databases are cloned from a template database built from postgre_sql_creation_input and named after its content hash. (False by default)"),
+        },
+        "postgre_sql_template_cache_limit": {
+            "required": False,
+            "description": ("Maximum number of cached template databases kept on the server, older ones are dropped first. 3 by default."),
+        },
+        "postgre_sql_session_mode": {
+            "required": False,
+            "description": ("How psql is driven: 'session' (default) keeps one psql process for the whole run, 'subprocess' starts one psql process per statement."),
+        },
+        "command_timeout": {
+            "required": False,
+            "description": ("Maximum number of seconds for each command, and each exchange with a psql session. Unset by default, no limit."),
+        },
+        "command_deadline": {
+            "required": False,
+            "description": ("Maximum number of seconds for all the commands of the run. Unset by default, no limit."),
+        },
+        "command_max_concurrent": {
+            "required": False,
+            "description": ("Maximum number of short lived commands (service controller, psql in subprocess mode) running at the same time. Unset by default."),
+        },
+        "postgre_sql_dry_run": {
+            "required": False,
+            "description": ("If true, the plan of the run is printed and returned in postgre_sql_plan, the server is only read. (False by default)"),
+        },
+        "postgre_sql_plan_cache": {
+            "required": False,
+            "description": ("File keeping the fingerprint and results of the last applied plan, default is a PostgreSQL folder in RECIPE_CACHE_DIR. Set to an empty string to always check the server."),
+        },
+        "postgre_sql_plan_max_age": {
+            "required": False,
+            "description": ("Number of seconds a cached plan is trusted, the server is checked again past it. 86400 by default, 0 for no limit."),
+        },
+        "processor_trace": {
+            "required": False,
+            "description": ("Set to true to time the phases of the run in processor_trace_spans. False by default."),
+        },
+        "processor_trace_file": {
+            "required": False,
+            "description": ("File the spans are appended to as JSON lines, tracing is enabled when set. Unset by default."),
+        },
     }
     output_variables = {
         "postgre_sql_ouput_password": {
             "description": ("The PostgreSQL password to use with the database. It can be a generated one or the postgre_sql_role_password set in input."),
         },
+        "postgre_sql_results": {
+            "description": ("One dictionary per provisioned database with status (ok or failed), error, database, role_name, password, role_existed, database_existed, database_created, applied_scripts and skipped_scripts."),
+        },
+        "postgre_sql_applied_scripts": {
+            "description": ("SQL files applied through the ledger during this run."),
+        },
+        "postgre_sql_skipped_scripts": {
+            "description": ("SQL files skipped because the ledger shows them already applied with the same checksum."),
+        },
+        "postgre_sql_ready_wait": {
+            "description": ("Number of seconds spent waiting for the server to accept connexions after starting the service."),
+        },
+        "postgre_sql_server_reachable": {
+            "description": ("True once the server answered the state discovery query."),
+        },
+        "postgre_sql_role_existed": {
+            "description": ("True if postgre_sql_role_name already existed before the process ran."),
+        },
+        "postgre_sql_database_existed": {
+            "description": ("True if postgre_sql_database already existed before the process ran."),
+        },
+        "postgre_sql_database_owner": {
+            "description": ("Owner of postgre_sql_database before the process ran, None if the database didn't exist."),
+        },
+        "postgre_sql_database_encoding": {
+            "description": ("Encoding of postgre_sql_database before the process ran, None if the database didn't exist."),
+        },
+        "postgre_sql_database_created": {
+            "description": ("True if postgre_sql_database has been created (or recreated) by this run."),
+        },
+        "postgre_sql_plan": {
+            "description": ("Actions of the run in order, one dictionary with action (start_service, create_role, update_role, drop_database, build_template, create_database, evict_templates, load, resume_load, create_ledger, apply_script or skip_script) and its arguments."),
+        },
+        "postgre_sql_plan_skipped": {
+            "description": ("True if the inputs were those of the last applied plan and the server wasn't contacted."),
+        },
+        "command_log": {
+            "description": ("One dictionary per command run with command, started, duration, status, timed_out, error and stderr. Passwords are masked."),
+        },
+        "processor_trace_spans": {
+            "description": ("With processor_trace or processor_trace_file, one dictionary per timed phase with name, id, parent, start, duration, thread, error and metadata."),
+        },
     }
     
     __doc__ = description
     
-    psql_base_command = []
-    postgre_sql_initial_connexion_database = None
+    template_prefix = "autopkg_template_"
+    # Bumped when what decides a run changes, invalidating the cached plans
+    plan_cache_version = 2
+    tracer = tracing.DISABLED
+    
+    def __init__(self, *args, **kwargs):
+        super(PostgreSQL, self).__init__(*args, **kwargs)
+        self.thread_state = threading.local()
+        self.runner = runner.Runner()
+        self.psql_base_command = []
+        self.postgre_sql_initial_connexion_database = None
+        self.connection_keys = {}
+        self.session_mode = psql.SESSION_MODE
+        self.psql_session = None
+        self.ledger = False
+        self.ledger_table = None
+        self.template_cache = False
+        self.template_cache_limit = 3
+        self.built_templates = set()
+        self.template_locks = {}
+        self.template_locks_guard = threading.Lock()
+        self.stream_batch_size = None
+        self.stream_checkpoint_dir = None
+        self.stream_progress_interval = 5
+    
+    
+    # Each provisioning worker thread has its own session
+    @property
+    def psql_session(self):
+        return getattr(self.thread_state, 'psql_session', None)
+    
+    
+    @psql_session.setter
+    def psql_session(self, session):
+        self.thread_state.psql_session = session
+    
+    
+    def new_psql_session(self):
+        try:
+            return psql.PsqlSession(self.psql_base_command, self.postgre_sql_initial_connexion_database,
+                                    self.connection_keys, self.session_mode, self.runner)
+        except psql.PsqlError as err:
+            raise ProcessorError(str(err))
+    
+    
+    def generate_password(self):
+        from processor_utils import entropy
+        return entropy.token_hex(6)
+    
+    
+    def template_lock(self, template):
+        with self.template_locks_guard:
+            return self.template_locks.setdefault(template, threading.Lock())
     
     
     def run_psql_command(self, command, dbname=None):
-        if not dbname:
-            dbname = self.postgre_sql_initial_connexion_database
-        return self.run_psql_with_args(['-d', dbname, '-tAc', command])
+        try:
+            if dbname:
+                self.psql_session.connect(dbname)
+            return self.psql_session.query(command)
+        except psql.PsqlError as err:
+            raise ProcessorError("psql command failed: %s" % err)
+    
     
+    def service_command(self, controller, action):
+        command = [controller] if isinstance(controller, str) else list(controller)
+        try:
+            with self.tracer.span('service', action=action):
+                return self.runner.run(command + [action, 'postgres']).stdout
+        except runner.CommandError as err:
+            raise ProcessorError("Unable to %s the postgres service: %s" % (action, err))
+    
+    
+    def service_is_running(self, controller):
+        postgre_sql_state = self.service_command(controller, 'status')
+        match = re.search(r':state\s*=\s*"?(\w+)', postgre_sql_state)
+        return bool(match) and match.group(1) == 'RUNNING'
     
-    def run_psql_with_args(self, commands_array):
-        final_commands = self.psql_base_command[:]
-        final_commands.extend(commands_array)
-        command_result = subprocess.check_output(final_commands)
-        return command_result
     
+    def wait_for_db_service_or_die(self, timeout, first_delay=0.25, max_delay=5):
+        self.output("Wait for the PostgreSQL Server to accept connexions.")
+        started = time.time()
+        deadline = started + timeout
+        delay = first_delay
+        with self.tracer.span('wait_ready') as span:
+            while True:
+                span.add('attempts')
+                try:
+                    self.psql_session.query(';')
+                    break
+                except psql.PsqlError:
+                    if time.time() + delay > deadline:
+                        raise ProcessorError("Impossible to connect to database server after %.1f seconds" % (time.time() - started))
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+        waited = time.time() - started
+        self.output("Connexion OK after %.2f seconds." % waited)
+        return waited
     
-    def check_db_service_or_die(self):
-        self.output("Check if we are able to connect to the PostgreSQL Server.")
+    
+    def discover_server_state(self, role, dbname, template=None):
+        self.output("Discover server state for role %s and database %s." % (role, dbname))
         try:
-            self.run_psql_command(';')
-            self.output("Connexion OK.")
-        except Exception:
+            with self.tracer.span('discover', database=dbname):
+                result = self.run_psql_command(
+                    "SELECT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = %s), d.datname IS NOT NULL, "
+                    "coalesce(pg_get_userbyid(d.datdba), ''), coalesce(pg_encoding_to_char(d.encoding), ''), "
+                    "EXISTS (SELECT 1 FROM pg_database WHERE datname = %s) "
+                    "FROM (SELECT 1) AS server LEFT JOIN pg_database AS d ON d.datname = %s"
+                    % (psql.sql_literal(role), psql.sql_literal(template or ''), psql.sql_literal(dbname)))
+        except ProcessorError:
             raise ProcessorError("Impossible to connect to database server")
-        
-        
-    def check_db_existance(self, dbname):
-        self.output("Check if %s database already exist." % dbname)
-        result = self.run_psql_command("SELECT 1 FROM pg_database WHERE datname='%s'" % dbname)
-        if result:
-            self.output("Database exist.")
-            return True
-        else:
-            self.output("Database don't exist.")
-            return False 
+        role_exist, db_exist, db_owner, db_encoding, template_exist = result.strip().split('|')
+        state = {
+            'reachable': True,
+            'role_exist': role_exist == 't',
+            'database_exist': db_exist == 't',
+            'database_owner': db_owner or None,
+            'database_encoding': db_encoding or None,
+            'template_exist': template_exist == 't',
+        }
+        self.output("Connexion OK, role %s, database %s." % ("exist" if state['role_exist'] else "don't exist",
+                                                            "exist" if state['database_exist'] else "don't exist"))
+        return state
     
     
     def drop_database(self, dbname):
         self.output("Drop pre existing database %s" % dbname)
-        self.run_psql_command("DROP DATABASE %s" % dbname)
+        with self.tracer.span('drop_database', database=dbname):
+            self.run_psql_command("DROP DATABASE %s" % dbname)
     
     
-    def create_database(self, dbname, owner):
-        self.output("Create database %s" % dbname)
-        self.run_psql_command("CREATE DATABASE %s OWNER %s" % (dbname, owner))
-        
-        
-    def check_role_existance(self, role):
-        self.output("Check if %s role already exist." % role)
-        result = self.run_psql_command("SELECT 1 FROM pg_roles WHERE rolname='%s'" % role)
-        if result:
-            self.output("Role exist.")
-            return True
-        else:
-            self.output("Role don't exist.")
-            return False 
+    def create_database(self, dbname, owner, template=None):
+        with self.tracer.span('create_database', database=dbname, template=template):
+            if template:
+                self.output("Create database %s from template %s" % (dbname, template))
+                self.run_psql_command("CREATE DATABASE %s OWNER %s TEMPLATE %s" % (dbname, owner, template))
+            else:
+                self.output("Create database %s" % dbname)
+                self.run_psql_command("CREATE DATABASE %s OWNER %s" % (dbname, owner))
+    
+    
+    def abandon_database(self, dbname, sql_file):
+        # Left empty, the database would be found by the next runs and never loaded
+        if self.has_pending_stream(sql_file, dbname):
+            self.output("The load of %s into %s stopped, the next run resumes it" % (sql_file, dbname))
+            return
+        self.output("Load failed, drop %s created by this run" % dbname)
+        try:
+            self.run_psql_command("DROP DATABASE IF EXISTS %s" % dbname, self.postgre_sql_initial_connexion_database)
+        except ProcessorError as err:
+            self.output("Unable to drop %s: %s" % (dbname, err))
+    
+    
+    def template_name_for(self, sql_file):
+        return self.template_prefix + psql.file_checksum(sql_file)[:32]
+    
+    
+    def template_comment_for(self, sql_file):
+        return "autopkg template of %s" % os.path.abspath(sql_file)
     
     
+    def build_template(self, template, sql_file):
+        # Loaded under a temporary name and renamed once complete, so that an
+        # interrupted build (killed run, timeout) is never cloned as the template
+        from processor_utils import entropy
+        building = "%s_%s" % (template, entropy.token_hex(4))
+        self.output("Build template %s from %s" % (template, sql_file))
+        with self.tracer.span('build_template', template=template):
+            self.run_psql_command("CREATE DATABASE %s" % building)
+            try:
+                self.execute_sql_file_to_db(sql_file, building)
+                # CREATE DATABASE ... TEMPLATE needs the template to be free of any connexion
+                self.psql_session.connect(self.postgre_sql_initial_connexion_database)
+                self.run_psql_command("COMMENT ON DATABASE %s IS %s" % (building, psql.sql_literal(self.template_comment_for(sql_file))))
+                self.run_psql_command("ALTER DATABASE %s RENAME TO %s" % (building, template))
+            except (ProcessorError, psql.PsqlError):
+                self.output("Template build failed, drop %s" % building)
+                self.run_psql_command("DROP DATABASE IF EXISTS %s" % building, self.postgre_sql_initial_connexion_database)
+                self.forget_stream(sql_file, building)
+                if not self.template_exists(template):
+                    raise
+                self.output("Template %s was built by a concurrent run" % template)
+    
+    
+    def template_exists(self, template):
+        result = self.run_psql_command("SELECT EXISTS (SELECT 1 FROM pg_database WHERE datname = %s)" % psql.sql_literal(template))
+        return result.strip() == 't'
+    
+    
+    def evict_templates(self, template, sql_file, limit):
+        with self.tracer.span('evict_templates') as span:
+            self._evict_templates(template, sql_file, limit, span)
+    
+    
+    def _evict_templates(self, template, sql_file, limit, span):
+        result = self.run_psql_command(
+            "SELECT datname, coalesce(shobj_description(oid, 'pg_database'), '') FROM pg_database "
+            "WHERE left(datname, %d) = %s ORDER BY oid DESC"
+            % (len(self.template_prefix), psql.sql_literal(self.template_prefix)))
+        comment = self.template_comment_for(sql_file)
+        kept = 1
+        for line in result.splitlines():
+            name, _, name_comment = line.partition('|')
+            if name == template:
+                continue
+            if name_comment != comment and kept < limit:
+                kept += 1
+                continue
+            self.output("Evict cached template %s" % name)
+            span.add('evicted')
+            try:
+                self.run_psql_command("DROP DATABASE %s" % name)
+            except ProcessorError as err:
+                self.output("Unable to drop template %s: %s" % (name, err))
+        
+        
     def create_role_with_password(self, role, password):
         self.output("Create role %s" % role)
-        self.run_psql_command("CREATE ROLE %s WITH PASSWORD '%s'" % (role, password))
+        self.runner.add_secret(password)
+        with self.tracer.span('create_role', role=role):
+            self.run_psql_command("CREATE ROLE %s WITH PASSWORD '%s'" % (role, password))
     
     
     def update_role_with_password(self, role, password):
         self.output("Update role %s" % role)
-        self.run_psql_command("ALTER ROLE %s WITH PASSWORD '%s'" % (role, password))
+        self.runner.add_secret(password)
+        with self.tracer.span('update_role', role=role):
+            self.run_psql_command("ALTER ROLE %s WITH PASSWORD '%s'" % (role, password))
     
     
-    def execute_sql_file_to_db(self, sql_file, dbname):
+    def execute_sql_file_to_db(self, sql_file, dbname, resume=False):
+        if self.stream_batch_size:
+            return self.stream_sql_file_to_db(sql_file, dbname, resume)
         self.output("Load SQL file %s into %s" % (sql_file, dbname))
-        self.run_psql_with_args(['-d', dbname, '-f', sql_file])
+        try:
+            with self.tracer.span('load_sql_file', path=sql_file, database=dbname) as span:
+                if self.tracer.enabled:
+                    span.set(bytes=os.path.getsize(sql_file))
+                self.psql_session.execute_file(sql_file, dbname)
+        except psql.PsqlError as err:
+            raise ProcessorError("Unable to load %s: %s" % (sql_file, err))
+    
+    
+    def stream_checkpoint_path(self, sql_file, dbname):
+        if not self.stream_checkpoint_dir:
+            return None
+        import hashlib
+        file_key = hashlib.sha1(os.path.abspath(sql_file).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.stream_checkpoint_dir, "%s-%s.json" % (dbname, file_key))
+    
+    
+    def has_pending_stream(self, sql_file, dbname):
+        checkpoint_path = self.stream_checkpoint_path(sql_file, dbname)
+        return bool(checkpoint_path) and os.path.exists(checkpoint_path)
+    
+    
+    def forget_stream(self, sql_file, dbname):
+        checkpoint_path = self.stream_checkpoint_path(sql_file, dbname)
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    
+    
+    def stream_sql_file_to_db(self, sql_file, dbname, resume=False):
+        # The streaming loader is only imported by the runs that use it
+        from processor_utils import sqlstream
+        session = self.psql_session
+        if session.mode != psql.SESSION_MODE:
+            session = psql.PsqlSession(session.base_command, dbname, session.connection_keys, runner=session.runner)
+        loader = sqlstream.StreamLoader(session, sql_file, self.stream_batch_size,
+                                        self.stream_checkpoint_path(sql_file, dbname),
+                                        self.output, self.stream_progress_interval)
+        self.output("Stream SQL file %s into %s by batches of %s statements" % (sql_file, dbname, loader.batch_size))
+        try:
+            with self.tracer.span('stream_sql_file', path=sql_file, database=dbname, batch_size=loader.batch_size) as span:
+                try:
+                    session.connect(dbname)
+                    loader.load(resume)
+                finally:
+                    span.set(bytes=loader.bytes, statements=loader.statements, rows=loader.rows,
+                             resumed_from=loader.resumed_from)
+        except sqlstream.LoadError as err:
+            if loader.checkpoint_path:
+                raise ProcessorError("%s, the next run will resume after the last committed batch" % err)
+            raise ProcessorError(str(err))
+        except psql.PsqlError as err:
+            raise ProcessorError("Unable to load %s: %s" % (sql_file, err))
+        finally:
+            if session is not self.psql_session:
+                session.close()
+        if loader.resumed_from:
+            self.output("Load resumed at offset %d" % loader.resumed_from)
+    
+    
+    def read_ledger(self, dbname, table):
+        self.output("Read ledger %s of %s" % (table, dbname))
+        with self.tracer.span('read_ledger', database=dbname):
+            result = self.run_psql_command(
+                "BEGIN; SET LOCAL client_min_messages TO warning; "
+                "CREATE TABLE IF NOT EXISTS %s (script text PRIMARY KEY, checksum text NOT NULL, path text NOT NULL, "
+                "duration interval NOT NULL, applied_at timestamp with time zone NOT NULL); COMMIT; "
+                "SELECT script, checksum FROM %s" % (table, table), dbname)
+        return self.parse_ledger(result)
+    
+    
+    def parse_ledger(self, result):
+        ledger = {}
+        for line in result.splitlines():
+            script, _, checksum = line.rpartition('|')
+            ledger[script] = checksum
+        return ledger
+    
+    
+    def peek_ledger(self, dbname, table):
+        # Read-only reading for dry runs, None when the ledger table doesn't exist yet
+        self.output("Read ledger %s of %s" % (table, dbname))
+        with self.tracer.span('read_ledger', database=dbname):
+            exists = self.run_psql_command("SELECT to_regclass(%s) IS NOT NULL" % psql.sql_literal(table), dbname)
+            if exists.strip() != 't':
+                return None
+            result = self.run_psql_command("SELECT script, checksum FROM %s" % table, dbname)
+        return self.parse_ledger(result)
+    
+    
+    def apply_ledger_script(self, sql_file, script, checksum, dbname, table):
+        self.output("Apply SQL file %s to %s" % (sql_file, dbname))
+        # The ledger entry is written in the transaction of the file, now() being the start of that transaction
+        record = ("DELETE FROM %s WHERE script = %s; "
+                  "INSERT INTO %s (script, checksum, path, duration, applied_at) "
+                  "VALUES (%s, %s, %s, clock_timestamp() - now(), now())"
+                  % (table, psql.sql_literal(script), table, psql.sql_literal(script), psql.sql_literal(checksum),
+                     psql.sql_literal(os.path.abspath(sql_file))))
+        try:
+            with self.tracer.span('apply_script', path=sql_file, database=dbname):
+                self.psql_session.execute_file_in_transaction(sql_file, record, dbname)
+        except psql.PsqlError as err:
+            raise ProcessorError("Unable to apply %s, its transaction has been rolled back: %s" % (sql_file, err))
+    
+    
+    def update_directory_files(self, update_directory):
+        return [os.path.join(update_directory, name)
+                for name in sorted(os.listdir(update_directory)) if name.endswith('.sql')]
+    
+    
+    def plan_fingerprint(self, specs):
+        # Digest of the inputs deciding what a run does, None when a run can't be skipped however unchanged they are
+        import hashlib
+        import json
+        items = []
+        for spec in specs:
+            if spec.get('drop_db_if_exist') or (spec.get('update_input') and not self.ledger):
+                return None
+            if spec.get('always_replace_role_password') and spec.get('generated_password'):
+                return None
+            if self.stream_batch_size and spec.get('creation_input') and self.has_pending_stream(spec['creation_input'], spec['database']):
+                return None
+            files = [spec[key] for key in ('creation_input', 'update_input') if spec.get(key)]
+            try:
+                if spec.get('update_directory'):
+                    files.extend(self.update_directory_files(spec['update_directory']))
+                checksums = [[path, psql.file_checksum(path)] for path in files]
+            except (IOError, OSError):
+                return None
+            password = None
+            if not spec.get('generated_password'):
+                password = hashlib.sha256(str(spec['role_password']).encode('utf-8')).hexdigest()
+            items.append({
+                'database': spec['database'],
+                'role_name': spec['role_name'],
+                'role_password': password,
+                'always_replace_role_password': bool(spec.get('always_replace_role_password')),
+                'files': checksums,
+            })
+        key = {
+            'version': self.plan_cache_version,
+            'server': [self.connection_keys.get('host'), self.connection_keys.get('port'),
+                       self.connection_keys.get('user'), self.postgre_sql_initial_connexion_database],
+            'ledger': [bool(self.ledger), self.ledger_table],
+            'template_cache': bool(self.template_cache),
+            'items': items,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    
+    def plan_cache_path(self, specs):
+        postgre_sql_plan_cache = self.env.get('postgre_sql_plan_cache', None)
+        if postgre_sql_plan_cache is not None:
+            return postgre_sql_plan_cache or None
+        if not self.env.get('RECIPE_CACHE_DIR'):
+            return None
+        import hashlib
+        import json
+        target = json.dumps([self.connection_keys.get('host'), self.connection_keys.get('port'),
+                             sorted(spec['database'] for spec in specs)])
+        return os.path.join(self.env['RECIPE_CACHE_DIR'], 'PostgreSQL',
+                            "plan-%s.json" % hashlib.sha1(target.encode('utf-8')).hexdigest()[:12])
+    
+    
+    def read_plan_cache(self, path, fingerprint, max_age):
+        import json
+        try:
+            with open(path) as handle:
+                cache = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get('fingerprint') != fingerprint:
+            return None
+        if max_age and time.time() - cache.get('applied_at', 0) > max_age:
+            self.output("Last applied plan is older than %d seconds, check the server again" % max_age)
+            return None
+        return cache
+    
+    
+    def write_plan_cache(self, path, fingerprint, server, results):
+        # Role passwords are left out, the file is still only readable by its owner
+        import json
+        results = [dict(result, password=None) for result in results]
+        directory = os.path.dirname(os.path.abspath(path))
+        temporary_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            handle = os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+            with handle:
+                json.dump({'fingerprint': fingerprint, 'applied_at': time.time(), 'server': server, 'results': results}, handle)
+            os.rename(temporary_path, path)
+        except (IOError, OSError) as err:
+            self.output("Unable to save the applied plan in %s: %s" % (path, err))
+    
+    
+    def forget_plan_cache(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    
+    def server_signature(self, specs):
+        # Changes when the server restarts or loses a role or database of specs, None when it can't be reached
+        roles = sorted(set(spec['role_name'] for spec in specs))
+        databases = sorted(set(spec['database'] for spec in specs))
+        try:
+            with self.tracer.span('server_signature'):
+                result = self.run_psql_command(
+                    "SELECT pg_postmaster_start_time(), (SELECT count(*) FROM pg_database WHERE datname IN (%s)), "
+                    "(SELECT count(*) FROM pg_roles WHERE rolname IN (%s))"
+                    % (", ".join(psql.sql_literal(name) for name in databases), ", ".join(psql.sql_literal(name) for name in roles)))
+        except ProcessorError:
+            return None
+        start_time, database_count, role_count = result.strip().split('|')
+        if int(database_count) != len(databases) or int(role_count) != len(roles):
+            return None
+        return start_time
+    
+    
+    def unchanged_result(self, result, spec):
+        # What a run finding everything as the cached run left it would return, with the password of the inputs only
+        scripts = [action['path'] for action in result.get('plan', []) if action['action'] in ('apply_script', 'skip_script')]
+        password = None if spec.get('generated_password') else spec['role_password']
+        return dict(result, password=password, role_existed=True, database_existed=True, database_created=False,
+                    database_owner=result.get('database_owner') or result['role_name'],
+                    applied_scripts=[], skipped_scripts=scripts, plan=[])
+    
     
+    def describe_action(self, action):
+        details = ", ".join("%s %s" % (key, value) for key, value in sorted(action.items())
+                            if key not in ('action', 'checksum') and value is not None)
+        return "%s%s" % (action['action'].replace('_', ' '), " (%s)" % details if details else "")
     
+    
+    @tracing.traced
     def main(self):
         postgre_sql_host = self.env.get('postgre_sql_host', None)
         postgre_sql_port = self.env.get('postgre_sql_port', None)
@@ -198,26 +762,76 @@ class PostgreSQL(Processor):
         postgre_sql_admin_name = self.env.get('postgre_sql_admin_name', None)
         postgre_sql_admin_password = self.env.get('postgre_sql_admin_password', None)
         
-        postgre_sql_database = self.env['postgre_sql_database']
-        postgre_sql_role_name = self.env['postgre_sql_role_name']
-        postgre_sql_role_password = self.env.get('postgre_sql_role_password', ''.join(random.choice(string.hexdigits) for i in range(12)))
+        postgre_sql_databases = self.env.get('postgre_sql_databases', None)
+        postgre_sql_max_workers = int(self.env.get('postgre_sql_max_workers', 4))
+        postgre_sql_database = self.env.get('postgre_sql_database', None)
+        postgre_sql_role_name = self.env.get('postgre_sql_role_name', None)
+        if not postgre_sql_databases and not postgre_sql_database:
+            raise ProcessorError("Expected a 'postgre_sql_database' or 'postgre_sql_databases' input variable but none is set!")
+        if not postgre_sql_databases and not postgre_sql_role_name:
+            raise ProcessorError("Expected a 'postgre_sql_role_name' input variable but none is set!")
+        postgre_sql_role_password = self.env.get('postgre_sql_role_password', self.generate_password())
         postgre_sql_always_replace_role_password = self.env.get('postgre_sql_always_replace_role_password', False)
         
         postgre_sql_start_os_x_server_service = self.env.get('postgre_sql_start_os_x_server_service', True)
+        postgre_sql_service_controller = self.env.get('postgre_sql_service_controller', 'serveradmin')
+        postgre_sql_ready_timeout = float(self.env.get('postgre_sql_ready_timeout', 30))
         
         postgre_sql_drop_db_if_exist = self.env.get('postgre_sql_drop_db_if_exist', False)
         
         postgre_sql_update_input = self.env.get('postgre_sql_update_input', None)
         postgre_sql_creation_input = self.env.get('postgre_sql_creation_input', None)
+        postgre_sql_update_directory = self.env.get('postgre_sql_update_directory', None)
+        self.ledger = self.env.get('postgre_sql_ledger', False)
+        self.ledger_table = self.env.get('postgre_sql_ledger_table', 'autopkg_sql_ledger')
+        self.template_cache = self.env.get('postgre_sql_template_cache', False)
+        self.template_cache_limit = int(self.env.get('postgre_sql_template_cache_limit', 3))
+        self.built_templates = set()
+        self.dry_run = bool(self.env.get('postgre_sql_dry_run', False))
+        postgre_sql_plan_max_age = float(self.env.get('postgre_sql_plan_max_age', 86400))
         
         postgre_sql_psql_path = self.env.get('postgre_sql_psql_path', "psql")
         postgre_sql_sudo_account = self.env.get('postgre_sql_sudo_account', None)
         
         self.postgre_sql_initial_connexion_database = self.env.get('postgre_sql_initial_connexion_database', 'template1')
+        self.session_mode = self.env.get('postgre_sql_session_mode', psql.SESSION_MODE)
+        
+        self.stream_batch_size = int(self.env.get('postgre_sql_stream_batch_size', 0)) or None
+        self.stream_progress_interval = float(self.env.get('postgre_sql_stream_progress_interval', 5))
+        self.stream_checkpoint_dir = self.env.get('postgre_sql_stream_checkpoint_dir', None)
+        if not self.stream_checkpoint_dir and self.env.get('RECIPE_CACHE_DIR'):
+            self.stream_checkpoint_dir = os.path.join(self.env['RECIPE_CACHE_DIR'], 'PostgreSQL')
+        
+        # Connection keys end in the connection string given to psql, the final format look like "dbname=template1 user=alice password=NotBobAgain host=203.0.113.42 port=1234"
+        self.connection_keys = {
+            'user': postgre_sql_admin_name,
+            'password': postgre_sql_admin_password,
+            'host': postgre_sql_host,
+            'port': postgre_sql_port,
+        }
         
-        db_created_on_this_run = False
+        if postgre_sql_databases:
+            specs = self.database_specs(postgre_sql_databases, postgre_sql_role_password)
+        else:
+            specs = [{
+                'database': postgre_sql_database,
+                'role_name': postgre_sql_role_name,
+                'role_password': postgre_sql_role_password,
+                'generated_password': 'postgre_sql_role_password' not in self.env,
+                'always_replace_role_password': postgre_sql_always_replace_role_password,
+                'drop_db_if_exist': postgre_sql_drop_db_if_exist,
+                'creation_input': postgre_sql_creation_input,
+                'update_input': postgre_sql_update_input,
+                'update_directory': postgre_sql_update_directory,
+            }]
+        
+        try:
+            self.runner = runner.from_settings(self.env, secrets=[postgre_sql_admin_password])
+        except runner.CommandError as err:
+            raise ProcessorError(str(err))
         
         ### Create the baseline for psql command line which will be used to run all SQL commands
+        self.psql_base_command = []
         if postgre_sql_sudo_account:
             self.psql_base_command.append('sudo')
             self.psql_base_command.append('-u')
@@ -225,59 +839,357 @@ class PostgreSQL(Processor):
         
         self.psql_base_command.append(postgre_sql_psql_path)
         
-        # Construct the connection keys string from available input. The final format look like "user=alice password=NotBobAgain host=203.0.113.42 port=1234"
-        user_name_with_key = ""
-        password_with_key = ""
-        port_with_key = ""
-        host_with_key = ""
-        if postgre_sql_admin_name:
-            user_name_with_key = "user=%s" % postgre_sql_admin_name
-            if postgre_sql_admin_password:
-                password_with_key = "password=%s" % postgre_sql_admin_password
-        if postgre_sql_host:
-            host_with_key = "host=%s" % postgre_sql_host
-        if postgre_sql_port:
-            port_with_key = "port=%s" % postgre_sql_port
-        connkeys = '%s %s %s %s' % (user_name_with_key, password_with_key, host_with_key, port_with_key)  
-        if not connkeys.isspace():
-            self.psql_base_command.append(connkeys)
+        self.psql_session = self.new_psql_session()
+        
+        ### Nothing to do when the inputs are those of the last applied plan and the server is as it left it
+        with self.tracer.span('plan_cache') as span:
+            fingerprint = self.plan_fingerprint(specs)
+            plan_cache = self.plan_cache_path(specs)
+            cache = None
+            if plan_cache and fingerprint:
+                cache = self.read_plan_cache(plan_cache, fingerprint, postgre_sql_plan_max_age)
+            if cache and self.server_signature(specs) != cache.get('server'):
+                self.output("The server changed since the plan applied on %s, check it again" % time.ctime(cache['applied_at']))
+                cache = None
+            span.set(hit=bool(cache))
+        if cache:
+            self.psql_session.close()
+            self.output("Inputs and server unchanged since the plan applied on %s, nothing to do" % time.ctime(cache['applied_at']))
+            self.env['postgre_sql_plan'] = []
+            self.env['postgre_sql_plan_skipped'] = True
+            self.env['command_log'] = self.runner.log()
+            self.set_outputs([self.unchanged_result(result, spec) for result, spec in zip(cache['results'], specs)], 0)
+            return
+        self.env['postgre_sql_plan_skipped'] = False
+        # Saved again once this run succeeds, a failed run must not leave the plan of a previous one
+        if plan_cache and not self.dry_run:
+            self.forget_plan_cache(plan_cache)
         
         ### Start PostgreSQL on OS X Server if needed
+        ready_wait = 0
+        service_started = False
+        plan = []
         if postgre_sql_start_os_x_server_service:
-            self.output("Start OS X Server PostgreSQL server if needed.")
-            postgre_sql_state = subprocess.check_output(["serveradmin", "start", "postgres"])
-            print postgre_sql_state
-                
-        ### Service check
-        self.check_db_service_or_die()
-        
-        ### State discovery and adjustments            
-        role_exist = self.check_role_existance(postgre_sql_role_name)
-        if role_exist and postgre_sql_always_replace_role_password:
-            self.update_role_with_password(postgre_sql_role_name, postgre_sql_role_password)
-        elif not role_exist:
-            self.create_role_with_password(postgre_sql_role_name, postgre_sql_role_password)
-            role_exist = True
-        
-        db_exist = self.check_db_existance(postgre_sql_database)
-        if db_exist and postgre_sql_drop_db_if_exist:
-            self.drop_database(postgre_sql_database)
-            db_exist = False
+            if self.service_is_running(postgre_sql_service_controller):
+                self.output("OS X Server PostgreSQL server already running.")
+            elif self.dry_run:
+                self.output("OS X Server PostgreSQL server isn't running, the state of the server can't be discovered.")
+                plan.append({'action': 'start_service'})
+            else:
+                self.output("Start OS X Server PostgreSQL server.")
+                plan.append({'action': 'start_service'})
+                postgre_sql_state = self.service_command(postgre_sql_service_controller, 'start')
+                self.output(postgre_sql_state.strip())
+                service_started = True
+        
+        try:
+            ### A freshly started server may need some time before accepting connexions
+            if service_started:
+                ready_wait = self.wait_for_db_service_or_die(postgre_sql_ready_timeout)
             
-        if not db_exist:
-            self.create_database(postgre_sql_database, postgre_sql_role_name)
-            db_exist = True
-            db_created_on_this_run = True
+            if plan and self.dry_run:
+                results = []
+            elif postgre_sql_databases:
+                role_plan, results = self.provision_databases(specs, postgre_sql_max_workers)
+                plan.extend(role_plan)
+            else:
+                results = [self.provision_database(specs[0])]
+            server = None
+            if plan_cache and fingerprint and not self.dry_run and all(result['status'] == 'ok' for result in results):
+                server = self.server_signature(specs)
+        finally:
+            self.psql_session.close()
+            self.env['command_log'] = self.runner.log()
         
-        ### SQL loading
-        if db_created_on_this_run and postgre_sql_creation_input:
-            self.execute_sql_file_to_db(postgre_sql_creation_input, postgre_sql_database)
-        elif not db_created_on_this_run and postgre_sql_update_input:
-            self.execute_sql_file_to_db(postgre_sql_update_input, postgre_sql_database)
+        for result in results:
+            plan.extend(result.get('plan', []))
+        self.env['postgre_sql_plan'] = plan
+        if self.dry_run:
+            for action in plan:
+                self.output("Would %s" % self.describe_action(action), 0)
+            if not plan:
+                self.output("Nothing to do", 0)
+            for result in results:
+                result['password'] = None
+            self.env['postgre_sql_results'] = results
+            return
         
         ### End
-        self.env['postgre_sql_ouput_password'] = postgre_sql_role_password
-
+        if server:
+            self.write_plan_cache(plan_cache, fingerprint, server, results)
+        self.set_outputs(results, ready_wait)
+    
+    
+    def set_outputs(self, results, ready_wait):
+        self.env['postgre_sql_results'] = results
+        self.env['postgre_sql_ready_wait'] = ready_wait
+        if self.env.get('postgre_sql_databases'):
+            failures = [result for result in results if result['status'] != 'ok']
+            if failures:
+                message = "Provisioning failed for %s" % ", ".join(
+                    "%s (%s)" % (result['database'], result['error']) for result in failures)
+                if not self.env.get('postgre_sql_allow_partial_failure', False):
+                    raise ProcessorError(message)
+                self.output(message)
+            return
+        result = results[0]
+        self.env['postgre_sql_ouput_password'] = result['password']
+        self.env['postgre_sql_applied_scripts'] = result['applied_scripts']
+        self.env['postgre_sql_skipped_scripts'] = result['skipped_scripts']
+        self.env['postgre_sql_server_reachable'] = result['server_reachable']
+        self.env['postgre_sql_role_existed'] = result['role_existed']
+        self.env['postgre_sql_database_existed'] = result['database_existed']
+        self.env['postgre_sql_database_owner'] = result['database_owner']
+        self.env['postgre_sql_database_encoding'] = result['database_encoding']
+        self.env['postgre_sql_database_created'] = result['database_created']
+    
+    
+    def plan_database(self, spec, server_state, template, read_ledger, manage_role=True, evict_templates=True):
+        database = spec['database']
+        role_name = spec['role_name']
+        creation_input = spec.get('creation_input')
+        update_input = spec.get('update_input')
+        update_directory = spec.get('update_directory')
+        plan = []
+        
+        ### Adjustments
+        if manage_role:
+            if server_state['role_exist'] and spec.get('always_replace_role_password'):
+                plan.append({'action': 'update_role', 'role': role_name})
+            elif not server_state['role_exist']:
+                plan.append({'action': 'create_role', 'role': role_name})
+        
+        db_exist = server_state['database_exist']
+        if db_exist and spec.get('drop_db_if_exist'):
+            plan.append({'action': 'drop_database', 'database': database})
+            db_exist = False
+        
+        if not db_exist:
+            if template and not server_state['template_exist']:
+                plan.append({'action': 'build_template', 'template': template, 'path': creation_input})
+            plan.append({'action': 'create_database', 'database': database, 'owner': role_name, 'template': template})
+            if template and evict_templates:
+                plan.append({'action': 'evict_templates', 'template': template, 'path': creation_input})
+        
+        ### SQL loading, the session reconnects once to the target database
+        ledger_files = []
+        if not db_exist and creation_input and not template:
+            plan.append({'action': 'load', 'path': creation_input, 'database': database})
+        elif db_exist and self.stream_batch_size and creation_input and self.has_pending_stream(creation_input, database):
+            plan.append({'action': 'resume_load', 'path': creation_input, 'database': database})
+        elif db_exist and update_input and self.ledger:
+            ledger_files.append((update_input, update_input))
+        elif db_exist and update_input:
+            plan.append({'action': 'load', 'path': update_input, 'database': database})
+        
+        if update_directory:
+            # Migrations are known by their name in the directory, which can move
+            ledger_files.extend((os.path.basename(path), path) for path in self.update_directory_files(update_directory))
+        
+        if ledger_files:
+            # A database created by this run has an empty ledger
+            ledger = read_ledger(database) if db_exist else None
+            if ledger is None:
+                plan.append({'action': 'create_ledger', 'database': database, 'table': self.ledger_table})
+                ledger = {}
+            for script, sql_file in ledger_files:
+                with self.tracer.span('checksum', path=sql_file):
+                    checksum = psql.file_checksum(sql_file)
+                action = {'action': 'apply_script', 'path': sql_file, 'script': script, 'database': database,
+                          'checksum': checksum}
+                if ledger.get(script) == checksum:
+                    action['action'] = 'skip_script'
+                plan.append(action)
+        return plan
+    
+    
+    def execute_plan(self, plan, spec):
+        applied_files = []
+        skipped_files = []
+        created = set()
+        for action in plan:
+            kind = action['action']
+            if kind == 'create_role':
+                self.create_role_with_password(action['role'], spec['role_password'])
+            elif kind == 'update_role':
+                self.update_role_with_password(action['role'], spec['role_password'])
+            elif kind == 'drop_database':
+                self.drop_database(action['database'])
+            elif kind == 'build_template':
+                with self.template_lock(action['template']):
+                    if action['template'] not in self.built_templates:
+                        self.build_template(action['template'], action['path'])
+                        self.built_templates.add(action['template'])
+            elif kind == 'create_database':
+                self.create_database(action['database'], action['owner'], action['template'])
+                created.add(action['database'])
+                # The checkpoint of an earlier load into a database of the same name is stale
+                if spec.get('creation_input'):
+                    self.forget_stream(spec['creation_input'], action['database'])
+            elif kind == 'evict_templates':
+                self.evict_templates(action['template'], action['path'], self.template_cache_limit)
+            elif kind == 'load':
+                try:
+                    self.execute_sql_file_to_db(action['path'], action['database'])
+                except (ProcessorError, IOError, OSError):
+                    if action['database'] in created:
+                        self.abandon_database(action['database'], action['path'])
+                    raise
+            elif kind == 'resume_load':
+                self.output("Resume the interrupted load of %s" % action['path'])
+                self.execute_sql_file_to_db(action['path'], action['database'], resume=True)
+            elif kind == 'create_ledger':
+                self.read_ledger(action['database'], action['table'])
+            elif kind == 'skip_script':
+                self.output("Skip unchanged SQL file %s" % action['path'])
+                skipped_files.append(action['path'])
+            elif kind == 'apply_script':
+                self.apply_ledger_script(action['path'], action['script'], action['checksum'], action['database'],
+                                         self.ledger_table)
+                applied_files.append(action['path'])
+        return applied_files, skipped_files
+    
+    
+    def provision_database(self, spec, manage_role=True, evict_templates=True):
+        with self.tracer.span('provision_database', database=spec['database']):
+            try:
+                return self._provision_database(spec, manage_role, evict_templates)
+            except (IOError, OSError) as err:
+                # Missing or unreadable creation_input, update_input or update_directory
+                raise ProcessorError("Unable to provision %s: %s" % (spec['database'], err))
+    
+    
+    def _provision_database(self, spec, manage_role, evict_templates):
+        database = spec['database']
+        role_name = spec['role_name']
+        
+        template = None
+        if self.template_cache and spec.get('creation_input'):
+            template = self.template_name_for(spec['creation_input'])
+        
+        ### Service check and state discovery in one round trip
+        server_state = self.discover_server_state(role_name, database, template)
+        
+        ### The plan is followed unless it's only shown, a dry run reads the ledger without creating it
+        read_ledger = self.peek_ledger if self.dry_run else self.read_ledger
+        plan = self.plan_database(spec, server_state, template, lambda dbname: read_ledger(dbname, self.ledger_table),
+                                  manage_role, evict_templates)
+        applied_files = []
+        skipped_files = []
+        if not self.dry_run:
+            applied_files, skipped_files = self.execute_plan(plan, spec)
+        
+        return {
+            'status': 'ok',
+            'error': None,
+            'database': database,
+            'role_name': role_name,
+            'password': spec['role_password'],
+            'server_reachable': server_state['reachable'],
+            'role_existed': server_state['role_exist'],
+            'database_existed': server_state['database_exist'],
+            'database_owner': server_state['database_owner'],
+            'database_encoding': server_state['database_encoding'],
+            'database_created': not self.dry_run and any(action['action'] == 'create_database' for action in plan),
+            'template': template,
+            'applied_scripts': applied_files,
+            'skipped_scripts': skipped_files,
+            'plan': plan,
+        }
+    
+    
+    def provision_roles(self, specs):
+        roles = []
+        for spec in specs:
+            if spec['role_name'] not in roles:
+                roles.append(spec['role_name'])
+        self.output("Check roles %s" % ", ".join(roles))
+        with self.tracer.span('check_roles', roles=len(roles)):
+            result = self.run_psql_command("SELECT rolname FROM pg_roles WHERE rolname IN (%s)"
+                                           % ", ".join(psql.sql_literal(role) for role in roles))
+        existing_roles = set(result.splitlines())
+        done = {}
+        plan = []
+        for spec in specs:
+            role = spec['role_name']
+            if role in done:
+                if spec['role_password'] != done[role]:
+                    self.output("Role %s is shared with a previous item, its first password is kept" % role)
+                    spec['role_password'] = done[role]
+                continue
+            action = None
+            if role in existing_roles and spec.get('always_replace_role_password'):
+                action = {'action': 'update_role', 'role': role}
+            elif role not in existing_roles:
+                action = {'action': 'create_role', 'role': role}
+            if action:
+                plan.append(action)
+                if not self.dry_run:
+                    self.execute_plan([action], spec)
+            done[role] = spec['role_password']
+        return existing_roles, plan
+    
+    
+    def provision_worker(self, spec):
+        self.psql_session = None
+        try:
+            self.psql_session = self.new_psql_session()
+            return self.provision_database(spec, manage_role=False, evict_templates=False)
+        except Exception as err:
+            # ProcessorError, or anything else that must not stop the other items
+            error = str(err) if isinstance(err, ProcessorError) else "%s: %s" % (err.__class__.__name__, err)
+            self.output("Provisioning of %s failed: %s" % (spec['database'], error))
+            return {'status': 'failed', 'error': error, 'database': spec['database'],
+                    'role_name': spec['role_name'], 'password': spec['role_password']}
+        finally:
+            if self.psql_session is not None:
+                self.psql_session.close()
+    
+    
+    def database_specs(self, items, default_password):
+        specs = []
+        generated_passwords = {}
+        for item in items:
+            if 'database' not in item or 'role_name' not in item:
+                raise ProcessorError("Each postgre_sql_databases item needs a database and a role_name")
+            spec = dict(item)
+            for key in ('always_replace_role_password', 'drop_db_if_exist', 'creation_input', 'update_input', 'update_directory'):
+                spec.setdefault(key, self.env.get('postgre_sql_' + key))
+            spec['generated_password'] = False
+            if not spec.get('role_password'):
+                if 'postgre_sql_role_password' in self.env:
+                    spec['role_password'] = default_password
+                else:
+                    spec['role_password'] = generated_passwords.setdefault(spec['role_name'], self.generate_password())
+                    spec['generated_password'] = True
+            specs.append(spec)
+        return specs
+    
+    
+    def provision_databases(self, specs, max_workers):
+        ### Roles first, once per role, then databases in parallel
+        existing_roles, plan = self.provision_roles(specs)
+        self.output("Provision %d databases with up to %d workers" % (len(specs), max_workers))
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            results = list(pool.map(self.provision_worker, specs))
+        finally:
+            pool.shutdown()
+        for result in results:
+            result['role_existed'] = result['role_name'] in existing_roles
+        
+        evicted = set()
+        for spec, result in zip(specs, results):
+            if result['status'] == 'ok' and result['template'] and result['template'] not in evicted:
+                evicted.add(result['template'])
+                action = {'action': 'evict_templates', 'template': result['template'], 'path': spec['creation_input']}
+                result['plan'].append(action)
+                if not self.dry_run:
+                    self.execute_plan([action], spec)
+        return plan, results
+    
+    
 if __name__ == '__main__':
     processor = PostgreSQL()
     processor.execute_shell()
@@ -15,34 +15,77 @@
 # limitations under the License.
 
 import os
-import random
-import string
+import sys
 
 from autopkglib import Processor, ProcessorError
 
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import entropy
+from processor_utils import tracing
+
 __all__ = ["RandomString"]
 
 
 class RandomString(Processor):
-    description = ("Generate a random printable string (without spaces and return).")
+    description = ("Generate a random printable string (without spaces and return). "
+                   "Characters come from the shared os.urandom buffer of processor_utils.entropy, uniformly drawn from the chosen alphabet.")
     input_variables = {
         "random_string_length": {
             "required": False,
             "description": ("The string length, 42 by default."),
         },
+        "random_string_alphabet": {
+            "required": False,
+            "description": ("Characters to use: \"printable\" (default, printable characters without whitespace), "
+                            "\"hex\", \"alphanumeric\", \"urlsafe\" (alphanumeric, - and _), or \"custom:\" followed "
+                            "by the characters of a custom set, like \"custom:ABCDEF0123456789\"."),
+        },
+        "random_string_count": {
+            "required": False,
+            "description": ("Number of strings to generate in random_strings, 1 by default."),
+        },
+        "processor_trace": {
+            "required": False,
+            "description": ("Set to true to time the phases of the run in processor_trace_spans. False by default."),
+        },
+        "processor_trace_file": {
+            "required": False,
+            "description": ("File the spans are appended to as JSON lines, tracing is enabled when set. Unset by default."),
+        },
     }
     output_variables = {
         "random_string": {
             "description": ("The random string."),
         },
+        "random_strings": {
+            "description": ("The random strings, random_string_count of them, random_string being the first one."),
+        },
+        "processor_trace_spans": {
+            "description": ("With processor_trace or processor_trace_file, one dictionary per timed phase with name, id, parent, start, duration, thread, error and metadata."),
+        },
     }
     
     __doc__ = description
     
         
+    tracer = tracing.DISABLED
+    
+    @tracing.traced
     def main(self):
-        random_string_length = self.env.get('random_string_length', 42)
-        self.env['random_string'] = ''.join(random.choice(string.printable.strip().strip(''''"''')) for i in range(random_string_length))
+        random_string_length = int(self.env.get('random_string_length', 42))
+        random_string_alphabet = self.env.get('random_string_alphabet') or 'printable'
+        random_string_count = int(self.env.get('random_string_count', 1))
+        if random_string_length < 0 or random_string_count < 1:
+            raise ProcessorError("random_string_length can't be negative and random_string_count must be at least 1")
+        try:
+            with self.tracer.span('generate', count=random_string_count, length=random_string_length):
+                strings = entropy.random_strings(random_string_count, random_string_length, random_string_alphabet)
+        except entropy.EntropyError as err:
+            raise ProcessorError(str(err))
+        self.env['random_string'] = strings[0]
+        self.env['random_strings'] = strings
 
 if __name__ == '__main__':
     processor = RandomString()
@@ -14,21 +14,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
 import os
+import sys
+import threading
 import time
 
 from autopkglib import Processor, ProcessorError
-from tempfile import NamedTemporaryFile
+
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import runner
+from processor_utils import sed
+from processor_utils import tracing
 
 __all__ = ["Sed"]
 
 
 class Sed(Processor):
-    description = "Run sed command on target_file (with backup option enabled)."
+    description = ("Run sed command on target_file (with backup option enabled). "
+                   "target_file can be a path, a glob pattern or an array of both, the files are edited "
+                   "by up to sed_max_workers workers. Files the commands don't change are left untouched, "
+                   "the previous content of changed files is kept in a deduplicating backup store.")
     input_variables = {
         "target_file": {
             "required": True,
-            "description": ("Execute sed commands against this file."),
+            "description": ("Execute sed commands against this file. Can also be a glob pattern, "
+                            "or an array of paths and glob patterns."),
         },
         "sed_commands": {
             "required": True,
@@ -39,32 +52,224 @@ class Sed(Processor):
             "required": False,
             "description": "Set to true if you want to keep the temporary sed file created during the process, for debug purpose. False by default.",
         },
+        "sed_engine": {
+            "required": False,
+            "description": ("\"builtin\" (default) runs the commands in-process and falls back to the sed binary "
+                            "for commands the builtin engine doesn't support, and for files whose characters only "
+                            "the locale can match, \"external\" always uses the sed binary."),
+        },
+        "sed_max_workers": {
+            "required": False,
+            "description": "Maximum number of files edited at the same time, 4 by default.",
+        },
+        "sed_backup": {
+            "required": False,
+            "description": ("\"store\" (default) keeps the previous content of changed files in sed_backup_store, "
+                            "\"sibling\" next to them as <target_file>.<timestamp> like before, \"none\" doesn't keep it. "
+                            "\"store\" falls back to \"sibling\" when no store folder is available."),
+        },
+        "sed_backup_store": {
+            "required": False,
+            "description": ("Folder of the content-addressed backup store, default is a SedBackups folder in RECIPE_CACHE_DIR."),
+        },
+        "sed_backup_keep": {
+            "required": False,
+            "description": "Number of backups kept per file in the store, 10 by default.",
+        },
+        "sed_backup_max_age": {
+            "required": False,
+            "description": "Age in days after which backups are removed from the store, unset by default.",
+        },
+        "command_timeout": {
+            "required": False,
+            "description": "Maximum number of seconds for each sed binary call, unset by default.",
+        },
+        "command_deadline": {
+            "required": False,
+            "description": "Maximum number of seconds for all the sed binary calls of the run, unset by default.",
+        },
+        "command_max_concurrent": {
+            "required": False,
+            "description": "Maximum number of sed binary calls running at the same time, unset by default (sed_max_workers bounds them).",
+        },
+        "processor_trace": {
+            "required": False,
+            "description": ("Set to true to time the phases of the run in processor_trace_spans. False by default."),
+        },
+        "processor_trace_file": {
+            "required": False,
+            "description": ("File the spans are appended to as JSON lines, tracing is enabled when set. Unset by default."),
+        },
     }
     output_variables = {
+        "sed_engine_used": {
+            "description": "\"builtin\" or \"external\", the engine that edited target_file.",
+        },
+        "sed_changed_files": {
+            "description": "Files whose content was changed by the sed commands.",
+        },
+        "sed_unchanged_files": {
+            "description": "Files whose content was left as it was by the sed commands.",
+        },
+        "sed_changed": {
+            "description": "True if the sed commands changed at least one file.",
+        },
+        "command_log": {
+            "description": "One dictionary per sed binary call with command, started, duration, status, timed_out, error and stderr.",
+        },
+        "processor_trace_spans": {
+            "description": ("With processor_trace or processor_trace_file, one dictionary per timed phase with name, id, parent, start, duration, thread, error and metadata."),
+        },
     }
     
     __doc__ = description
     
+    tracer = tracing.DISABLED
+    
+    def expand_targets(self, target_file):
+        patterns = [target_file] if isinstance(target_file, str) else list(target_file)
+        targets = []
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                matches = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+                if not matches:
+                    raise ProcessorError("No file matches %s" % pattern)
+            elif not os.path.exists(pattern):
+                raise ProcessorError("The target file don't exist! (%s)" % pattern)
+            else:
+                matches = [pattern]
+            for path in matches:
+                if path not in targets:
+                    targets.append(path)
+        return targets
+
+    @tracing.traced
     def main(self):
         sed_debug = self.env.get('sed_debug', False)
         target_file = self.env['target_file']
         sed_commands = self.env['sed_commands']
+        sed_max_workers = int(self.env.get('sed_max_workers', 4))
         if not target_file:
             raise ProcessorError("Expected an 'target_file' input variable but none is set!")
-        if not os.path.exists(target_file):
-            raise ProcessorError("The target file don't exist! (%s)" % target_file)
         if not sed_commands:
             raise ProcessorError("Expected instruction from 'sed_commands' input variable but none is set!")
-        tmp_sed_commands_file = NamedTemporaryFile(delete=not sed_debug)
+        with self.tracer.span('expand_targets') as span:
+            targets = self.expand_targets(target_file)
+            span.set(files=len(targets))
+        engine = self.env.get('sed_engine') or "builtin"
+        if engine not in ("builtin", "external"):
+            raise ProcessorError("Unknown sed_engine %s, expected builtin or external" % engine)
+        try:
+            self.runner = runner.from_settings(self.env)
+        except runner.CommandError as err:
+            raise ProcessorError(str(err))
+        backup = self.backup_function()
+        program = None
+        if engine == "builtin":
+            with self.tracer.span('compile', commands=len(sed_commands)):
+                program, reason = sed.load_program(sed_commands)
+            if program is None:
+                self.output("Builtin sed engine can't run these commands (%s), using the sed binary" % reason)
+        self.script_file = None
+        self.script_lock = threading.Lock()
+        if program is not None:
+            if sed_debug:
+                self.output("[DEBUG] Builtin sed engine, compiled scripts cache: %s" % (sed.compile_script.cache_info(),))
+            edit = lambda path: self.run_builtin(program, path, backup, sed_commands, sed_debug)
+            self.env["sed_engine_used"] = "builtin"
+        else:
+            edit = lambda path: self.run_external(self.script_path(sed_commands, sed_debug), path, backup)
+            self.env["sed_engine_used"] = "external"
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=max(sed_max_workers, 1))
+        try:
+            results = list(pool.map(edit, targets))
+        finally:
+            pool.shutdown()
+            if self.script_file is not None:
+                self.script_file.close()
+            self.env["command_log"] = self.runner.log()
+        self.env["sed_changed_files"] = [result['path'] for result in results if result['changed']]
+        self.env["sed_unchanged_files"] = [result['path'] for result in results
+                                           if not result['changed'] and not result['error']]
+        self.env["sed_changed"] = bool(self.env["sed_changed_files"])
+        failures = [result for result in results if result['error']]
+        if failures:
+            raise ProcessorError("Editing failed for %s" % ", ".join(
+                "%s (%s)" % (result['path'], result['error']) for result in failures))
+        for result in results:
+            self.output("Editing done %s%s" % (result['path'], "" if result['changed'] else " (unchanged)"))
+
+    def backup_function(self):
+        mode = self.env.get('sed_backup') or "store"
+        if mode not in ("store", "sibling", "none"):
+            raise ProcessorError("Unknown sed_backup %s, expected store, sibling or none" % mode)
+        if mode == "none":
+            return None
+        from processor_utils import backups
+        root = self.env.get('sed_backup_store')
+        if not root and self.env.get('RECIPE_CACHE_DIR'):
+            root = os.path.join(self.env['RECIPE_CACHE_DIR'], 'SedBackups')
+        if mode == "sibling" or not root:
+            suffix = ".%s" % time.time()
+            return lambda path, digest: backups.link_or_copy(path, path + suffix)
+        max_age = self.env.get('sed_backup_max_age')
+        store = backups.BackupStore(root, keep=int(self.env.get('sed_backup_keep', 10)),
+                                    max_age=float(max_age) * 86400 if max_age is not None else None)
+        return store.add
+
+    def run_builtin(self, program, path, backup, sed_commands, sed_debug):
+        result = {'path': path, 'changed': False, 'error': None}
+        with self.tracer.span('edit', path=path, engine="builtin") as span:
+            try:
+                if self.tracer.enabled:
+                    span.set(bytes=os.path.getsize(path))
+                before, after = sed.edit_file(program, path, backup)
+                result['changed'] = before != after
+            except sed.LocaleError as err:
+                # Nothing has been written, the sed binary edits the file from the start
+                self.output("Builtin sed engine can't edit %s (%s), using the sed binary" % (path, err))
+                return self.run_external(self.script_path(sed_commands, sed_debug), path, backup)
+            except (sed.SedError, IOError, OSError) as err:
+                result['error'] = str(err)
+            span.set(changed=result['changed'])
+        return result
+
+    def script_path(self, sed_commands, sed_debug):
+        with self.script_lock:
+            if self.script_file is None:
+                self.script_file = self.write_script(sed_commands, sed_debug)
+        return self.script_file.name
+
+    def write_script(self, sed_commands, sed_debug):
+        from tempfile import NamedTemporaryFile
+        tmp_sed_commands_file = NamedTemporaryFile('w', suffix='.sed', delete=not sed_debug)
         if sed_debug:
             self.output("[DEBUG] Sed file is %s" % tmp_sed_commands_file.name)
         for command in sed_commands:
             tmp_sed_commands_file.write(command)
             tmp_sed_commands_file.write('\n')
         tmp_sed_commands_file.flush()
-        os.system("sed -f %s -i .%s %s" % (tmp_sed_commands_file.name, time.time(), target_file))
-        tmp_sed_commands_file.close()
-        self.output("Editing done %s" % target_file)
+        return tmp_sed_commands_file
+
+    def run_external(self, script_path, path, backup):
+        result = {'path': path, 'changed': False, 'error': None}
+
+        # sed writes to stdout, the file is replaced like with the builtin engine
+        def produce(source, write):
+            with self.tracer.span('sed', path=path):
+                self.runner.run(['sed', '-f', script_path, path], stdout=write)
+
+        with self.tracer.span('edit', path=path, engine="external") as span:
+            try:
+                if self.tracer.enabled:
+                    span.set(bytes=os.path.getsize(path))
+                before, after = sed.replace_file(path, produce, backup)
+                result['changed'] = before != after
+            except (sed.SedError, runner.CommandError, IOError, OSError) as err:
+                result['error'] = str(err)
+            span.set(changed=result['changed'])
+        return result
 
 if __name__ == '__main__':
     processor = Sed()
@@ -15,16 +15,24 @@
 # limitations under the License.
 
 import os
-import subprocess
+import sys
 
 from autopkglib import Processor, ProcessorError
-from tempfile import NamedTemporaryFile
+
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import permissions
+from processor_utils import runner
+from processor_utils import tracing
 
 __all__ = ["SetPermissionAndOwner"]
 
 
 class SetPermissionAndOwner(Processor):
-    description = "Change permission and ownder for different paths."
+    description = ("Change permission and ownder for different paths. Changes are applied in-process, "
+                   "through a single sudo call for the whole list when not running as root. "
+                   "Both lists are merged so each tree is walked once, entries already right are left untouched.")
     input_variables = {
         "chmod_list": {
             "required": False,
@@ -34,47 +42,115 @@ class SetPermissionAndOwner(Processor):
             "required": False,
             "description": ("Pass an array of dictionary with followings keys: path, owner (value in chown format), and recursive as bool (optional)."),
         },
+        "permissions_max_workers": {
+            "required": False,
+            "description": ("Number of threads scanning the directories of recursive entries, 1 by default."),
+        },
+        "permissions_manifest": {
+            "required": False,
+            "description": ("Path of a manifest file recording each directory walked, its mtime and the changes applied. "
+                            "Directories unchanged since the last successful pass aren't listed again. Unset by default."),
+        },
+        "permissions_dry_run": {
+            "required": False,
+            "description": ("Set to true to print the changes that would be made without applying them. False by default."),
+        },
+        "command_timeout": {
+            "required": False,
+            "description": ("Maximum number of seconds for the sudo call applying the changes, unset by default."),
+        },
+        "command_deadline": {
+            "required": False,
+            "description": ("Maximum number of seconds for all the commands of the run, unset by default."),
+        },
+        "processor_trace": {
+            "required": False,
+            "description": ("Set to true to time the phases of the run in processor_trace_spans. False by default."),
+        },
+        "processor_trace_file": {
+            "required": False,
+            "description": ("File the spans are appended to as JSON lines, tracing is enabled when set. Unset by default."),
+        },
     }
     output_variables = {
+        "permissions_examined": {
+            "description": "Number of entries examined.",
+        },
+        "permissions_changed": {
+            "description": "Number of entries whose owner or mode was changed.",
+        },
+        "permissions_skipped": {
+            "description": "Number of entries left untouched as their owner and mode were already right.",
+        },
+        "permissions_unchanged_directories": {
+            "description": "Number of directories not listed again as they didn't change since the last pass.",
+        },
+        "permissions_planned_changes": {
+            "description": "With permissions_dry_run, the chown and chmod changes that would be made.",
+        },
+        "command_log": {
+            "description": "One dictionary per command run (the sudo call) with command, started, duration, status, timed_out, error and stderr.",
+        },
+        "processor_trace_spans": {
+            "description": ("With processor_trace or processor_trace_file, one dictionary per timed phase with name, id, parent, start, duration, thread, error and metadata."),
+        },
     }
     
     __doc__ = description
     
+    tracer = tracing.DISABLED
+    
+    @tracing.traced
     def main(self):
         chmod_list = self.env.get('chmod_list', [])
         chown_list = self.env.get('chown_list', [])
+        permissions_max_workers = int(self.env.get('permissions_max_workers', 1))
+        permissions_manifest = self.env.get('permissions_manifest', None)
+        permissions_dry_run = bool(self.env.get('permissions_dry_run', False))
         
+        operations = []
         for path_info in chmod_list:
-            path = path_info['path']
             rights = path_info['rights']
-            recursive = False
-            if path_info.has_key('recursive'):
-                recursive = path_info['recursive']
-            commands = []
-            commands.append('sudo')
-            commands.append('chmod')
-            if recursive:
-                commands.append('-R')
-            commands.append(rights)
-            commands.append(path)
-            self.output("Set permission %s to %s" % (rights, path))
-            command_result = subprocess.check_output(commands)
+            self.output("Set permission %s to %s" % (rights, path_info['path']))
+            operations.append({'path': path_info['path'], 'mode': rights,
+                               'recursive': bool(path_info.get('recursive', False))})
         
         for path_info in chown_list:
-            path = path_info['path']
             owner = path_info['owner']
-            recursive = False
-            if path_info.has_key('recursive'):
-                recursive = path_info['recursive']
-            commands = []
-            commands.append('sudo')
-            commands.append('chown')
-            if recursive:
-                commands.append('-R')
-            commands.append(owner)
-            commands.append(path)
-            self.output("Set owner %s to %s" % (owner, path))
-            command_result = subprocess.check_output(commands)
+            self.output("Set owner %s to %s" % (owner, path_info['path']))
+            operations.append({'path': path_info['path'], 'owner': owner,
+                               'recursive': bool(path_info.get('recursive', False))})
+        
+        try:
+            command_runner = runner.from_settings(self.env)
+        except runner.CommandError as err:
+            raise ProcessorError(str(err))
+        result = {'examined': 0, 'changed': 0, 'skipped': 0, 'unchanged_directories': 0, 'errors': [], 'planned': []}
+        if operations:
+            try:
+                with self.tracer.span('apply_plan', operations=len(operations), dry_run=permissions_dry_run,
+                                      privileged_helper=os.geteuid() != 0 and not permissions_dry_run) as span:
+                    result = permissions.run_plan(operations, dry_run=permissions_dry_run,
+                                                  manifest_path=permissions_manifest,
+                                                  max_workers=permissions_max_workers, runner=command_runner)
+                    span.set(examined=result['examined'], changed=result['changed'], skipped=result['skipped'],
+                             unchanged_directories=result['unchanged_directories'], errors=len(result['errors']))
+            except permissions.PermissionsError as err:
+                raise ProcessorError(str(err))
+            finally:
+                self.env['command_log'] = command_runner.log()
+        self.env['permissions_examined'] = result['examined']
+        self.env['permissions_changed'] = result['changed']
+        self.env['permissions_skipped'] = result['skipped']
+        self.env['permissions_unchanged_directories'] = result['unchanged_directories']
+        self.env['permissions_planned_changes'] = result['planned']
+        for change in result['planned']:
+            self.output("Would %s" % change)
+        self.output("%d entries examined, %d %s, %d already right, %d unchanged directories skipped"
+                    % (result['examined'], result['changed'], "to change" if permissions_dry_run else "changed",
+                       result['skipped'], result['unchanged_directories']))
+        if result['errors']:
+            raise ProcessorError("Unable to change %d entries: %s" % (len(result['errors']), "; ".join(result['errors'][:10])))
 
 if __name__ == '__main__':
     processor = SetPermissionAndOwner()
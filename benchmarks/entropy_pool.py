@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Small secrets per second, one os.urandom call each against the buffered entropy pool.
+
+The pool saves the os.urandom calls, the last column counts those it still
+makes for 1000 secrets. How much that is worth depends on the cost of the
+call: a getrandom() system call on Linux is cheap enough for both to be on
+par, reading /dev/urandom or a slower getentropy() isn't. --device reads
+/dev/urandom for both to show the latter case.
+
+    python benchmarks/entropy_pool.py [--min-time SECONDS] [--threads 1,4,...] [--sizes 6,16,...] [--device]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from processor_utils import entropy
+
+SIZES = (6, 16, 32, 256)
+THREADS = (1, 4, 16)
+
+URANDOM = os.urandom
+POOL = entropy.POOL
+
+
+def legacy_password(size):
+    """What PostgreSQL.generate_password did before entropy was used, for 2 * size characters."""
+    return ''.join(random.choice(string.hexdigits) for i in range(2 * size))
+
+
+def device_urandom(size, device=[]):
+    """os.urandom through an unbuffered /dev/urandom read."""
+    if not device:
+        device.append(open('/dev/urandom', 'rb', buffering=0))
+    return device[0].read(size)
+
+
+def urandom_token_hex(size):
+    return URANDOM(size).hex()
+
+
+def pool_token_hex(size):
+    return POOL.token_hex(size)
+
+
+def measure(function, size, threads, min_time):
+    """Calls per second of function(size), run by threads threads for at least min_time seconds."""
+    counts = [0] * threads
+    start = threading.Barrier(threads + 1)
+    stop = threading.Event()
+
+    def work(index):
+        start.wait()
+        calls = 0
+        while not stop.is_set():
+            for i in range(100):
+                function(size)
+            calls += 100
+        counts[index] = calls
+
+    workers = [threading.Thread(target=work, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    started = time.perf_counter()
+    time.sleep(min_time)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.perf_counter() - started), sum(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds spent on each measure")
+    parser.add_argument('--threads', default=','.join(str(threads) for threads in THREADS))
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES), help="bytes of each secret")
+    parser.add_argument('--device', action='store_true', help="read /dev/urandom instead of calling getrandom()")
+    args = parser.parse_args(argv)
+    global URANDOM, POOL
+    if args.device:
+        URANDOM = device_urandom
+        POOL = entropy.EntropyPool(urandom=device_urandom)
+    print("%7s %6s %14s %14s %14s %9s %13s" % ("threads", "bytes", "legacy/s", "urandom/s", "pool/s", "speedup", "refills/1000"))
+    for threads in [int(value) for value in args.threads.split(',')]:
+        for size in [int(value) for value in args.sizes.split(',')]:
+            legacy_rate, calls = measure(legacy_password, size, threads, args.min_time)
+            urandom_rate, calls = measure(urandom_token_hex, size, threads, args.min_time)
+            refills = POOL.refills
+            pool_rate, calls = measure(pool_token_hex, size, threads, args.min_time)
+            print("%7d %6d %14.0f %14.0f %14.0f %8.1fx %13.3f"
+                  % (threads, size, legacy_rate, urandom_rate, pool_rate, pool_rate / urandom_rate,
+                     (POOL.refills - refills) * 1000.0 / calls))
+
+
+if __name__ == '__main__':
+    main()
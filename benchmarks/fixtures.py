@@ -0,0 +1,124 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generated inputs of the benchmark suite.
+
+Every generator is deterministic for a given seed, so two runs of the suite
+measure the same work.
+"""
+
+import os
+import plistlib
+import random
+
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+         "india", "juliet", "kilo", "lima", "mike", "november", "oscar", "papa")
+
+
+def text_file(path, size, seed=0, line_length=72):
+    """A text file of about size bytes, lines of words from WORDS. Returns the size written."""
+    generator = random.Random(seed)
+    written = 0
+    with open(path, 'w') as handle:
+        lines = []
+        while written < size:
+            words = []
+            length = 0
+            while length < line_length:
+                word = generator.choice(WORDS)
+                words.append(word)
+                length += len(word) + 1
+            line = " ".join(words) + "\n"
+            lines.append(line)
+            written += len(line)
+            if len(lines) == 4096:
+                handle.write("".join(lines))
+                lines = []
+        handle.write("".join(lines))
+    return written
+
+
+def text_files(folder, count, size, seed=0):
+    """count text files of about size bytes in folder. Returns their paths."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, "file%05d.conf" % index)
+        text_file(path, size, seed + index)
+        paths.append(path)
+    return paths
+
+
+def tree(root, depth, breadth, files):
+    """Folders breadth wide and depth deep under root, files files in each. Returns the number of entries."""
+    entries = 1
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    for index in range(files):
+        with open(os.path.join(root, "file%d" % index), 'w') as handle:
+            handle.write("x")
+        entries += 1
+    if depth > 0:
+        for index in range(breadth):
+            entries += tree(os.path.join(root, "dir%d" % index), depth - 1, breadth, files)
+    return entries
+
+
+def sql_file(path, tables, rows, seed=0, copy_every=2):
+    """A SQL file creating tables, each filled with rows rows, by COPY blocks or INSERT statements.
+
+    Returns the number of statements.
+    """
+    generator = random.Random(seed)
+    statements = 0
+    with open(path, 'w') as handle:
+        for table in range(tables):
+            name = "bench_%d" % table
+            handle.write("CREATE TABLE %s (id integer PRIMARY KEY, name text, value integer);\n" % name)
+            statements += 1
+            if copy_every and table % copy_every == 0:
+                handle.write("COPY %s (id, name, value) FROM stdin;\n" % name)
+                handle.write("".join("%d\t%s\t%d\n" % (row, generator.choice(WORDS), generator.randint(0, 1 << 20))
+                                     for row in range(rows)))
+                handle.write("\\.\n")
+                statements += 1
+            else:
+                handle.write("".join("INSERT INTO %s (id, name, value) VALUES (%d, '%s', %d);\n"
+                                     % (name, row, generator.choice(WORDS), generator.randint(0, 1 << 20))
+                                     for row in range(rows)))
+                statements += rows
+            handle.write("CREATE INDEX %s_value ON %s (value);\n" % (name, name))
+            statements += 1
+    return statements
+
+
+def system_root(root, system_version="10.9.5", server_version="3.2.2"):
+    """A fake OS X tree for OSXServerOnly, with Server.app unless server_version is None."""
+    def write_plist(relative_path, content):
+        path = os.path.join(root, relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as handle:
+            plistlib.dump(content, handle)
+
+    write_plist("System/Library/CoreServices/SystemVersion.plist",
+                {'ProductName': "Mac OS X", 'ProductVersion': system_version})
+    if server_version:
+        write_plist("Applications/Server.app/Contents/Info.plist", {'CFBundleShortVersionString': server_version})
+        library = os.path.join(root, "Library/Server")
+        if not os.path.isdir(library):
+            os.makedirs(library)
+    return root
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import time of each processor module, failing when startup regresses.
+
+    python benchmarks/importtime.py [--runs 7] [--threshold MS] [PROCESSOR ...]
+
+Each processor is imported by a fresh interpreter run with -X importtime,
+benchmarks/stubs standing in for autopkglib; the median of the cumulative
+time of the module is reported twice: from a bare interpreter, and once the
+modules AutoPKG's autopkglib imports itself are loaded, which is what a
+recipe run pays.
+
+The exit status is 1 when a median from a bare interpreter is over
+--threshold milliseconds, or when a processor imports at load time one of
+HEAVY, the modules only some code paths need and import when they run.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+STUBS = os.path.join(BENCHMARKS, 'stubs')
+
+PROCESSORS = ('OSXServerOnly', 'PostgreSQL', 'RandomString', 'Sed', 'SetPermissionAndOwner')
+
+# Imported by autopkglib before any processor
+AUTOPKG_IMPORTS = ('glob', 'json', 'os', 'plistlib', 're', 'subprocess', 'sys', 'time', 'traceback')
+
+# Imported lazily by the code paths using them
+HEAVY = ('base64', 'concurrent.futures', 'distutils', 'hashlib', 'platform', 'plistlib', 'selectors',
+         'shutil', 'subprocess', 'tempfile', 'processor_utils.backups', 'processor_utils.sqlstream')
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile(module, preload=()):
+    """Cumulative import time of module in microseconds and the modules its import loaded."""
+    statement = "import sys; sys.path[:0] = [%r, %r]; %s import %s" % (
+        STUBS, ROOT, "".join("import %s; " % name for name in preload), module)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=ROOT)
+    if process.returncode:
+        raise RuntimeError("Importing %s failed: %s" % (module, process.stderr.strip().splitlines()[-1]))
+    loaded = []
+    cumulative = None
+    # Lines of the modules module imports come before its own, at deeper levels
+    pending = []
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        name = match.group(4)
+        if len(match.group(3)) == 1 and name == module:
+            cumulative = int(match.group(2))
+            loaded = pending
+        elif len(match.group(3)) == 1:
+            pending = []
+        else:
+            pending.append(name)
+    return cumulative, loaded
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def heavy_imports(loaded):
+    return sorted(set(name for name in loaded for heavy in HEAVY if name == heavy or name.startswith(heavy + '.')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('processors', nargs='*', default=list(PROCESSORS), help="processors measured, all by default")
+    parser.add_argument('--runs', type=int, default=7, help="interpreters started per measure, 7 by default")
+    parser.add_argument('--threshold', type=float, default=30.0,
+                        help="maximum median import time from a bare interpreter, in milliseconds, 30 by default")
+    args = parser.parse_args(argv)
+
+    failures = []
+    print("%-22s %12s %16s  %s" % ("processor", "bare", "after autopkglib", "heavy modules imported"))
+    for processor in args.processors:
+        bare = []
+        loaded = []
+        for run in range(args.runs):
+            cumulative, loaded = import_profile(processor)
+            bare.append(cumulative)
+        warm = median([import_profile(processor, AUTOPKG_IMPORTS)[0] for run in range(args.runs)])
+        heavy = heavy_imports(loaded)
+        print("%-22s %10.1fms %14.1fms  %s" % (processor, median(bare) / 1000.0, warm / 1000.0, ", ".join(heavy) or "-"))
+        if median(bare) / 1000.0 > args.threshold:
+            failures.append("%s takes %.1fms to import, over %.1fms" % (processor, median(bare) / 1000.0, args.threshold))
+        if heavy:
+            failures.append("%s imports %s when loaded" % (processor, ", ".join(heavy)))
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
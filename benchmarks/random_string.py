@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput of RandomString generation, previous implementation against os.urandom bulk sampling.
+
+    python benchmarks/random_string.py [--min-time SECONDS] [--lengths 8,64,...]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from processor_utils import entropy
+
+LENGTHS = (8, 64, 1024, 65536, 1048576)
+
+
+def legacy_random_string(length):
+    """What RandomString.main did before entropy was used."""
+    return ''.join(random.choice(string.printable.strip().strip('''\'"''')) for i in range(length))
+
+
+def bulk_random_string(length):
+    return entropy.random_characters(length, 'printable')
+
+
+def measure(function, length, min_time):
+    """Calls per second and characters per second of function(length) over at least min_time seconds."""
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or calls < 3:
+        function(length)
+        calls += 1
+        elapsed = time.perf_counter() - started
+    return calls / elapsed, calls * length / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds spent on each measure")
+    parser.add_argument('--lengths', default=','.join(str(length) for length in LENGTHS))
+    args = parser.parse_args(argv)
+    print("%10s %16s %16s %16s %9s" % ("length", "legacy chars/s", "bulk chars/s", "bulk strings/s", "speedup"))
+    for length in [int(value) for value in args.lengths.split(',')]:
+        legacy_calls, legacy_rate = measure(legacy_random_string, length, args.min_time)
+        bulk_calls, bulk_rate = measure(bulk_random_string, length, args.min_time)
+        print("%10d %16.0f %16.0f %16.0f %8.1fx" % (length, legacy_rate, bulk_rate, bulk_calls, bulk_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
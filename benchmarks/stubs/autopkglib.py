@@ -0,0 +1,59 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-in for the parts of AutoPKG's autopkglib the processors use, for the benchmarks.
+
+Only Processor and ProcessorError are provided, with AutoPKG's behavior for
+what the processors rely on: env, output() and its verbose level, the check
+of required input variables in process().
+"""
+
+import sys
+
+
+class ProcessorError(Exception):
+    pass
+
+
+class Processor(object):
+    input_variables = {}
+    output_variables = {}
+
+    def __init__(self, env=None, infile=None, outfile=None):
+        self.env = env if env is not None else {}
+        self.infile = infile or sys.stdin
+        self.outfile = outfile or sys.stdout
+
+    def output(self, msg, verbose_level=1):
+        if self.env.get('verbose', 0) >= verbose_level:
+            print("%s: %s" % (self.__class__.__name__, msg))
+
+    def main(self):
+        raise ProcessorError("Abstract method main() not implemented.")
+
+    def process(self):
+        for variable, flags in self.input_variables.items():
+            if flags.get("required") and variable not in self.env:
+                raise ProcessorError("%s requires %s" % (self.__class__.__name__, variable))
+        self.main()
+        return self.env
+
+    def execute_shell(self):
+        self.env.setdefault('verbose', 1)
+        try:
+            self.process()
+        except ProcessorError as err:
+            sys.stderr.write("ProcessorError: %s\n" % err)
+            sys.exit(10)
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Latency, throughput and peak memory of every processor, outside of AutoPKG.
+
+    python benchmarks/suite.py [--scale 1.0] [--repeat 5] [--only NAME,...]
+                               [--output FILE] [--compare FILE] [--threshold 0.1]
+
+Each scenario runs in its own interpreter, with benchmarks/stubs standing in
+for autopkglib and benchmarks/fakes (psql, serveradmin, sudo) first on PATH,
+against inputs generated by benchmarks/fixtures.py in a temporary folder.
+Latencies are per processor invocation; throughput leaves the first
+invocation out when there are several, as it fills the caches; peak memory
+is the maximum resident size of the interpreter and of the commands it ran.
+
+Results are saved as JSON, in benchmarks/results by default. --compare
+prints the ratios against an earlier result file and exits with status 1
+when a scenario got slower or bigger by more than --threshold.
+"""
+
+import argparse
+import collections
+import getpass
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+STUBS = os.path.join(BENCHMARKS, 'stubs')
+FAKES = os.path.join(BENCHMARKS, 'fakes')
+RESULTS = os.path.join(BENCHMARKS, 'results')
+
+sys.path.insert(0, BENCHMARKS)
+
+import fixtures
+
+RESULTS_VERSION = 1
+
+Scenario = collections.namedtuple('Scenario', 'name processor unit calls setup')
+SCENARIOS = collections.OrderedDict()
+
+
+class Skip(Exception):
+    pass
+
+
+def scenario(name, processor, unit, calls=1):
+    """Register setup(workdir, scale) as a scenario. It returns invoke(index), which runs calls
+    processor invocations and returns the number of units they processed."""
+    def register(setup):
+        SCENARIOS[name] = Scenario(name, processor, unit, calls, setup)
+        return setup
+    return register
+
+
+def processor_class(name):
+    module = __import__(name)
+    return getattr(module, name)
+
+
+def run_processor(name, env):
+    env.setdefault('verbose', 0)
+    processor = processor_class(name)(env=env)
+    processor.process()
+    return processor.env
+
+
+@scenario('random_string', 'RandomString', 'strings')
+def random_string(workdir, scale):
+    count = max(1, int(10000 * scale))
+
+    def invoke(index):
+        run_processor('RandomString', {'random_string_length': 42, 'random_string_count': count})
+        return count
+    return invoke
+
+
+@scenario('osx_server_only', 'OSXServerOnly', 'invocations', calls=100)
+def osx_server_only(workdir, scale):
+    root = fixtures.system_root(os.path.join(workdir, 'root'))
+    cache = os.path.join(workdir, 'probe.json')
+
+    def invoke(index):
+        for call in range(100):
+            run_processor('OSXServerOnly', {'minimum_system_version': '10.7', 'os_x_root': root,
+                                            'os_x_probe_cache': cache})
+        return 100
+    return invoke
+
+
+def sed_scenario(workdir, scale, engine):
+    if engine == 'external' and not shutil.which('sed'):
+        raise Skip("no sed binary")
+    path = os.path.join(workdir, 'big.conf')
+    size = fixtures.text_file(path, int(16 * 1024 * 1024 * scale))
+    commands = (['s/alpha/omega/g', 's/^bravo/BRAVO/'], ['s/omega/alpha/g', 's/^BRAVO/bravo/'])
+
+    def invoke(index):
+        run_processor('Sed', {'target_file': path, 'sed_commands': commands[index % 2], 'sed_engine': engine,
+                              'sed_backup_store': os.path.join(workdir, 'backups')})
+        return size / 1048576.0
+    return invoke
+
+
+@scenario('sed_builtin', 'Sed', 'MB')
+def sed_builtin(workdir, scale):
+    return sed_scenario(workdir, scale, 'builtin')
+
+
+@scenario('sed_external', 'Sed', 'MB')
+def sed_external(workdir, scale):
+    return sed_scenario(workdir, scale, 'external')
+
+
+@scenario('sed_many_files', 'Sed', 'files')
+def sed_many_files(workdir, scale):
+    count = max(1, int(200 * scale))
+    fixtures.text_files(os.path.join(workdir, 'conf'), count, 16 * 1024)
+    commands = (['s/^alpha/ALPHA/'], ['s/^ALPHA/alpha/'])
+
+    def invoke(index):
+        run_processor('Sed', {'target_file': os.path.join(workdir, 'conf', '*.conf'),
+                              'sed_commands': commands[index % 2],
+                              'sed_backup_store': os.path.join(workdir, 'backups')})
+        return count
+    return invoke
+
+
+def permissions_tree(workdir, scale):
+    root = os.path.join(workdir, 'tree')
+    entries = fixtures.tree(root, 4, 6, max(1, int(4 * scale)))
+    return root, entries
+
+
+@scenario('permissions_tree', 'SetPermissionAndOwner', 'entries')
+def permissions_changes(workdir, scale):
+    root, entries = permissions_tree(workdir, scale)
+    modes = ('u=rwX,go=rX', 'u=rwX,go=')
+    owner = getpass.getuser()
+
+    def invoke(index):
+        env = run_processor('SetPermissionAndOwner', {
+            'chmod_list': [{'path': root, 'rights': modes[index % 2], 'recursive': True}],
+            'chown_list': [{'path': root, 'owner': owner, 'recursive': True}],
+            'permissions_max_workers': 4,
+        })
+        return env['permissions_examined']
+    return invoke
+
+
+@scenario('permissions_manifest', 'SetPermissionAndOwner', 'entries')
+def permissions_manifest(workdir, scale):
+    root, entries = permissions_tree(workdir, scale)
+    manifest = os.path.join(workdir, 'manifest')
+
+    def invoke(index):
+        run_processor('SetPermissionAndOwner', {
+            'chmod_list': [{'path': root, 'rights': 'u=rwX,go=rX', 'recursive': True}],
+            'permissions_manifest': manifest,
+        })
+        return entries
+    return invoke
+
+
+def postgresql_env(workdir, **settings):
+    env = {
+        'postgre_sql_psql_path': os.path.join(FAKES, 'psql'),
+        'postgre_sql_service_controller': os.path.join(FAKES, 'serveradmin'),
+        'postgre_sql_admin_name': 'postgres',
+        'postgre_sql_role_name': 'bench',
+        'postgre_sql_role_password': 'bench',
+        'RECIPE_CACHE_DIR': os.path.join(workdir, 'cache'),
+    }
+    env.update(settings)
+    return env
+
+
+def postgresql_load(workdir, scale, **settings):
+    sql_file = os.path.join(workdir, 'create.sql')
+    fixtures.sql_file(sql_file, 8, max(1, int(5000 * scale)))
+    size = os.path.getsize(sql_file)
+
+    def invoke(index):
+        run_processor('PostgreSQL', postgresql_env(workdir, postgre_sql_database='bench_%d' % index,
+                                                   postgre_sql_creation_input=sql_file, **settings))
+        return size / 1048576.0
+    return invoke
+
+
+@scenario('postgresql_create', 'PostgreSQL', 'MB')
+def postgresql_create(workdir, scale):
+    return postgresql_load(workdir, scale)
+
+
+@scenario('postgresql_stream', 'PostgreSQL', 'MB')
+def postgresql_stream(workdir, scale):
+    return postgresql_load(workdir, scale, postgre_sql_stream_batch_size=1000)
+
+
+@scenario('postgresql_subprocess', 'PostgreSQL', 'invocations')
+def postgresql_subprocess(workdir, scale):
+    def invoke(index):
+        run_processor('PostgreSQL', postgresql_env(workdir, postgre_sql_database='bench_%d' % index,
+                                                   postgre_sql_session_mode='subprocess'))
+        return 1
+    return invoke
+
+
+def postgresql_migrations(workdir, scale):
+    migrations = os.path.join(workdir, 'migrations')
+    count = max(1, int(20 * scale))
+    os.makedirs(migrations)
+    for index in range(count):
+        fixtures.sql_file(os.path.join(migrations, '%04d.sql' % index), 1, 200, seed=index)
+    return migrations, count
+
+
+@scenario('postgresql_ledger', 'PostgreSQL', 'scripts')
+def postgresql_ledger(workdir, scale):
+    migrations, count = postgresql_migrations(workdir, scale)
+
+    def invoke(index):
+        # Without the plan cache, the runs after the first one would not read the ledger
+        run_processor('PostgreSQL', postgresql_env(workdir, postgre_sql_database='bench',
+                                                   postgre_sql_update_directory=migrations,
+                                                   postgre_sql_plan_cache=''))
+        return count
+    return invoke
+
+
+@scenario('postgresql_unchanged', 'PostgreSQL', 'scripts')
+def postgresql_unchanged(workdir, scale):
+    migrations, count = postgresql_migrations(workdir, scale)
+
+    def invoke(index):
+        env = run_processor('PostgreSQL', postgresql_env(workdir, postgre_sql_database='bench',
+                                                         postgre_sql_update_directory=migrations))
+        if index and not env['postgre_sql_plan_skipped']:
+            raise RuntimeError("Run %d with unchanged inputs wasn't skipped" % index)
+        return count
+    return invoke
+
+
+def peak_rss_kb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # Bytes on OS X, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(name, workdir, scale, repeat):
+    """Run one scenario in this interpreter, see child()."""
+    sys.path[:0] = [STUBS, ROOT]
+    definition = SCENARIOS[name]
+    try:
+        invoke = definition.setup(workdir, scale)
+    except Skip as err:
+        return {'processor': definition.processor, 'unit': definition.unit, 'skipped': str(err)}
+    setup_rss = peak_rss_kb(resource.RUSAGE_SELF)
+    latencies = []
+    units = []
+    for index in range(repeat):
+        started = time.perf_counter()
+        units.append(invoke(index))
+        latencies.append((time.perf_counter() - started) / definition.calls)
+    warm = slice(1, None) if repeat > 1 else slice(None)
+    warm_time = sum(latencies[warm]) * definition.calls
+    return {
+        'processor': definition.processor,
+        'unit': definition.unit,
+        'invocations': repeat * definition.calls,
+        'latency': {
+            'first': latencies[0],
+            'min': min(latencies),
+            'median': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'mean': sum(latencies) / len(latencies),
+        },
+        'units': sum(units),
+        'throughput': sum(units[warm]) / warm_time if warm_time else None,
+        'setup_rss_kb': setup_rss,
+        'peak_rss_kb': peak_rss_kb(resource.RUSAGE_SELF),
+        'children_peak_rss_kb': peak_rss_kb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def spawn_scenario(name, scale, repeat, keep=False):
+    """Run a scenario in a new interpreter and return its result."""
+    workdir = tempfile.mkdtemp(prefix='bench-%s-' % name)
+    env = dict(os.environ)
+    env['PATH'] = FAKES + os.pathsep + env.get('PATH', '')
+    env['FAKE_PSQL_STATE'] = os.path.join(workdir, 'psql.json')
+    env['FAKE_SERVERADMIN_STATE'] = os.path.join(workdir, 'serveradmin')
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--workdir', workdir,
+               '--scale', str(scale), '--repeat', str(repeat)]
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                                 universal_newlines=True)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if process.returncode != 0:
+        return {'processor': SCENARIOS[name].processor, 'unit': SCENARIOS[name].unit,
+                'error': (process.stderr.strip().splitlines() or ["exit status %d" % process.returncode])[-1]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_latency(seconds):
+    if seconds >= 1:
+        return "%.2fs" % seconds
+    if seconds >= 0.001:
+        return "%.1fms" % (seconds * 1000)
+    return "%.0fus" % (seconds * 1000000)
+
+
+def print_results(results):
+    print("%-22s %9s %9s %9s %22s %10s %10s" % ("scenario", "first", "median", "p95", "throughput", "peak RSS", "children"))
+    for name, result in results['scenarios'].items():
+        if 'skipped' in result or 'error' in result:
+            print("%-22s %s" % (name, "skipped: %s" % result['skipped'] if 'skipped' in result else "error: %s" % result['error']))
+            continue
+        latency = result['latency']
+        throughput = "%.1f %s/s" % (result['throughput'], result['unit']) if result['throughput'] else "-"
+        print("%-22s %9s %9s %9s %22s %8dMB %8dMB" % (
+            name, format_latency(latency['first']), format_latency(latency['median']), format_latency(latency['p95']),
+            throughput, result['peak_rss_kb'] // 1024, result['children_peak_rss_kb'] // 1024))
+
+
+def compare(baseline, results, threshold):
+    """Print the ratios of results to baseline, return the names of the scenarios that regressed."""
+    regressions = []
+    print("\n%-22s %14s %14s %14s  (against %s)" % ("scenario", "median ratio", "throughput", "peak RSS",
+                                                     baseline.get('commit') or baseline.get('created')))
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or 'latency' not in before or 'latency' not in result:
+            continue
+        latency = result['latency']['median'] / before['latency']['median']
+        throughput = (result['throughput'] / before['throughput']
+                      if result['throughput'] and before['throughput'] else None)
+        memory = float(result['peak_rss_kb']) / before['peak_rss_kb']
+        regressed = (latency > 1 + threshold or memory > 1 + threshold
+                     or (throughput is not None and throughput < 1 - threshold))
+        if regressed:
+            regressions.append(name)
+        print("%-22s %13.2fx %13s %13.2fx%s" % (name, latency, "%.2fx" % throughput if throughput else "-",
+                                                memory, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def child(args):
+    result = run_scenario(args.child, args.workdir, args.scale, args.repeat)
+    print(json.dumps(result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0, help="size of the generated inputs, 1 by default")
+    parser.add_argument('--repeat', type=int, default=5, help="invocations of each scenario")
+    parser.add_argument('--only', help="comma separated scenarios, all by default: %s" % ", ".join(SCENARIOS))
+    parser.add_argument('--output', help="result file, benchmarks/results/<commit>-<time>.json by default")
+    parser.add_argument('--compare', help="earlier result file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change reported as a regression")
+    parser.add_argument('--keep', action='store_true', help="keep the working folders of the scenarios")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return child(args)
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios %s" % ", ".join(unknown))
+    commit = git_commit()
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'scenarios': collections.OrderedDict(),
+    }
+    for name in names:
+        results['scenarios'][name] = spawn_scenario(name, args.scale, args.repeat, args.keep)
+    print_results(results)
+    output = args.output
+    if not output:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        output = os.path.join(RESULTS, "%s-%s.json" % (commit or 'unknown', time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=1)
+    print("\nResults saved in %s" % output)
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        if compare(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
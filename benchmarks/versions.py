@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import time and comparisons per second, distutils' StrictVersion against processor_utils.versions.
+
+    python benchmarks/versions.py [--min-time SECONDS] [--imports COUNT]
+
+Import times are those of a fresh interpreter, minus the one of an empty
+interpreter. Nothing is measured for distutils where it's gone (Python 3.12
+and later).
+"""
+
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from processor_utils import versions
+
+# Pairs compared by OSXServerOnly and their like
+VERSIONS = ('10.6.8', '10.7', '10.8.5', '10.9', '10.9.3', '10.10', '10.10.5', '10.11.6')
+
+
+def import_time(statement, count):
+    """Best wall time in seconds of a fresh interpreter running statement, over count runs."""
+    best = None
+    for i in range(count):
+        started = time.perf_counter()
+        subprocess.check_call([sys.executable, '-W', 'ignore', '-c', statement], cwd=ROOT)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def distutils_compare():
+    try:
+        from distutils import version
+    except ImportError:
+        return None
+    return lambda first, second: version.StrictVersion(first) >= version.StrictVersion(second)
+
+
+def measure(function, pairs, min_time):
+    """Comparisons per second of function(first, second) over at least min_time seconds."""
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        for first, second in pairs:
+            function(first, second)
+        calls += len(pairs)
+        elapsed = time.perf_counter() - started
+    return calls / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds spent on each measure")
+    parser.add_argument('--imports', type=int, default=10, help="interpreters started for each import time")
+    args = parser.parse_args(argv)
+    # StrictVersion warns on each instance on recent Pythons
+    warnings.simplefilter('ignore', DeprecationWarning)
+    empty = import_time('pass', args.imports)
+    compare = distutils_compare()
+    pairs = list(itertools.product(VERSIONS, repeat=2))
+    print("%-28s %14s %16s" % ("", "import ms", "comparisons/s"))
+    if compare is None:
+        print("%-28s %14s %16s" % ("distutils.version", "unavailable", "unavailable"))
+    else:
+        print("%-28s %14.1f %16.0f" % ("distutils.version",
+                                        (import_time('from distutils import version', args.imports) - empty) * 1000,
+                                        measure(compare, pairs, args.min_time)))
+    print("%-28s %14.1f %16.0f" % ("processor_utils.versions",
+                                    (import_time('from processor_utils import versions', args.imports) - empty) * 1000,
+                                    measure(versions.at_least, pairs, args.min_time)))
+
+
+if __name__ == '__main__':
+    main()
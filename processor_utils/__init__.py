@@ -0,0 +1,23 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Support code shared by the processors of this repository.
+
+Nothing in this package imports autopkglib, so its modules can also be run
+outside of AutoPKG (helpers executed through sudo, benchmarks, ...).
+Processors make the package importable by adding their own directory to
+sys.path before importing it. batch is the exception: it loads processors, and
+through them autopkglib, when it runs.
+"""
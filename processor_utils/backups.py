@@ -0,0 +1,148 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed store for the backups of edited files.
+
+Each distinct content is kept once, as objects/<sha[:2]>/<sha>, hard linked
+to the original file when the store is on the same volume and copied
+otherwise. targets/<sha of the path>.json lists the backups of one file,
+newest last, and is pruned by count and age; objects no longer listed by
+any file are removed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+def link_or_copy(source, destination):
+    """Hard link source as destination, copy it when links aren't possible."""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        temporary_path = "%s.%d.%d.tmp" % (destination, os.getpid(), threading.get_ident())
+        shutil.copy2(source, temporary_path)
+        os.rename(temporary_path, destination)
+
+
+class BackupStore(object):
+
+    def __init__(self, root, keep=None, max_age=None):
+        self.root = root
+        self.keep = keep
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def index_path(self, path):
+        key = hashlib.sha256(os.path.abspath(path).encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.root, 'targets', key + '.json')
+
+    def history(self, path):
+        """Backups of path, oldest first, as {"time": ..., "digest": ..., "object": ...} dicts."""
+        index_path = self.index_path(path)
+        if not os.path.exists(index_path):
+            return []
+        try:
+            with open(index_path) as handle:
+                backups = json.load(handle)['backups']
+        except (ValueError, KeyError):
+            return []
+        for backup in backups:
+            backup['object'] = self.object_path(backup['digest'])
+        return backups
+
+    def _write_index(self, path, backups):
+        index_path = self.index_path(path)
+        if not backups:
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            return
+        if not os.path.isdir(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        temporary_path = "%s.%d.%d.tmp" % (index_path, os.getpid(), threading.get_ident())
+        with open(temporary_path, 'w') as handle:
+            json.dump({'path': os.path.abspath(path),
+                       'backups': [{'time': backup['time'], 'digest': backup['digest']} for backup in backups]},
+                      handle)
+        os.rename(temporary_path, index_path)
+
+    def _store_object(self, path, digest):
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            return object_path
+        directory = os.path.dirname(object_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            link_or_copy(path, object_path)
+        except FileExistsError:
+            pass
+        return object_path
+
+    def add(self, path, digest):
+        """Record the current content of path, whose sha256 hex digest is given, and apply retention."""
+        with self.lock:
+            object_path = self._store_object(path, digest)
+            backups = self.history(path)
+            backups.append({'time': time.time(), 'digest': digest, 'object': object_path})
+            kept = self._retained(backups)
+            self._write_index(path, kept)
+            if len(kept) < len(backups):
+                self.collect_garbage(set(backup['digest'] for backup in backups))
+        return object_path
+
+    def _retained(self, backups):
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+            backups = [backup for backup in backups if backup['time'] >= oldest]
+        if self.keep is not None:
+            backups = backups[-self.keep:] if self.keep > 0 else []
+        return backups
+
+    def collect_garbage(self, candidates=None):
+        """Remove objects listed by no target, among candidates (digests) or all of them."""
+        targets = os.path.join(self.root, 'targets')
+        referenced = set()
+        if os.path.isdir(targets):
+            for name in os.listdir(targets):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(targets, name)) as handle:
+                        referenced.update(backup['digest'] for backup in json.load(handle)['backups'])
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+        if candidates is None:
+            objects = os.path.join(self.root, 'objects')
+            candidates = set()
+            if os.path.isdir(objects):
+                for prefix in os.listdir(objects):
+                    candidates.update(name for name in os.listdir(os.path.join(objects, prefix))
+                                      if not name.endswith('.tmp'))
+        removed = []
+        for digest in candidates - referenced:
+            object_path = self.object_path(digest)
+            if os.path.exists(object_path):
+                os.remove(object_path)
+                removed.append(digest)
+        return removed
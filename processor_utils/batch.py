@@ -0,0 +1,244 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run a processor over many input environments in one interpreter.
+
+    python -m processor_utils.batch PROCESSOR [INPUT] [--workers 4] [--pool thread|process]
+                                    [--set KEY=VALUE ...] [--path DIR ...] [--output FILE]
+
+INPUT (stdin by default) is either JSON lines, one dictionary per line, or a
+plist array of dictionaries. Each dictionary, over the --set values, is the
+env of one run of PROCESSOR, loaded from the processors folder. Runs are
+spread over a pool of threads or processes; each thread or process creates
+the processor once and reuses it for all the runs it gets.
+
+One JSON line per input is written, in input order, as soon as it and the
+ones before it are done: index, status ("ok" or "error"), error, duration
+and outputs, the output variables of the processor. The exit status is 1 if
+any run failed.
+
+The processors import autopkglib, AutoPKG's or benchmarks/stubs, --path adds
+the folder it is in to sys.path. While the batch runs, what the processors
+print goes to stderr so that stdout only has the results.
+"""
+
+import argparse
+import collections
+import importlib
+import json
+import os
+import plistlib
+import sys
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+PROCESSORS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THREAD_POOL = "thread"
+PROCESS_POOL = "process"
+
+
+class BatchError(Exception):
+    pass
+
+
+def load_processor(name, paths=()):
+    """Processor class name, from the module of the same name."""
+    for path in [PROCESSORS_DIR] + list(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    try:
+        module = importlib.import_module(name)
+        return getattr(module, name)
+    except (ImportError, AttributeError) as err:
+        raise BatchError("Unable to load processor %s: %s" % (name, err))
+
+
+def read_items(handle):
+    """Input environments of handle, a binary file object: JSON lines or a plist array.
+
+    Lines that aren't a JSON dictionary are yielded as BatchError, so that their run fails alone.
+    """
+    first = handle.peek(8)[:8] if hasattr(handle, 'peek') else b''
+    if first.lstrip().startswith(b'<') or first.startswith(b'bplist'):
+        try:
+            # plistlib needs to seek, which pipes can't
+            items = plistlib.loads(handle.read())
+        except Exception as err:
+            raise BatchError("Invalid plist input: %s" % err)
+        if not isinstance(items, list):
+            raise BatchError("The plist input must be an array of dictionaries")
+        for number, item in enumerate(items, 1):
+            yield item if isinstance(item, dict) else BatchError("Item %d isn't a dictionary" % number)
+        return
+    for number, line in enumerate(handle, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line.decode('utf-8'))
+        except ValueError as err:
+            yield BatchError("Line %d isn't valid JSON: %s" % (number, err))
+            continue
+        yield item if isinstance(item, dict) else BatchError("Line %d isn't a dictionary" % number)
+
+
+class _Worker(object):
+    """Processor instances of the threads of a pool, created once per thread."""
+
+    def __init__(self, name, paths=()):
+        self.processor_class = load_processor(name, paths)
+        self.local = threading.local()
+
+    def processor(self):
+        processor = getattr(self.local, 'processor', None)
+        if processor is None:
+            processor = self.local.processor = self.processor_class(env={})
+        return processor
+
+    def run(self, index, item, defaults):
+        result = {'index': index, 'status': 'error', 'error': None, 'duration': 0.0, 'outputs': {}}
+        if isinstance(item, Exception):
+            result['error'] = str(item)
+            return result
+        env = dict(defaults)
+        env.update(item)
+        env.setdefault('verbose', 0)
+        started = time.time()
+        try:
+            processor = self.processor()
+            processor.env = env
+            processor.process()
+            result['status'] = 'ok'
+        except Exception as err:
+            # ProcessorError, or anything else a broken input makes the processor raise
+            if err.__class__.__name__ == 'ProcessorError':
+                result['error'] = str(err)
+            else:
+                result['error'] = "%s: %s" % (err.__class__.__name__, err)
+        result['duration'] = time.time() - started
+        result['outputs'] = dict((key, env[key]) for key in self.processor_class.output_variables if key in env)
+        return result
+
+
+# Worker of the processes of a process pool, set up by _start_process()
+_process_worker = None
+
+
+def _start_process(name, paths):
+    global _process_worker
+    sys.stdout = sys.stderr
+    _process_worker = _Worker(name, paths)
+
+
+def _run_in_process(index, item, defaults):
+    return _process_worker.run(index, item, defaults)
+
+
+def run_batch(name, items, defaults=None, workers=4, pool=THREAD_POOL, paths=()):
+    """Run the processor name over items, yield the results in the order of items.
+
+    At most a few times workers items are read ahead, so items can be a stream of any length.
+    """
+    defaults = dict(defaults or {})
+    if pool not in (THREAD_POOL, PROCESS_POOL):
+        raise BatchError("Unknown pool %s, expected %s or %s" % (pool, THREAD_POOL, PROCESS_POOL))
+    if workers <= 1 and pool == THREAD_POOL:
+        worker = _Worker(name, paths)
+        for index, item in enumerate(items):
+            yield worker.run(index, item, defaults)
+        return
+    if pool == THREAD_POOL:
+        worker = _Worker(name, paths)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda index, item: executor.submit(worker.run, index, item, defaults)
+    else:
+        # Load errors are reported here rather than by each process
+        load_processor(name, paths)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_start_process, initargs=(name, list(paths)))
+        submit = lambda index, item: executor.submit(_run_in_process, index, item, defaults)
+    pending = collections.deque()
+    window = max(workers, 1) * 4
+
+    def collect():
+        index, future = pending.popleft()
+        try:
+            return future.result()
+        except Exception as err:
+            return {'index': index, 'status': 'error', 'error': "%s: %s" % (err.__class__.__name__, err),
+                    'duration': 0.0, 'outputs': {}}
+
+    try:
+        for index, item in enumerate(items):
+            pending.append((index, submit(index, item)))
+            if len(pending) >= window:
+                yield collect()
+        while pending:
+            yield collect()
+    finally:
+        for index, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def parse_setting(text):
+    key, separator, value = text.partition('=')
+    if not separator or not key:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got %s" % text)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('processor', help="name of the processor, like Sed")
+    parser.add_argument('input', nargs='?', help="JSON lines or plist array of input environments, stdin by default")
+    parser.add_argument('--workers', type=int, default=4, help="size of the pool, 4 by default")
+    parser.add_argument('--pool', choices=(THREAD_POOL, PROCESS_POOL), default=THREAD_POOL,
+                        help="threads (default) or processes")
+    parser.add_argument('--set', dest='settings', action='append', type=parse_setting, default=[],
+                        metavar='KEY=VALUE', help="value given to every run unless its input sets it, JSON or string")
+    parser.add_argument('--path', dest='paths', action='append', default=[],
+                        help="folder added to sys.path, the one of autopkglib for instance")
+    parser.add_argument('--output', help="result file, stdout by default")
+    args = parser.parse_args(argv)
+
+    results_handle = open(args.output, 'w') if args.output else sys.stdout
+    input_handle = open(args.input, 'rb') if args.input else sys.stdin.buffer
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    failures = 0
+    try:
+        for result in run_batch(args.processor, read_items(input_handle), dict(args.settings),
+                                args.workers, args.pool, args.paths):
+            failures += result['status'] != 'ok'
+            results_handle.write(json.dumps(result, sort_keys=True, default=str) + "\n")
+            results_handle.flush()
+    except BatchError as err:
+        sys.stderr.write("%s\n" % err)
+        return 2
+    finally:
+        sys.stdout = stdout
+        if args.input:
+            input_handle.close()
+        if args.output:
+            results_handle.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
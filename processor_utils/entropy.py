@@ -0,0 +1,202 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cryptographically secure random bytes and strings.
+
+An EntropyPool reads os.urandom by large blocks and hands out slices of
+them, so the thousands of small secrets of a provisioning run cost a few
+system calls. Threads don't share blocks, and a forked child drops those
+it inherited, which would otherwise hand out the same bytes as its parent.
+
+Characters are drawn from random bytes in bulk. For an alphabet of n
+characters, the bytes below the largest multiple of n under 256 are mapped
+to alphabet[byte % n] and the others are dropped, which keeps every
+character equally likely; bytes.translate() does both for a whole buffer
+at once.
+"""
+
+import os
+import string
+import threading
+import weakref
+
+from functools import lru_cache
+
+ALPHABETS = {
+    # What RandomString always produced: the printable characters but whitespace
+    'printable': string.printable.strip().strip('\'"'),
+    'hex': '0123456789abcdef',
+    'alphanumeric': string.ascii_letters + string.digits,
+    'urlsafe': string.ascii_letters + string.digits + '-_',
+}
+# Marks a custom set of characters, so a misspelled name isn't taken for one
+CUSTOM = 'custom:'
+
+
+class EntropyError(Exception):
+    pass
+
+
+_pools = weakref.WeakSet()
+
+
+def _forget_after_fork():
+    for pool in list(_pools):
+        pool.reset()
+
+
+# Without the hook, each read compares the pid instead
+_FORK_HOOK = hasattr(os, 'register_at_fork')
+if _FORK_HOOK:
+    os.register_at_fork(after_in_child=_forget_after_fork)
+
+
+class EntropyPool(object):
+    """Random bytes read from os.urandom by blocks of block_size.
+
+    Each thread draws from its own block, so no lock is taken but to count
+    the refills.
+    """
+
+    def __init__(self, block_size=16 * 1024, urandom=os.urandom):
+        self.block_size = block_size
+        self.urandom = urandom
+        self.lock = threading.Lock()
+        self.refills = 0
+        self.reset()
+        _pools.add(self)
+
+    def reset(self):
+        """Drop the buffered bytes of every thread."""
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def read(self, size):
+        """size random bytes, never handed out twice."""
+        if not _FORK_HOOK and self._pid != os.getpid():
+            self.reset()
+        local = self._local
+        try:
+            buffer = local.buffer
+            offset = local.offset
+        except AttributeError:
+            buffer = b''
+            offset = 0
+        end = offset + size
+        if end > len(buffer):
+            if size >= self.block_size:
+                return self.urandom(size)
+            buffer = local.buffer = self.urandom(self.block_size)
+            offset = 0
+            end = size
+            with self.lock:
+                self.refills += 1
+        local.offset = end
+        return buffer[offset:end]
+
+    def token_bytes(self, size):
+        return self.read(size)
+
+    def token_hex(self, size):
+        """size random bytes as 2 * size hex digits."""
+        return self.read(size).hex()
+
+    def token_base64(self, size, urlsafe=False):
+        """size random bytes in base64, without padding."""
+        import base64
+        encode = base64.urlsafe_b64encode if urlsafe else base64.b64encode
+        return encode(self.read(size)).rstrip(b'=').decode('ascii')
+
+    def characters(self, length, characters='printable'):
+        return random_characters(length, characters, self)
+
+    def strings(self, count, length, characters='printable'):
+        return random_strings(count, length, characters, self)
+
+
+class Alphabet(object):
+    """Precomputed translation tables of an alphabet, see alphabet()."""
+
+    def __init__(self, characters):
+        characters = ''.join(sorted(set(characters), key=characters.index))
+        if len(characters) < 2:
+            raise EntropyError("An alphabet needs at least 2 distinct characters")
+        if len(characters) > 256:
+            raise EntropyError("An alphabet can't have more than 256 characters")
+        self.characters = characters
+        self.size = len(characters)
+        # Bytes from limit up would make the first characters more likely
+        self.limit = 256 - 256 % self.size
+        self.rejected = bytes(range(self.limit, 256))
+        self.ascii = all(ord(char) < 128 for char in characters)
+        targets = characters if self.ascii else [chr(index) for index in range(self.size)]
+        self.table = bytes(ord(targets[byte % self.size]) for byte in range(self.limit)) + bytes(256 - self.limit)
+        # Average number of random bytes needed per character
+        self.cost = 256.0 / self.limit
+
+    def decode(self, data):
+        if self.ascii:
+            return data.decode('ascii')
+        characters = self.characters
+        return ''.join([characters[index] for index in data])
+
+    def sample(self, data):
+        """Map the random bytes of data to characters, dropping the rejected ones."""
+        return data.translate(self.table, self.rejected)
+
+
+@lru_cache(maxsize=64)
+def alphabet(name_or_characters):
+    """Alphabet for a name of ALPHABETS, or for the characters following CUSTOM."""
+    if name_or_characters in ALPHABETS:
+        return Alphabet(ALPHABETS[name_or_characters])
+    if name_or_characters.startswith(CUSTOM):
+        return Alphabet(name_or_characters[len(CUSTOM):])
+    raise EntropyError("Unknown alphabet %r, expected one of %s or %s followed by the characters to use"
+                       % (name_or_characters, ", ".join(sorted(ALPHABETS)), CUSTOM))
+
+
+def random_characters(length, characters='printable', pool=None):
+    """A string of length characters drawn uniformly from an alphabet."""
+    read = (pool or POOL).read
+    table = alphabet(characters)
+    chunks = []
+    missing = length
+    while missing > 0:
+        # A little more than the expected need, so one read is nearly always enough
+        data = table.sample(read(int(missing * table.cost * 1.05) + 16))
+        chunks.append(data[:missing])
+        missing -= len(chunks[-1])
+    return table.decode(b''.join(chunks))
+
+
+def random_strings(count, length, characters='printable', pool=None):
+    """count strings of length characters, drawn in one go."""
+    if not length:
+        return [''] * count
+    data = random_characters(count * length, characters, pool)
+    return [data[index:index + length] for index in range(0, count * length, length)]
+
+
+# The pool shared by the processors
+POOL = EntropyPool()
+
+
+def token_hex(size):
+    return POOL.token_hex(size)
+
+
+def token_base64(size, urlsafe=False):
+    return POOL.token_base64(size, urlsafe)
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mode and owner changes done in-process, used by the SetPermissionAndOwner processor.
+
+Modes are parsed and applied like chmod does (octal and symbolic modes,
+umask when no "who" is given, X, s, t, copies like g=u, set-user-ID and
+set-group-ID bits of directories kept by octal modes). Owners are given like
+chown does, user, user:group, user: and :group, with names or numeric IDs.
+Recursive changes walk the tree with os.scandir, without following symbolic
+links: chmod skips them, chown changes the links themselves.
+
+A plan is a list of operations, {"path", "mode" or "owner", "recursive"}.
+apply_plan() walks each tree once for all of them, optionally on several
+threads and skipping directories unchanged since the previous pass, and
+only changes the entries whose lstat() shows a different owner or mode.
+When the process isn't root, run_plan() passes the whole plan as JSON to
+one "sudo python permissions.py" process, this file having no dependency
+outside of the standard library.
+"""
+
+import grp
+import marshal
+import os
+import pwd
+import stat
+import sys
+
+from functools import lru_cache
+
+CHMOD_MODE_BITS = 0o7777
+MANIFEST_VERSION = 1
+_ORDINARY, _COPY_EXISTING, _X_IF_ANY_X = range(3)
+_WHO_BITS = {
+    'u': stat.S_ISUID | stat.S_IRWXU,
+    'g': stat.S_ISGID | stat.S_IRWXG,
+    'o': stat.S_ISVTX | stat.S_IRWXO,
+    'a': CHMOD_MODE_BITS,
+}
+_PERMISSION_BITS = {
+    'r': stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
+    'w': stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH,
+    'x': stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
+    's': stat.S_ISUID | stat.S_ISGID,
+    't': stat.S_ISVTX,
+}
+_COPY_BITS = {'u': stat.S_IRWXU, 'g': stat.S_IRWXG, 'o': stat.S_IRWXO}
+_ALL_READ = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+_ALL_WRITE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+_ALL_EXECUTE = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+class PermissionsError(Exception):
+    pass
+
+
+@lru_cache(maxsize=256)
+def parse_mode(spec):
+    """Compile a chmod mode into a tuple of (op, flag, affected, value, mentioned) changes."""
+    spec = str(spec)
+    if spec and all(char in '01234567' for char in spec):
+        mode = int(spec, 8)
+        if mode > CHMOD_MODE_BITS:
+            raise PermissionsError("invalid mode: %s" % spec)
+        # Up to 4 digits, the set-user-ID and set-group-ID bits of directories are kept unless set
+        if len(spec) < 5:
+            mentioned = (mode & (stat.S_ISUID | stat.S_ISGID)) | stat.S_ISVTX | 0o777
+        else:
+            mentioned = CHMOD_MODE_BITS
+        return (('=', _ORDINARY, CHMOD_MODE_BITS, mode, mentioned),)
+    changes = []
+    for clause in spec.split(','):
+        pos = 0
+        affected = 0
+        while pos < len(clause) and clause[pos] in _WHO_BITS:
+            affected |= _WHO_BITS[clause[pos]]
+            pos += 1
+        if pos >= len(clause) or clause[pos] not in '+-=':
+            raise PermissionsError("invalid mode: %s" % spec)
+        while pos < len(clause) and clause[pos] in '+-=':
+            op = clause[pos]
+            pos += 1
+            value = 0
+            flag = _ORDINARY
+            if pos < len(clause) and clause[pos] in _COPY_BITS:
+                value = _COPY_BITS[clause[pos]]
+                flag = _COPY_EXISTING
+                pos += 1
+            else:
+                while pos < len(clause) and clause[pos] in 'rwxXst':
+                    if clause[pos] == 'X':
+                        flag = _X_IF_ANY_X
+                    else:
+                        value |= _PERMISSION_BITS[clause[pos]]
+                    pos += 1
+            mentioned = affected & value if affected else value
+            changes.append((op, flag, affected, value, mentioned))
+        if pos != len(clause):
+            raise PermissionsError("invalid mode: %s" % spec)
+    return tuple(changes)
+
+
+def adjust_mode(changes, mode, is_dir, umask):
+    """New permission bits of a file of the given mode once changes are applied."""
+    new_mode = mode & CHMOD_MODE_BITS
+    for op, flag, affected, value, mentioned in changes:
+        omitted = (stat.S_ISUID | stat.S_ISGID if is_dir else 0) & ~mentioned
+        if flag == _COPY_EXISTING:
+            value &= new_mode
+            value |= ((_ALL_READ if value & _ALL_READ else 0)
+                      | (_ALL_WRITE if value & _ALL_WRITE else 0)
+                      | (_ALL_EXECUTE if value & _ALL_EXECUTE else 0))
+        elif flag == _X_IF_ANY_X:
+            if new_mode & _ALL_EXECUTE or is_dir:
+                value |= _ALL_EXECUTE
+        # With no "who" the umask applies
+        value &= (affected if affected else ~umask) & ~omitted
+        if op == '=':
+            preserved = (~affected if affected else 0) | omitted
+            new_mode = (new_mode & preserved) | value
+        elif op == '+':
+            new_mode |= value
+        else:
+            new_mode &= ~value
+    return new_mode & CHMOD_MODE_BITS
+
+
+@lru_cache(maxsize=1024)
+def lookup_user(name):
+    """(uid, login gid) of a user name or numeric ID."""
+    try:
+        entry = pwd.getpwnam(name)
+        return entry.pw_uid, entry.pw_gid
+    except KeyError:
+        pass
+    if name.isdigit():
+        uid = int(name)
+        try:
+            return uid, pwd.getpwuid(uid).pw_gid
+        except KeyError:
+            return uid, -1
+    raise PermissionsError("invalid user: %s" % name)
+
+
+@lru_cache(maxsize=1024)
+def lookup_group(name):
+    try:
+        return grp.getgrnam(name).gr_gid
+    except KeyError:
+        pass
+    if name.isdigit():
+        return int(name)
+    raise PermissionsError("invalid group: %s" % name)
+
+
+def parse_owner(spec):
+    """(uid, gid) of a chown owner, -1 for the part that doesn't change."""
+    spec = str(spec)
+    user, separator, group = spec.partition(':')
+    uid = gid = -1
+    if user:
+        uid, login_gid = lookup_user(user)
+        if separator and not group:
+            if login_gid < 0:
+                raise PermissionsError("invalid user: %s" % spec)
+            gid = login_gid
+    if group:
+        gid = lookup_group(group)
+    if not user and not group and not separator:
+        raise PermissionsError("invalid owner: %s" % spec)
+    return uid, gid
+
+
+class Counts(object):
+
+    def __init__(self):
+        self.examined = 0
+        self.changed = 0
+        self.skipped = 0
+        self.unchanged_directories = 0
+        self.errors = []
+        self.planned = []
+
+    def merge(self, other):
+        self.examined += other.examined
+        self.changed += other.changed
+        self.skipped += other.skipped
+        self.unchanged_directories += other.unchanged_directories
+        self.errors.extend(other.errors)
+        self.planned.extend(other.planned)
+
+    def as_dict(self):
+        return {'examined': self.examined, 'changed': self.changed, 'skipped': self.skipped,
+                'unchanged_directories': self.unchanged_directories, 'errors': self.errors,
+                'planned': self.planned}
+
+
+def _desired_owner(rules, uid, gid):
+    for index, operation in rules:
+        if 'owner' in operation:
+            new_uid, new_gid = operation['owner']
+            uid = uid if new_uid == -1 else new_uid
+            gid = gid if new_gid == -1 else new_gid
+    return uid, gid
+
+
+def _desired_mode(rules, mode, umask):
+    new_mode = stat.S_IMODE(mode)
+    is_dir = stat.S_ISDIR(mode)
+    for index, operation in rules:
+        if 'mode' in operation:
+            new_mode = adjust_mode(parse_mode(operation['mode']), new_mode, is_dir, umask)
+    return new_mode
+
+
+def _rule_key(rule):
+    operation = rule[1]
+    owner = tuple(operation['owner']) if 'owner' in operation else None
+    return (operation.get('mode'), owner, bool(operation.get('recursive')))
+
+
+def load_manifest(path):
+    """Directory records of a manifest file, {} when it is missing or unreadable."""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'rb') as handle:
+            manifest = marshal.load(handle)
+    except (EOFError, ValueError, TypeError, OSError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['directories']
+
+
+def save_manifest(path, directories):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, 'wb') as handle:
+        marshal.dump({'version': MANIFEST_VERSION, 'directories': directories}, handle)
+    os.rename(temporary_path, path)
+
+
+class PlanRun(object):
+    """Apply a plan, walking each tree once and changing only the entries that need it.
+
+    Operations are grouped by path. Each path with recursive operations is
+    walked once, operations given for paths inside it being applied along
+    the way. For one entry, the owner is set before the mode, owner changes
+    and mode changes composing in plan order.
+
+    Directories are scanned as separate tasks, on up to max_workers
+    threads. With a manifest (directory path: mtime, ctime, fingerprint of
+    the rules applied, subdirectories) from a previous successful pass, a
+    directory whose mtime and ctime didn't change isn't listed again: only
+    its recorded subdirectories are visited and the entries with rules of
+    their own are checked. In dry_run mode nothing is
+    changed and the changes that would be made are listed instead.
+    """
+
+    def __init__(self, plan, umask, dry_run=False, manifest=None, max_workers=1):
+        self.umask = umask
+        self.dry_run = dry_run
+        self.manifest = manifest or {}
+        self.max_workers = max(int(max_workers), 1)
+        self.records = {}
+        self.rules = {}
+        for index, operation in enumerate(plan):
+            self.rules.setdefault(os.path.abspath(operation['path']), []).append((index, operation))
+        # Directories leading to a path with rules, walks go down them even with nothing to apply
+        self.ancestors = set()
+        self.children_rules = {}
+        self.children_paths = {}
+        for path, rules in self.rules.items():
+            self.children_rules.setdefault(os.path.dirname(path), []).extend(rules)
+            self.children_paths.setdefault(os.path.dirname(path), []).append(path)
+            parent = os.path.dirname(path)
+            while parent not in self.ancestors and parent != os.path.dirname(parent):
+                self.ancestors.add(parent)
+                parent = os.path.dirname(parent)
+
+    def apply_entry(self, path, info, rules, counts, follow_mode=False, follow_owner=False):
+        """Bring one entry to the owner then the mode its rules (sorted (index, operation) pairs) give.
+
+        info is the lstat() result of path. Symbolic links have their owner
+        changed unless follow_owner is set and keep their mode unless
+        follow_mode is set, in which case the target is changed.
+        """
+        counts.examined += 1
+        changed = False
+        try:
+            is_link = stat.S_ISLNK(info.st_mode)
+            if any('owner' in operation for index, operation in rules):
+                current = os.stat(path) if is_link and follow_owner else info
+                uid, gid = _desired_owner(rules, current.st_uid, current.st_gid)
+                if (uid, gid) != (current.st_uid, current.st_gid):
+                    if self.dry_run:
+                        counts.planned.append("chown %d:%d %s" % (uid, gid, path))
+                    elif is_link and not follow_owner:
+                        os.lchown(path, uid, gid)
+                    else:
+                        os.chown(path, uid, gid)
+                    changed = True
+                    # chown may clear the set-user-ID and set-group-ID bits
+                    if not self.dry_run and current is info and info.st_mode & (stat.S_ISUID | stat.S_ISGID):
+                        info = os.lstat(path)
+            if any('mode' in operation for index, operation in rules) and (not is_link or follow_mode):
+                current = os.stat(path) if is_link else info
+                mode = _desired_mode(rules, current.st_mode, self.umask)
+                if mode != stat.S_IMODE(current.st_mode):
+                    if self.dry_run:
+                        counts.planned.append("chmod %04o %s" % (mode, path))
+                    else:
+                        os.chmod(path, mode)
+                    changed = True
+        except OSError as err:
+            counts.errors.append(str(err))
+        if changed:
+            counts.changed += 1
+        else:
+            counts.skipped += 1
+
+    def fingerprint(self, directory, directory_rules):
+        """Digest of what applies to a directory content: inherited rules and rules of its entries, in plan order."""
+        own_rules = sorted(self.children_rules.get(directory, []), key=lambda rule: rule[0])
+        key = (self.umask,
+               [_rule_key(rule) for rule in sorted(directory_rules, key=lambda rule: rule[0])],
+               [(os.path.basename(os.path.abspath(rule[1]['path'])), _rule_key(rule)) for rule in own_rules])
+        import hashlib
+        return hashlib.sha1(repr(key).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+    def scan(self, directory, directory_rules):
+        """Apply the rules to the entries of one directory.
+
+        Return the subdirectories to scan next with their rules, the counts,
+        the rule paths met and the manifest records of this scan.
+        """
+        counts = Counts()
+        visited = []
+        records = {}
+        children = []
+        try:
+            info = os.lstat(directory)
+            fingerprint = self.fingerprint(directory, directory_rules)
+            record = self.manifest.get(directory)
+            if record and record[:3] == (info.st_mtime_ns, info.st_ctime_ns, fingerprint):
+                counts.unchanged_directories += 1
+                records[directory] = record
+                # Entries with rules of their own still get the rules inherited here, like a listing would give them
+                for path in sorted(self.children_paths.get(directory, [])):
+                    try:
+                        entry_info = os.lstat(path)
+                    except OSError:
+                        # Reported when its own rules are applied
+                        continue
+                    if stat.S_ISLNK(entry_info.st_mode):
+                        continue
+                    visited.append(path)
+                    self.apply_entry(path, entry_info, sorted(directory_rules + self.rules[path], key=lambda rule: rule[0]),
+                                     counts)
+                for path in record[3]:
+                    own_rules = self.rules.get(path, [])
+                    if own_rules:
+                        visited.append(path)
+                    children.append((path, directory_rules + [rule for rule in own_rules if rule[1].get('recursive')]))
+                return children, counts, visited, records
+            subdirectories = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    own_rules = []
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if entry.path in self.rules and not entry.is_symlink():
+                        # Rules given for this path are applied here, with no second walk
+                        own_rules = self.rules[entry.path]
+                        visited.append(entry.path)
+                    entry_rules = sorted(directory_rules + own_rules, key=lambda rule: rule[0])
+                    if entry_rules:
+                        self.apply_entry(entry.path, entry.stat(follow_symlinks=False), entry_rules, counts)
+                    if is_dir:
+                        child_rules = directory_rules + [rule for rule in own_rules if rule[1].get('recursive')]
+                        if child_rules or entry.path in self.ancestors:
+                            children.append((entry.path, child_rules))
+                            subdirectories.append(entry.path)
+            records[directory] = (info.st_mtime_ns, info.st_ctime_ns, fingerprint, tuple(subdirectories))
+        except OSError as err:
+            counts.errors.append(str(err))
+        return children, counts, visited, records
+
+    def walk(self, root, inherited, counts, visited, pool=None):
+        """Scan everything below root, on the pool threads if there is one."""
+        if pool is None:
+            stack = [(root, inherited)]
+            while stack:
+                children, scan_counts, scan_visited, records = self.scan(*stack.pop())
+                stack.extend(children)
+                counts.merge(scan_counts)
+                visited.update(scan_visited)
+                self.records.update(records)
+            return
+        from concurrent.futures import FIRST_COMPLETED, wait
+        pending = set([pool.submit(self.scan, root, inherited)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                children, scan_counts, scan_visited, records = future.result()
+                pending.update(pool.submit(self.scan, path, rules) for path, rules in children)
+                counts.merge(scan_counts)
+                visited.update(scan_visited)
+                self.records.update(records)
+
+    def run(self):
+        counts = Counts()
+        visited = set()
+        pool = None
+        if self.max_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for path in sorted(self.rules):
+                if path in visited:
+                    continue
+                visited.add(path)
+                path_rules = self.rules[path]
+                try:
+                    info = os.lstat(path)
+                except OSError as err:
+                    counts.errors.append(str(err))
+                    continue
+                is_link = stat.S_ISLNK(info.st_mode)
+                recursive_owner = any('owner' in operation and operation.get('recursive')
+                                      for index, operation in path_rules)
+                # Like chmod, a symbolic link given as path is followed; like chown, only without recursion
+                self.apply_entry(path, info, path_rules, counts, follow_mode=True,
+                                 follow_owner=not recursive_owner)
+                inherited = [(index, operation) for index, operation in path_rules
+                             if operation.get('recursive') and not (is_link and 'owner' in operation)]
+                if inherited and os.path.isdir(path):
+                    self.walk(path, inherited, counts, visited, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return counts
+
+
+def apply_plan(plan, umask, dry_run=False, manifest_path=None, max_workers=1):
+    """Apply a plan, see PlanRun. The manifest is only updated after a pass without errors."""
+    manifest = load_manifest(manifest_path) if manifest_path else {}
+    run = PlanRun(plan, umask, dry_run=dry_run, manifest=manifest, max_workers=max_workers)
+    counts = run.run()
+    if manifest_path and not dry_run and not counts.errors:
+        save_manifest(manifest_path, run.records)
+    return counts.as_dict()
+
+
+def _read_umask():
+    """umask of the process, from /proc where there is one: os.umask() only reads it by changing it."""
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, OSError, ValueError):
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once, at import: while os.umask(0) is in effect, the files other
+# threads create and the modes computed by concurrent runs would get umask 0
+_UMASK = _read_umask()
+
+
+def current_umask():
+    """umask of the process when this module was imported."""
+    return _UMASK
+
+
+def compile_plan(operations):
+    """Validate modes and resolve owner names of operations, once for the whole plan."""
+    plan = []
+    for operation in operations:
+        operation = dict(operation)
+        if 'mode' in operation:
+            parse_mode(operation['mode'])
+        if 'owner' in operation and isinstance(operation['owner'], str):
+            operation['owner'] = parse_owner(operation['owner'])
+        plan.append(operation)
+    return plan
+
+
+def run_plan(operations, sudo=None, dry_run=False, manifest_path=None, max_workers=1, runner=None, umask=None):
+    """Apply operations, through one privileged helper process started by runner when not running as root.
+
+    A dry run changes nothing and runs in-process. umask, the one of the
+    process by default, applies to the modes that don't say who they're for.
+    """
+    plan = compile_plan(operations)
+    umask = current_umask() if umask is None else umask
+    options = {'dry_run': dry_run, 'manifest_path': manifest_path, 'max_workers': max_workers}
+    if os.geteuid() == 0 or dry_run:
+        return apply_plan(plan, umask, **options)
+    # Imported here, the helper runs this file on its own, outside of the package
+    import json
+    from processor_utils import runner as runners
+    runner = runner or runners.Runner()
+    command = list(sudo or ['sudo']) + [sys.executable, os.path.abspath(__file__)]
+    payload = json.dumps({'umask': umask, 'plan': plan, 'options': options})
+    try:
+        output = runner.run(command, input=payload).stdout
+    except runners.CommandError as err:
+        raise PermissionsError(str(err))
+    try:
+        return json.loads(output)
+    except ValueError:
+        raise PermissionsError("Unexpected output from the privileged helper: %s" % output[:200])
+
+
+def main():
+    import json
+    request = json.load(sys.stdin)
+    json.dump(apply_plan(request['plan'], request['umask'], **request.get('options', {})), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""psql driver used by the PostgreSQL processor.
+
+A PsqlSession runs SQL statements either over one long-lived psql process fed
+through stdin ("session" mode), or with one psql process per statement
+("subprocess" mode, the historical behavior kept as a fallback).
+"""
+
+import os
+
+from processor_utils import runner as runners
+
+SESSION_MODE = "session"
+SUBPROCESS_MODE = "subprocess"
+MODES = (SESSION_MODE, SUBPROCESS_MODE)
+
+
+class PsqlError(Exception):
+    pass
+
+
+def conninfo_value(value):
+    """Quote a value for a libpq connection string if needed."""
+    value = str(value)
+    if value and not any(c in value for c in " '\\"):
+        return value
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def build_conninfo(dbname, user=None, password=None, host=None, port=None):
+    """Build a libpq connection string like "dbname=db user=alice host=203.0.113.42"."""
+    keys = [("dbname", dbname), ("user", user), ("host", host), ("port", port)]
+    if user:
+        keys.insert(2, ("password", password))
+    return " ".join("%s=%s" % (key, conninfo_value(value)) for key, value in keys if value)
+
+
+def file_checksum(path, algorithm='sha256', block_size=1024 * 1024):
+    """Hex digest of a file content, read by blocks."""
+    import hashlib
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sql_literal(value):
+    """Quote a value as a SQL string literal."""
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def meta_argument(value):
+    """Quote an argument of a psql backslash command."""
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class PsqlSession(object):
+    """Run statements against one PostgreSQL server.
+
+    The session starts connected to `dbname` and can be moved to another
+    database with connect(). It is opened lazily, can be closed and will
+    reopen itself on next use, so one instance can serve several runs.
+    psql processes are started by runner, which bounds each exchange with
+    them by its timeouts.
+    """
+
+    def __init__(self, base_command, dbname, connection_keys=None, mode=SESSION_MODE, runner=None):
+        if mode not in MODES:
+            raise PsqlError("Unknown psql mode %s, expected one of %s" % (mode, ", ".join(MODES)))
+        self.base_command = list(base_command)
+        self.connection_keys = dict(connection_keys or {})
+        self.initial_dbname = dbname
+        self.dbname = dbname
+        self.mode = mode
+        self.runner = runner or runners.Runner()
+        self.runner.add_secret(self.connection_keys.get('password'))
+        self._process = None
+        self._sentinel = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def conninfo(self, dbname=None):
+        return build_conninfo(dbname or self.dbname, **self.connection_keys)
+
+    def command_line(self, args, dbname=None):
+        return self.base_command + ['-X', '-d', self.conninfo(dbname)] + list(args)
+
+    @property
+    def is_open(self):
+        return self._process is not None and self._process.poll() is None
+
+    def open(self):
+        if self.is_open:
+            return
+        self._sentinel = "__psql_session_%s__" % os.urandom(8).hex()
+        import subprocess
+        command = self.command_line(['-q', '-A', '-t', '-v', 'ON_ERROR_STOP=1'])
+        try:
+            # surrogateescape lets bytes that are not UTF-8 go through unchanged
+            self._process = self.runner.start(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                              encoding='utf-8', errors='surrogateescape')
+        except runners.CommandError as err:
+            raise PsqlError(str(err))
+
+    def close(self):
+        process, self._process = self._process, None
+        self.dbname = self.initial_dbname
+        if process is None:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write("\\q\n")
+                process.stdin.flush()
+        except (IOError, OSError):
+            pass
+        self._release(process)
+
+    def _release(self, process, timed_out=False):
+        """Wait for process and return its record."""
+        for stream in (process.stdin, process.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        return self.runner.finish(process, timed_out)
+
+    def _abandon(self, process, message=None, timed_out=False):
+        """Release a session process that stopped answering and return the error to raise.
+
+        The tail of what psql wrote to stderr, where it reports the statement
+        that failed, is added to message (by default, the exit status).
+        """
+        self._process = None
+        self.dbname = self.initial_dbname
+        record = self._release(process, timed_out)
+        message = message or "psql session ended with status %s" % record['status']
+        detail = record.get('stderr', '').strip()
+        return PsqlError("%s:\n%s" % (message, detail) if detail else message)
+
+    def send(self, text):
+        """Write text to the psql process without waiting for it to be processed."""
+        if self.mode != SESSION_MODE:
+            raise PsqlError("Streaming to psql needs the %s mode" % SESSION_MODE)
+        if self._process is None:
+            self.open()
+        process = self._process
+        try:
+            # A psql that stopped reading blocks the write once the pipe is full
+            with self.runner.guard(process):
+                process.stdin.write(text)
+        except (IOError, OSError):
+            # psql is gone, sync() reports it
+            pass
+        except runners.CommandTimeout as err:
+            raise self._abandon(process, str(err), timed_out=True)
+
+    def sync(self):
+        """Wait for psql to process everything sent so far and return what it printed."""
+        self.send("\\echo %s\n" % self._sentinel)
+        process = self._process
+        lines = []
+        try:
+            with self.runner.guard(process):
+                try:
+                    process.stdin.flush()
+                except (IOError, OSError):
+                    pass
+                while True:
+                    line = process.stdout.readline()
+                    if not line:
+                        break
+                    if line.rstrip('\n') == self._sentinel:
+                        return ''.join(lines)
+                    lines.append(line)
+        except runners.CommandTimeout as err:
+            raise self._abandon(process, str(err), timed_out=True)
+        raise self._abandon(process)
+
+    def _exchange(self, script):
+        """Feed script to the psql process and return what it printed."""
+        self.open()
+        self.send(script + "\n")
+        return self.sync()
+
+    def _run(self, args, dbname=None):
+        # The runner masks the password of the connection string in its errors and records
+        try:
+            return self.runner.run(self.command_line(args, dbname)).stdout
+        except runners.CommandError as err:
+            raise PsqlError(str(err))
+
+    def query(self, command):
+        """Run one statement on the current database and return its unaligned, tuples only output."""
+        if self.mode == SUBPROCESS_MODE:
+            return self._run(['-tAc', command])
+        return self._exchange(command.strip().rstrip(';') + ';')
+
+    def connect(self, dbname):
+        """Move the session to another database of the same server."""
+        if dbname == self.dbname:
+            return
+        if self.mode == SESSION_MODE and self.is_open:
+            self._exchange("\\connect %s" % meta_argument(dbname))
+        self.dbname = dbname
+
+    def execute_file(self, sql_file, dbname=None):
+        """Load sql_file into dbname (the current database by default).
+
+        Like `psql -f`, errors inside the file are reported by psql but do
+        not stop the load.
+        """
+        if dbname:
+            self.connect(dbname)
+        if self.mode == SUBPROCESS_MODE:
+            return self._run(['-f', sql_file])
+        return self._exchange("\\set ON_ERROR_STOP 0\n\\i %s\n\\set ON_ERROR_STOP 1" % meta_argument(sql_file))
+
+    def execute_file_in_transaction(self, sql_file, epilogue=None, dbname=None):
+        """Load sql_file, then run the epilogue statements, in a single transaction.
+
+        The first error stops the load and rolls everything back.
+        """
+        if dbname:
+            self.connect(dbname)
+        if self.mode == SUBPROCESS_MODE:
+            args = ['-v', 'ON_ERROR_STOP=1', '-1', '-f', sql_file]
+            if epilogue:
+                args.extend(['-c', epilogue])
+            return self._run(args)
+        script = "BEGIN;\n\\i %s\n" % meta_argument(sql_file)
+        if epilogue:
+            script += epilogue.strip().rstrip(';') + ";\n"
+        return self._exchange(script + "COMMIT;")
@@ -0,0 +1,426 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Command execution shared by the processors.
+
+A Runner starts argument lists, never shell strings. Every call gets the
+per-call timeout of the runner, cut down to what is left of its overall
+deadline; a command still running when its time is up is sent SIGTERM, that
+sudo relays to the command it runs, then SIGKILL a few seconds later. The
+number of commands running at the same time can be bounded, and each call
+is recorded (command, start, duration, exit status) for the command_log
+output of the processors. Secrets given to the runner are masked in records
+and error messages.
+
+Long lived processes, like a psql session, are started with start(), each
+exchange with them is bounded with guard() and their record is completed by
+finish(), with the tail of what they wrote to stderr.
+
+subprocess and the other modules only needed to run commands are imported
+by the calls that need them, processors importing this module may well run
+nothing.
+"""
+
+import itertools
+import os
+import threading
+import time
+
+MASK = "********"
+# Seconds between SIGTERM and SIGKILL
+KILL_DELAY = 5
+# Characters of stderr kept in records and errors
+STDERR_TAIL = 2000
+
+
+class CommandError(Exception):
+
+    def __init__(self, message, record=None):
+        super(CommandError, self).__init__(message)
+        self.record = record
+
+
+class CommandTimeout(CommandError):
+    pass
+
+
+class _Monitor(object):
+    """One thread stopping the processes whose time is up."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.alarms = {}
+        self.tokens = itertools.count()
+        self.thread = None
+        self.wakes_at = None
+
+    def arm(self, process, timeout):
+        token = next(self.tokens)
+        when = time.monotonic() + timeout
+        with self.condition:
+            self.alarms[token] = {'when': when, 'process': process, 'fired': False}
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="command-monitor")
+                self.thread.daemon = True
+                self.thread.start()
+            # Guards come and go quickly, the thread is only woken up when it would sleep past this one
+            if self.wakes_at is None or when < self.wakes_at:
+                self.condition.notify()
+        return token
+
+    def fired(self, token):
+        with self.condition:
+            return self.alarms[token]['fired']
+
+    def disarm(self, token):
+        """Whether the alarm fired."""
+        with self.condition:
+            return self.alarms.pop(token)['fired']
+
+    def _loop(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for alarm in self.alarms.values():
+                    if alarm['when'] is None or alarm['when'] > now:
+                        continue
+                    try:
+                        if alarm['fired']:
+                            alarm['process'].kill()
+                        else:
+                            alarm['process'].terminate()
+                    except OSError:
+                        pass
+                    alarm['when'] = now + KILL_DELAY if not alarm['fired'] else None
+                    alarm['fired'] = True
+                pending = [alarm['when'] for alarm in self.alarms.values() if alarm['when'] is not None]
+                self.wakes_at = min(pending) if pending else None
+                self.condition.wait(self.wakes_at - now if pending else None)
+
+
+_monitor = _Monitor()
+
+
+class Guard(object):
+    """Context stopping process if the block lasts longer than timeout, see Runner.guard."""
+
+    def __init__(self, process, timeout, message):
+        self.process = process
+        self.timeout = timeout
+        self.message = message
+        self.token = None
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self.token = _monitor.arm(self.process, self.timeout)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.token is not None and _monitor.disarm(self.token):
+            # Replaces the error the stopped process caused
+            raise CommandTimeout(self.message)
+        return False
+
+
+class Result(object):
+    """Outcome of one call: output, record and, for batches, the error met."""
+
+    def __init__(self, record, stdout=None, stderr=None, error=None):
+        self.record = record
+        self.stdout = stdout
+        self.stderr = stderr
+        self.error = error
+
+    @property
+    def status(self):
+        return self.record['status'] if self.record else None
+
+
+class Runner(object):
+
+    def __init__(self, timeout=None, deadline=None, max_concurrent=None, secrets=()):
+        """timeout bounds each call and deadline all of them, both in seconds from now."""
+        self.timeout = timeout
+        self.deadline = time.monotonic() + deadline if deadline is not None else None
+        self.lock = threading.Lock()
+        self.secrets = ()
+        for secret in secrets:
+            self.add_secret(secret)
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.records = []
+        self.running = {}
+
+    def add_secret(self, secret):
+        if not secret:
+            return
+        with self.lock:
+            # Replaced rather than changed, mask() may be going through it; longest first as one may contain another
+            self.secrets = tuple(sorted(set(self.secrets) | set([str(secret)]), key=len, reverse=True))
+
+    def mask(self, text):
+        text = str(text)
+        for secret in self.secrets:
+            text = text.replace(secret, MASK)
+        return text
+
+    def display(self, args):
+        return [self.mask(arg) for arg in args]
+
+    def call_timeout(self, timeout=None):
+        """Seconds a new call may last, None for no limit."""
+        timeout = self.timeout if timeout is None else timeout
+        if self.deadline is not None:
+            left = self.deadline - time.monotonic()
+            if left <= 0:
+                raise CommandTimeout("The deadline for running commands has passed")
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def _check_args(self, args):
+        if isinstance(args, (str, bytes)):
+            raise CommandError("Commands are argument lists, not shell strings: %s" % self.mask(args))
+        args = [str(arg) if not isinstance(arg, (str, bytes)) else arg for arg in args]
+        if not args:
+            raise CommandError("Empty command")
+        return args
+
+    def _record(self, args, started, duration, status, timed_out=False, error=None, stderr=None):
+        record = {
+            'command': self.display(args),
+            'started': started,
+            'duration': round(duration, 6),
+            'status': status,
+            'timed_out': timed_out,
+            'error': self.mask(error) if error else None,
+        }
+        if stderr:
+            record['stderr'] = self.mask(stderr[-STDERR_TAIL:])
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def _spawn(self, args, **kwargs):
+        import subprocess
+        try:
+            return subprocess.Popen(args, **kwargs)
+        except OSError as err:
+            raise CommandError("Unable to start %s: %s" % (self.mask(args[0]), err))
+
+    @staticmethod
+    def _communicate(process, input, timeout):
+        """Output, errors and whether process was stopped for lasting longer than timeout."""
+        import subprocess
+        try:
+            output, errors = process.communicate(input, timeout=timeout)
+            return output, errors, False
+        except subprocess.TimeoutExpired:
+            pass
+        for stop, delay in ((process.terminate, KILL_DELAY), (process.kill, 1)):
+            stop()
+            try:
+                output, errors = process.communicate(timeout=delay)
+                return output, errors, True
+            except subprocess.TimeoutExpired:
+                pass
+        # A child of the process still holds the pipes, they're given up on
+        for stream in (process.stdin, process.stdout, process.stderr):
+            if stream:
+                stream.close()
+        process.wait()
+        return None, b'', True
+
+    @staticmethod
+    def _stream(process, input, consume, timeout):
+        import selectors
+        token = _monitor.arm(process, timeout) if timeout is not None else None
+        try:
+            if input is not None:
+                process.stdin.write(input)
+                process.stdin.close()
+            descriptor = process.stdout.fileno()
+            with selectors.DefaultSelector() as selector:
+                selector.register(descriptor, selectors.EVENT_READ)
+                while True:
+                    if selector.select(0.5):
+                        block = os.read(descriptor, 65536)
+                        if not block:
+                            break
+                        consume(block)
+                    elif token is not None and _monitor.fired(token) and process.poll() is not None:
+                        # A child of the stopped process still holds the pipe
+                        break
+            process.stdout.close()
+            process.wait()
+        finally:
+            fired = _monitor.disarm(token) if token is not None else False
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+        return fired
+
+    def run(self, args, input=None, timeout=None, check=True, env=None, cwd=None, text=True, stdout=None):
+        """Run args to completion and return its Result.
+
+        stdout may be a function called with each block of output (bytes) as
+        it comes, the output isn't kept then; otherwise it's in the result,
+        decoded when text is true. stderr is captured either way.
+        """
+        import subprocess
+        import tempfile
+        args = self._check_args(args)
+        call_timeout = self.call_timeout(timeout)
+        if isinstance(input, str):
+            input = input.encode('utf-8')
+        if self.slots:
+            self.slots.acquire()
+        started = time.time()
+        clock = time.monotonic()
+        status = None
+        output = error = None
+        errors = b''
+        fired = False
+        try:
+            if stdout:
+                with tempfile.TemporaryFile() as stderr:
+                    process = self._spawn(args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE, stderr=stderr, env=env, cwd=cwd)
+                    fired = self._stream(process, input, stdout, call_timeout)
+                    stderr.seek(0)
+                    errors = stderr.read()
+            else:
+                process = self._spawn(args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+                output, errors, fired = self._communicate(process, input, call_timeout)
+            status = process.returncode
+        except CommandError as err:
+            error = str(err)
+            raise
+        finally:
+            if self.slots:
+                self.slots.release()
+            errors = errors.decode('utf-8', 'replace') if errors else ''
+            if fired:
+                error = "%s timed out after %.1f seconds" % (self.mask(args[0]), call_timeout)
+            elif status:
+                error = "%s exited with status %s" % (self.mask(args[0]), status)
+            record = self._record(args, started, time.monotonic() - clock, status, fired, error, errors)
+        if text and output is not None:
+            output = output.decode('utf-8', 'surrogateescape')
+        if fired:
+            raise CommandTimeout(record['error'], record)
+        if status and check:
+            detail = record.get('stderr', '').strip().splitlines()
+            raise CommandError("%s%s" % (record['error'], ": %s" % detail[-1] if detail else ""), record)
+        return Result(record, output, errors)
+
+    def run_batch(self, commands, max_workers=4, **options):
+        """Run commands, argument lists or dicts of run() arguments, at most max_workers at a time.
+
+        Results come in the order of commands, those of failed calls have
+        their error set instead of raising.
+        """
+        def call(command):
+            arguments = dict(options)
+            if isinstance(command, dict):
+                arguments.update(command)
+            else:
+                arguments['args'] = command
+            try:
+                return self.run(**arguments)
+            except CommandError as err:
+                return Result(err.record, error=str(err))
+
+        if max_workers <= 1 or len(commands) <= 1:
+            return [call(command) for command in commands]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(call, commands))
+
+    def start(self, args, **kwargs):
+        """Start a long lived process, see guard() and finish().
+
+        Unless redirected by the caller, stderr goes to a temporary file
+        rather than a pipe nobody reads, finish() records its tail.
+        """
+        args = self._check_args(args)
+        self.call_timeout()
+        stderr = None
+        if 'stderr' not in kwargs:
+            import tempfile
+            stderr = kwargs['stderr'] = tempfile.TemporaryFile()
+        try:
+            process = self._spawn(args, **kwargs)
+        except CommandError:
+            if stderr:
+                stderr.close()
+            raise
+        with self.lock:
+            self.running[process.pid] = (args, time.time(), time.monotonic(), stderr)
+        return process
+
+    def guard(self, process, timeout=None):
+        """Context stopping process if what's done with it lasts longer than a call may."""
+        call_timeout = self.call_timeout(timeout)
+        message = "%s timed out after %.1f seconds" % (self.mask(process.args[0]), call_timeout or 0)
+        return Guard(process, call_timeout, message)
+
+    @staticmethod
+    def _tail(stderr):
+        """Last STDERR_TAIL characters written to the temporary file of start(), which is closed."""
+        try:
+            stderr.seek(0, os.SEEK_END)
+            # Up to 4 bytes per character in UTF-8
+            stderr.seek(max(0, stderr.tell() - STDERR_TAIL * 4))
+            return stderr.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            return ''
+        finally:
+            stderr.close()
+
+    def finish(self, process, timed_out=False):
+        """Wait for a process started by start() and record it."""
+        status = process.wait()
+        with self.lock:
+            args, started, clock, stderr = self.running.pop(
+                process.pid, (process.args, time.time(), time.monotonic(), None))
+        error = None
+        if timed_out:
+            error = "%s timed out" % self.mask(args[0])
+        elif status:
+            error = "%s exited with status %s" % (self.mask(args[0]), status)
+        errors = self._tail(stderr) if stderr else None
+        return self._record(args, started, time.monotonic() - clock, status, timed_out, error, errors)
+
+    def log(self):
+        """Records of the calls made so far, oldest first."""
+        with self.lock:
+            return [dict(record) for record in self.records]
+
+
+def from_settings(settings, secrets=()):
+    """Runner set up from the command_timeout, command_deadline and command_max_concurrent keys of settings."""
+    values = {}
+    for key, convert in (('command_timeout', float), ('command_deadline', float), ('command_max_concurrent', int)):
+        value = settings.get(key)
+        if value in (None, ''):
+            continue
+        try:
+            values[key] = convert(value)
+        except (TypeError, ValueError):
+            raise CommandError("Invalid %s: %s" % (key, value))
+        if values[key] <= 0:
+            raise CommandError("%s must be positive, got %s" % (key, value))
+    return Runner(values.get('command_timeout'), values.get('command_deadline'),
+                  values.get('command_max_concurrent'), secrets)
@@ -0,0 +1,998 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process sed engine used by the Sed processor.
+
+It covers the commonly used part of GNU sed: s///, y///, d, p, a, i, c, =,
+q, Q and { } blocks, with line, $, /regex/, first~step addresses, ranges
+(including 0,/re/, addr,+N and addr,~N) and negation. Regular expressions
+are POSIX basic expressions with the GNU extensions, translated to Python
+ones. Python regular expressions backtrack where POSIX ones take the longest
+match: alternations of literals are ordered to give the same result, other
+alternations are refused. Anything else raises SedError, callers are
+expected to fall back to the sed binary in that case.
+
+Characters are those of the locale sed would run in (LC_ALL, LC_CTYPE,
+LANG). In the C locale a character is a byte, like with `LC_ALL=C sed`. In a
+UTF-8 locale, lines are matched and case converted as decoded text. What
+else depends on the locale, character classes ([[:alpha:]], \\w, \\b...) on
+non-ASCII text, case conversion of non-ASCII bytes, invalid UTF-8 or the
+characters of any other charset, raises LocaleError while the file is
+edited: callers hand that file to the sed binary, which knows the locale.
+
+Compiled scripts are kept in an LRU cache keyed by the command list, and
+edit_file() streams a file through one and replaces it atomically when its
+content changed.
+"""
+
+import os
+import re
+import stat
+
+from functools import lru_cache
+
+# How the locale handles characters: one per byte, UTF-8, or any other charset
+BYTES = 'bytes'
+UTF8 = 'utf-8'
+OTHER = 'other'
+
+# Decoding of lines as one character per byte
+ENCODING = 'latin-1'
+
+# What a script needs from the locale: what a character is, character classes and case conversion
+CHARACTERS = 'characters'
+CLASSES = 'classes'
+CASE = 'case'
+
+# (first, last) character ranges, ASCII only like the C locale
+_POSIX_CLASSES = {
+    'alpha': (('a', 'z'), ('A', 'Z')),
+    'digit': (('0', '9'),),
+    'alnum': (('0', '9'), ('a', 'z'), ('A', 'Z')),
+    'upper': (('A', 'Z'),),
+    'lower': (('a', 'z'),),
+    'space': ((' ', ' '), ('\t', '\r')),
+    'blank': ((' ', ' '), ('\t', '\t')),
+    'punct': (('!', '/'), (':', '@'), ('[', '`'), ('{', '~')),
+    'xdigit': (('0', '9'), ('A', 'F'), ('a', 'f')),
+    'cntrl': (('\x00', '\x1f'), ('\x7f', '\x7f')),
+    'print': ((' ', '~'),),
+    'graph': (('!', '~'),),
+}
+_UPPER = dict((ord(c), c.upper()) for c in 'abcdefghijklmnopqrstuvwxyz')
+_LOWER = dict((ord(c), c.lower()) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_CHAR_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a'}
+_CLASS_ESCAPES = 'wWsSbB<>'
+_REGEX_ESCAPES = {
+    'w': r'\w', 'W': r'\W', 's': r'\s', 'S': r'\S', 'b': r'\b', 'B': r'\B',
+    '<': r'\b(?=\w)', '>': r'\b(?<=\w)', '`': r'\A', "'": r'\Z',
+}
+
+
+class SedError(Exception):
+    pass
+
+
+class LocaleError(SedError):
+    """A line needs the locale to be matched, only the sed binary can edit its file."""
+    pass
+
+
+def locale_charset(environ=None):
+    """BYTES, UTF8 or OTHER, how sed run with environ (os.environ by default) handles characters."""
+    environ = os.environ if environ is None else environ
+    name = environ.get('LC_ALL') or environ.get('LC_CTYPE') or environ.get('LANG') or 'C'
+    if name in ('C', 'POSIX'):
+        return BYTES
+    if re.search(r'utf-?8', name, re.I):
+        return UTF8
+    return OTHER
+
+
+class _CaseTable(dict):
+    """str.translate() table converting the case of any character, one character for one like towupper()."""
+
+    def __init__(self, upper):
+        super(_CaseTable, self).__init__()
+        self.upper = upper
+
+    def __missing__(self, code):
+        char = chr(code)
+        converted = char.upper() if self.upper else char.lower()
+        self[code] = converted if len(converted) == 1 else char
+        return self[code]
+
+
+_UNICODE_UPPER = _CaseTable(True)
+_UNICODE_LOWER = _CaseTable(False)
+
+
+def _class_char(char):
+    """Escape a character for a Python character set."""
+    code = ord(char)
+    if code < 0x100:
+        return '\\x%02x' % code
+    if code < 0x10000:
+        return '\\u%04x' % code
+    return '\\U%08x' % code
+
+
+def _class_range(first, last):
+    if first == last:
+        return _class_char(first)
+    return '%s-%s' % (_class_char(first), _class_char(last))
+
+
+def _translate_bracket(pattern, pos):
+    """Translate the bracket expression starting at pattern[pos] == '['."""
+    pos += 1
+    negate = pattern[pos:pos + 1] == '^'
+    if negate:
+        pos += 1
+    items = []
+    first = True
+    while True:
+        if pos >= len(pattern):
+            raise SedError("unterminated address regex")
+        char = pattern[pos]
+        if char == ']' and not first:
+            pos += 1
+            break
+        first = False
+        if pattern.startswith('[:', pos):
+            end = pattern.find(':]', pos + 2)
+            if end < 0:
+                raise SedError("unterminated character class")
+            name = pattern[pos + 2:end]
+            if name not in _POSIX_CLASSES:
+                raise SedError("unsupported character class %s" % name)
+            items.extend(_class_range(first, last) for first, last in _POSIX_CLASSES[name])
+            pos = end + 2
+            continue
+        if pattern.startswith('[=', pos) or pattern.startswith('[.', pos):
+            raise SedError("unsupported bracket expression")
+        if char == '\\' and pattern[pos + 1:pos + 2] in _CHAR_ESCAPES:
+            char = _CHAR_ESCAPES[pattern[pos + 1]]
+            pos += 1
+        pos += 1
+        if pattern[pos:pos + 1] == '-' and pattern[pos + 1:pos + 2] not in ('', ']'):
+            last = pattern[pos + 1]
+            pos += 2
+            items.append(_class_range(char, last))
+        else:
+            items.append(_class_char(char))
+    return '[%s%s]' % ('^' if negate else '', ''.join(items)), pos
+
+
+def _split_alternatives(pattern):
+    alternatives = []
+    current = []
+    pos = 0
+    while pos < len(pattern):
+        token = pattern[pos:pos + 2] if pattern[pos] == '\\' else pattern[pos]
+        if token == '\\|':
+            alternatives.append(''.join(current))
+            current = []
+        else:
+            current.append(token)
+        pos += len(token)
+    alternatives.append(''.join(current))
+    return alternatives
+
+
+def _literal_length(alternative):
+    """Length of the text matched by a literal alternative, None if it isn't literal."""
+    if alternative.startswith('^'):
+        alternative = alternative[1:]
+    if alternative.endswith('$') and not alternative.endswith('\\$'):
+        alternative = alternative[:-1]
+    length = 0
+    pos = 0
+    while pos < len(alternative):
+        char = alternative[pos]
+        if char == '\\':
+            pos += 1
+            escaped = alternative[pos:pos + 1]
+            if escaped.isalnum() and escaped not in _CHAR_ESCAPES or escaped in '(){}+?<>`\'':
+                return None
+        elif char in '*[.^$':
+            return None
+        length += 1
+        pos += 1
+    return length
+
+
+def regex_features(pattern):
+    """Set of CHARACTERS and CLASSES, what matching pattern depends on besides bytes."""
+    features = set()
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            if pattern[pos + 1:pos + 2] in _CLASS_ESCAPES:
+                features.add(CLASSES)
+            pos += 2
+        elif char == '[':
+            end = _translate_bracket(pattern, pos)[1]
+            features.add(CLASSES if '[:' in pattern[pos + 1:end] else CHARACTERS)
+            pos = end
+        else:
+            if char == '.':
+                features.add(CHARACTERS)
+            pos += 1
+    return features
+
+
+def translate_regex(pattern):
+    """Translate a POSIX basic regular expression (GNU flavour) to a Python one."""
+    if '\\|' in pattern:
+        # POSIX takes the longest of the alternatives matching at a position,
+        # Python the first one: literal alternatives are tried longest first,
+        # other alternations are left to the sed binary.
+        alternatives = _split_alternatives(pattern)
+        lengths = [_literal_length(alternative) for alternative in alternatives]
+        if None in lengths:
+            raise SedError("alternation of non literal expressions is not supported")
+        ordered = sorted(zip(lengths, alternatives), key=lambda item: -item[0])
+        return '|'.join('(?:%s)' % translate_regex(alternative) for length, alternative in ordered)
+    out = []
+    pos = 0
+    length = len(pattern)
+    # True where a following '*' is literal and '^' is an anchor
+    at_start = True
+    while pos < length:
+        char = pattern[pos]
+        starting = False
+        if char == '\\':
+            pos += 1
+            if pos >= length:
+                raise SedError("trailing backslash")
+            char = pattern[pos]
+            if char == '(':
+                out.append('(')
+                starting = True
+            elif char == ')':
+                out.append(')')
+            elif char in '+?':
+                out.append(re.escape(char) if at_start else char)
+            elif char == '{':
+                end = pattern.find('\\}', pos)
+                if end < 0:
+                    raise SedError("unmatched \\{")
+                bounds = pattern[pos + 1:end]
+                if not re.match(r'^\d*(,\d*)?$', bounds) or bounds in ('', ','):
+                    raise SedError("invalid content of \\{\\}")
+                if bounds.startswith(','):
+                    bounds = '0' + bounds
+                out.append('{%s}' % bounds)
+                pos = end + 1
+            elif char in '123456789':
+                out.append('(?:\\%s)' % char)
+            elif char in _CHAR_ESCAPES:
+                out.append(re.escape(_CHAR_ESCAPES[char]))
+            elif char in _REGEX_ESCAPES:
+                out.append(_REGEX_ESCAPES[char])
+            elif char.isalnum():
+                raise SedError("unsupported escape \\%s" % char)
+            else:
+                out.append(re.escape(char))
+            pos += 1
+        elif char == '[':
+            translated, pos = _translate_bracket(pattern, pos)
+            out.append(translated)
+        elif char == '*':
+            out.append('\\*' if at_start else '*')
+            pos += 1
+        elif char == '^':
+            if at_start:
+                out.append('^')
+                starting = True
+            else:
+                out.append('\\^')
+            pos += 1
+        elif char == '$':
+            rest = pattern[pos + 1:]
+            if not rest or rest.startswith('\\)') or rest.startswith('\\|'):
+                out.append('\\Z')
+            else:
+                out.append('\\$')
+            pos += 1
+        elif char == '.':
+            out.append('.')
+            pos += 1
+        else:
+            out.append(re.escape(char))
+            pos += 1
+        at_start = starting
+    return ''.join(out)
+
+
+@lru_cache(maxsize=256)
+def compile_regex(pattern, flags='', text=False):
+    # Classes are only used on ASCII lines of text, where the flag makes no difference
+    options = re.DOTALL if text else re.DOTALL | re.ASCII
+    if 'I' in flags:
+        options |= re.IGNORECASE
+    try:
+        return re.compile(translate_regex(pattern), options)
+    except re.error as err:
+        raise SedError("invalid regex %s: %s" % (pattern, err))
+
+
+class Replacement(object):
+    """Replacement part of a s command: literals, group references and case conversions."""
+
+    def __init__(self, text, charset=BYTES):
+        self.upper, self.lower = (_UNICODE_UPPER, _UNICODE_LOWER) if charset == UTF8 else (_UPPER, _LOWER)
+        self.parts = []
+        literal = []
+        pos = 0
+        while pos < len(text):
+            char = text[pos]
+            if char == '&':
+                self._flush(literal)
+                self.parts.append(('group', 0))
+            elif char == '\\' and pos + 1 < len(text):
+                pos += 1
+                char = text[pos]
+                if char.isdigit():
+                    self._flush(literal)
+                    self.parts.append(('group', int(char)))
+                elif char in 'LUluE':
+                    self._flush(literal)
+                    self.parts.append(('case', char))
+                elif char in _CHAR_ESCAPES:
+                    literal.append(_CHAR_ESCAPES[char])
+                else:
+                    literal.append(char)
+            else:
+                literal.append(char)
+            pos += 1
+        self._flush(literal)
+        self.has_case = any(kind == 'case' for kind, value in self.parts)
+        self.literal = None
+        if all(kind == 'literal' for kind, value in self.parts):
+            self.literal = ''.join(value for kind, value in self.parts)
+
+    def _flush(self, literal):
+        if literal:
+            self.parts.append(('literal', ''.join(literal)))
+            del literal[:]
+
+    def expand(self, match):
+        if self.literal is not None:
+            return self.literal
+        if not self.has_case:
+            return ''.join([value if kind == 'literal' else match.group(value) or '' for kind, value in self.parts])
+        out = []
+        persistent = None
+        one_shot = None
+        for kind, value in self.parts:
+            if kind == 'case':
+                if value in 'lu':
+                    one_shot = value
+                else:
+                    persistent = None if value == 'E' else value
+                    one_shot = None
+                continue
+            text = value if kind == 'literal' else (match.group(value) or '')
+            if persistent == 'U':
+                text = text.translate(self.upper)
+            elif persistent == 'L':
+                text = text.translate(self.lower)
+            if one_shot and text:
+                text = text[0].translate(self.upper if one_shot == 'u' else self.lower) + text[1:]
+                one_shot = None
+            out.append(text)
+        return ''.join(out)
+
+
+class Address(object):
+    LINE, LAST, REGEX, STEP, PLUS, MULTIPLE, ZERO = range(7)
+
+    def __init__(self, kind, value=None, step=None):
+        self.kind = kind
+        self.value = value
+        self.step = step
+
+    def matches(self, context):
+        kind = self.kind
+        if kind == self.LINE:
+            return context.line_number == self.value
+        if kind == self.LAST:
+            return context.is_last
+        if kind == self.REGEX:
+            return context.search(self.value, context.pattern_space) is not None
+        if kind == self.STEP:
+            if self.step <= 0:
+                return context.line_number == self.value
+            return context.line_number >= self.value and (context.line_number - self.value) % self.step == 0
+        return False
+
+
+class Command(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.address1 = None
+        self.address2 = None
+        self.negate = False
+        self.jump = None
+        self.text = None
+        self.regex = None
+        self.replacement = None
+        self.global_replace = False
+        self.occurrence = 1
+        self.print_result = False
+        self.table = None
+
+    def selected(self, context):
+        if self.address1 is None:
+            return True
+        if self.address2 is None:
+            return self.address1.matches(context) != self.negate
+        return self._range_selected(context) != self.negate
+
+    def _range_selected(self, context):
+        # Active ranges live in the run context, compiled programs are shared
+        ranges = context.ranges
+        line_number = context.line_number
+        end = self.address2
+        if self not in ranges:
+            if self.address1.kind == Address.ZERO:
+                # 0,/re/ is active from the start, its end regex can match the first line
+                if line_number != 1:
+                    return False
+                if not end.matches(context):
+                    ranges[self] = None
+                return True
+            if not self.address1.matches(context):
+                return False
+            if end.kind == Address.LINE:
+                if end.value > line_number:
+                    ranges[self] = end.value
+            elif end.kind == Address.PLUS:
+                if end.value > 0:
+                    ranges[self] = line_number + end.value
+            elif end.kind == Address.MULTIPLE:
+                if end.value > 0 and line_number % end.value:
+                    ranges[self] = (line_number // end.value + 1) * end.value
+            elif end.kind == Address.LAST:
+                if not context.is_last:
+                    ranges[self] = None
+            else:
+                ranges[self] = None
+            return True
+        if end.kind == Address.REGEX or end.kind == Address.LAST:
+            if end.matches(context):
+                del ranges[self]
+        elif line_number >= ranges[self]:
+            del ranges[self]
+        return True
+
+
+class _Parser(object):
+
+    def __init__(self, script, charset=BYTES):
+        self.script = script
+        self.charset = charset
+        self.pos = 0
+        self.features = set()
+
+    def peek(self):
+        return self.script[self.pos:self.pos + 1]
+
+    def next(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def skip_blanks(self):
+        while self.peek() in (' ', '\t'):
+            self.pos += 1
+
+    def skip_separators(self):
+        while self.peek() in (' ', '\t', '\n', ';'):
+            self.pos += 1
+
+    def number(self):
+        start = self.pos
+        while self.peek().isdigit():
+            self.pos += 1
+        if start == self.pos:
+            raise SedError("expected a number at char %d" % (start + 1))
+        return int(self.script[start:self.pos])
+
+    def delimited(self, delimiter, regex):
+        """Read up to the next unescaped delimiter, removing the backslash of escaped delimiters."""
+        out = []
+        in_bracket = False
+        while True:
+            char = self.next()
+            if not char:
+                raise SedError("unterminated command")
+            if char == '\\':
+                escaped = self.next()
+                if not escaped:
+                    raise SedError("unterminated command")
+                if escaped == delimiter:
+                    out.append(escaped)
+                elif escaped == '\n':
+                    out.append('\\n' if regex else '\\\n')
+                else:
+                    out.append('\\' + escaped)
+                continue
+            if regex and char == '[' and not in_bracket:
+                in_bracket = True
+                out.append(char)
+                if self.peek() == '^':
+                    out.append(self.next())
+                if self.peek() == ']':
+                    out.append(self.next())
+                continue
+            if in_bracket:
+                if char == '[' and self.peek() in (':', '.', '='):
+                    kind = self.next()
+                    end = self.script.find(kind + ']', self.pos)
+                    if end < 0:
+                        raise SedError("unterminated character class")
+                    out.append('[' + kind + self.script[self.pos:end + 2])
+                    self.pos = end + 2
+                    continue
+                if char == ']':
+                    in_bracket = False
+                out.append(char)
+                continue
+            if char == delimiter:
+                return ''.join(out)
+            if char == '\n' and regex:
+                raise SedError("unterminated address regex")
+            out.append(char)
+
+    def regex_address(self, delimiter):
+        pattern = self.delimited(delimiter, True)
+        flags = ''
+        while self.peek() in ('I', 'M'):
+            flag = self.next()
+            if flag == 'M':
+                raise SedError("M modifier is not supported")
+            flags += flag
+        return Address(Address.REGEX, (pattern, flags))
+
+    def address(self):
+        char = self.peek()
+        if char.isdigit():
+            value = self.number()
+            if self.peek() == '~':
+                self.pos += 1
+                return Address(Address.STEP, value, self.number())
+            return Address(Address.LINE, value)
+        if char == '$':
+            self.pos += 1
+            return Address(Address.LAST)
+        if char == '/':
+            self.pos += 1
+            return self.regex_address('/')
+        if char == '\\':
+            self.pos += 1
+            return self.regex_address(self.next())
+        return None
+
+    def text_argument(self):
+        """Text of a, i and c, with GNU one-liner and backslash-newline forms."""
+        self.skip_blanks()
+        if self.peek() == '\\':
+            self.pos += 1
+            if self.peek() == '\n':
+                self.pos += 1
+        out = []
+        while True:
+            char = self.next()
+            if not char or char == '\n':
+                break
+            if char == '\\':
+                escaped = self.next()
+                if escaped == '\n':
+                    out.append('\n')
+                elif escaped:
+                    out.append(_CHAR_ESCAPES.get(escaped, escaped) if escaped != 'n' else '\n')
+                continue
+            out.append(char)
+        if not out:
+            raise SedError("expected \\ after a, c or i")
+        return ''.join(out) + '\n'
+
+    def end_of_command(self):
+        self.skip_blanks()
+        char = self.peek()
+        if char in ('', '\n', ';'):
+            self.pos += len(char)
+        elif char == '#' or char == '}':
+            pass
+        else:
+            raise SedError("extra characters after command at char %d" % (self.pos + 1))
+
+    def parse(self):
+        commands = []
+        blocks = []
+        while True:
+            self.skip_separators()
+            if not self.peek():
+                break
+            if self.peek() == '#':
+                end = self.script.find('\n', self.pos)
+                self.pos = len(self.script) if end < 0 else end
+                continue
+            address1 = self.address()
+            address2 = None
+            if address1 is not None and self.peek() == ',':
+                self.pos += 1
+                self.skip_blanks()
+                char = self.peek()
+                if char == '+' or char == '~':
+                    self.pos += 1
+                    address2 = Address(Address.PLUS if char == '+' else Address.MULTIPLE, self.number())
+                else:
+                    address2 = self.address()
+                if address2 is None:
+                    raise SedError("unexpected `,'")
+                if address2.kind == Address.STEP:
+                    address2 = Address(Address.LINE, address2.value)
+            if address1 is not None and address1.kind == Address.LINE and address1.value == 0:
+                if address2 is None or address2.kind != Address.REGEX:
+                    raise SedError("invalid usage of line address 0")
+                address1 = Address(Address.ZERO)
+            self.skip_blanks()
+            negate = False
+            while self.peek() == '!':
+                negate = True
+                self.pos += 1
+                self.skip_blanks()
+            name = self.next()
+            if not name:
+                raise SedError("missing command")
+            command = Command(name)
+            command.address1 = address1
+            command.address2 = address2
+            command.negate = negate
+            if name == '{':
+                blocks.append(len(commands))
+                commands.append(command)
+                continue
+            if name == '}':
+                if address1 is not None or negate:
+                    raise SedError("} doesn't want any addresses")
+                if not blocks:
+                    raise SedError("unexpected `}'")
+                commands[blocks.pop()].jump = len(commands) + 1
+                commands.append(command)
+                self.end_of_command()
+                continue
+            if name in ('a', 'i', 'c'):
+                command.text = self.text_argument()
+            elif name == 's':
+                delimiter = self.next()
+                if delimiter in ('', '\n', '\\'):
+                    raise SedError("unterminated `s' command")
+                pattern = self.delimited(delimiter, True)
+                replacement = self.delimited(delimiter, False)
+                flags = ''
+                while True:
+                    char = self.peek()
+                    if char == 'g':
+                        command.global_replace = True
+                    elif char == 'p':
+                        command.print_result = True
+                    elif char in ('i', 'I'):
+                        flags = 'I'
+                    elif char.isdigit():
+                        command.occurrence = self.number()
+                        if command.occurrence == 0:
+                            raise SedError("number option to `s' command may not be zero")
+                        continue
+                    elif char in ('m', 'M', 'e', 'w'):
+                        raise SedError("s///%s is not supported" % char)
+                    else:
+                        break
+                    self.pos += 1
+                command.regex = (pattern, flags)
+                command.replacement = Replacement(replacement, self.charset)
+                if command.replacement.has_case:
+                    self.features.add(CASE)
+                self.end_of_command()
+            elif name == 'y':
+                delimiter = self.next()
+                source = self._y_text(self.delimited(delimiter, False))
+                target = self._y_text(self.delimited(delimiter, False))
+                if len(source) != len(target):
+                    raise SedError("strings for `y' command are different lengths")
+                command.table = dict((ord(a), b) for a, b in zip(source, target))
+                if any(ord(char) > 0x7f for char in source):
+                    self.features.add(CHARACTERS)
+                self.end_of_command()
+            elif name in ('d', 'p', '=', 'q', 'Q'):
+                if name in ('q', 'Q'):
+                    self.skip_blanks()
+                    if self.peek().isdigit():
+                        raise SedError("exit code of q is not supported")
+                self.end_of_command()
+            else:
+                raise SedError("command %s is not supported" % name)
+            commands.append(command)
+        if blocks:
+            raise SedError("unmatched `{'")
+        for command in commands:
+            if command.address1 is not None and command.address1.kind == Address.REGEX:
+                command.address1.value = self._regex(command.address1.value)
+            if command.address2 is not None and command.address2.kind == Address.REGEX:
+                command.address2.value = self._regex(command.address2.value)
+            if command.regex is not None:
+                command.regex = self._regex(command.regex)
+        return commands
+
+    def _regex(self, value):
+        pattern, flags = value
+        # An empty regex stands for the last regex used at run time
+        if not pattern:
+            return None
+        self.features |= regex_features(pattern)
+        if 'I' in flags:
+            self.features.add(CASE)
+        return compile_regex(pattern, flags, self.charset == UTF8)
+
+    @staticmethod
+    def _y_text(text):
+        out = []
+        pos = 0
+        while pos < len(text):
+            char = text[pos]
+            if char == '\\' and pos + 1 < len(text):
+                pos += 1
+                char = _CHAR_ESCAPES.get(text[pos], text[pos]) if text[pos] != '\\' else '\\'
+            out.append(char)
+            pos += 1
+        return out
+
+
+class _Context(object):
+
+    def __init__(self):
+        self.line_number = 0
+        self.is_last = False
+        self.pattern_space = ''
+        self.last_regex = None
+        self.ranges = {}
+
+    def search(self, regex, text, pos=0):
+        if regex is None:
+            regex = self.last_regex
+            if regex is None:
+                raise SedError("no previous regular expression")
+        self.last_regex = regex
+        return regex.search(text, pos)
+
+
+class Program(object):
+    """A compiled sed script, for the characters of charset."""
+
+    def __init__(self, script, charset=BYTES):
+        self.script = script
+        self.charset = charset
+        self.quiet = script.startswith('#n\n') or script == '#n'
+        parser = _Parser(script, charset)
+        self.commands = parser.parse()
+        self.features = frozenset(parser.features)
+
+    def decode(self, line):
+        """Text of a line, raise LocaleError when matching it needs the locale."""
+        if not self.features or line.isascii() or (self.charset == BYTES and CASE not in self.features):
+            return line.decode(ENCODING if self.charset != UTF8 else 'utf-8', 'surrogateescape')
+        if self.charset == BYTES:
+            # sed has its own idea of the case of bytes over 127
+            raise LocaleError("case conversion of non-ASCII bytes")
+        if self.charset == OTHER:
+            raise LocaleError("non-ASCII text in a locale of another charset than UTF-8")
+        if CLASSES in self.features:
+            raise LocaleError("character classes on non-ASCII text")
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise LocaleError("invalid UTF-8 text")
+
+    def encode(self, text):
+        return text.encode(ENCODING if self.charset != UTF8 else 'utf-8', 'surrogateescape')
+
+    def substitute(self, command, context):
+        text = context.pattern_space
+        match = context.search(command.regex, text)
+        if match is None:
+            return False
+        replacement = command.replacement
+        if command.occurrence == 1 and not command.global_replace:
+            context.pattern_space = text[:match.start()] + replacement.expand(match) + text[match.end():]
+            return True
+        occurrence = command.occurrence
+        global_replace = command.global_replace
+        expand = replacement.expand
+        # sed moves on by one byte after an empty match, in the middle of multibyte characters
+        multibyte = self.charset == UTF8 and not text.isascii()
+        # previous match end, matches counted
+        state = [-1, 0]
+
+        def replace(match):
+            start, end = match.span()
+            if start == end and multibyte:
+                raise LocaleError("empty matches on non-ASCII text")
+            if start == end and start == state[0]:
+                # GNU sed skips an empty match right after the previous match
+                return ''
+            state[0] = end
+            state[1] += 1
+            if state[1] < occurrence or (state[1] > occurrence and not global_replace):
+                return match.group()
+            return expand(match)
+
+        result = context.last_regex.sub(replace, text)
+        if state[1] < occurrence:
+            return False
+        context.pattern_space = result
+        return True
+
+    def run(self, source, write):
+        """Run the script over the lines of a binary file object, writing bytes with write()."""
+        commands = self.commands
+        command_count = len(commands)
+        decode = self.decode
+        encode = self.encode
+        context = _Context()
+        missing_newline = False
+        lines = iter(source)
+        next_line = next(lines, None)
+        while next_line is not None:
+            line = next_line
+            next_line = next(lines, None)
+            context.line_number += 1
+            context.is_last = next_line is None
+            chomped = line.endswith(b'\n')
+            context.pattern_space = decode(line[:-1] if chomped else line)
+            appended = []
+            output = []
+            deleted = False
+            quit_now = None
+            index = 0
+            while index < command_count:
+                command = commands[index]
+                if not command.selected(context):
+                    index = command.jump if command.name == '{' else index + 1
+                    continue
+                index += 1
+                name = command.name
+                if name == 's':
+                    if self.substitute(command, context) and command.print_result:
+                        output.append((context.pattern_space, chomped))
+                elif name == 'p':
+                    output.append((context.pattern_space, chomped))
+                elif name == 'd':
+                    deleted = True
+                    break
+                elif name == 'a':
+                    appended.append(command.text)
+                elif name == 'i':
+                    output.append((command.text, None))
+                elif name == 'c':
+                    if command.address2 is None or command not in context.ranges or command.negate:
+                        output.append((command.text, None))
+                    deleted = True
+                    break
+                elif name == 'y':
+                    context.pattern_space = context.pattern_space.translate(command.table)
+                elif name == '=':
+                    output.append(('%d\n' % context.line_number, None))
+                elif name == 'q' or name == 'Q':
+                    quit_now = name
+                    break
+            if not deleted and not self.quiet and quit_now != 'Q':
+                output.append((context.pattern_space, chomped))
+            if quit_now != 'Q':
+                output.extend((text, None) for text in appended)
+            for text, newline in output:
+                if missing_newline:
+                    write(b'\n')
+                write(encode(text))
+                if newline:
+                    write(b'\n')
+                missing_newline = newline is False
+            if quit_now:
+                break
+
+
+@lru_cache(maxsize=64)
+def compile_script(commands, charset=BYTES):
+    """Compile a tuple of sed commands (lines of a sed script) for charset, cached."""
+    script = '\n'.join(commands)
+    if charset != UTF8:
+        # Lines are then matched one character per byte, the script gets the same form
+        script = script.encode('utf-8', 'surrogateescape').decode(ENCODING)
+    return Program(script, charset)
+
+
+def load_program(commands, charset=None):
+    """Compiled Program for a list of commands, or None with the reason when unsupported.
+
+    charset defaults to the one of the locale of the process, see locale_charset().
+    """
+    try:
+        return compile_script(tuple(commands), charset or locale_charset()), None
+    except SedError as err:
+        return None, str(err)
+
+
+def _hashed_lines(handle, digest):
+    for line in handle:
+        digest.update(line)
+        yield line
+
+
+def replace_file(path, produce, backup=None):
+    """Rewrite path with the output of produce(source, write), unless it is unchanged.
+
+    source yields the lines of path and write() takes bytes. The output goes
+    to a temporary file next to path, given the mode and owner of the
+    original, then renamed over it, so an interrupted edit leaves path as it
+    was. When the content differs, backup(path, digest) is called with the
+    original still in place just before the rename. Return the sha256 hex
+    digests of the content before and after; path is left untouched, mtime
+    included, when they are equal.
+    """
+    import hashlib
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(path))
+    info = os.stat(path)
+    handle, temporary_path = tempfile.mkstemp(prefix='.%s.' % name, suffix='.sed', dir=directory)
+    try:
+        source_digest = hashlib.sha256()
+        target_digest = hashlib.sha256()
+        with os.fdopen(handle, 'wb') as target, open(path, 'rb') as source:
+            def write(data):
+                target_digest.update(data)
+                target.write(data)
+            lines = _hashed_lines(source, source_digest)
+            produce(lines, write)
+            # q stops reading early, the digest covers the whole original
+            for line in lines:
+                pass
+        before, after = source_digest.hexdigest(), target_digest.hexdigest()
+        if before == after:
+            os.remove(temporary_path)
+            return before, after
+        os.chmod(temporary_path, stat.S_IMODE(info.st_mode))
+        if (info.st_uid, info.st_gid) != (os.getuid(), os.getgid()):
+            try:
+                os.chown(temporary_path, info.st_uid, info.st_gid)
+            except OSError:
+                pass
+        if backup is not None:
+            backup(path, before)
+        os.rename(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return before, after
+
+
+def edit_file(program, path, backup=None):
+    """Run program over path line by line, see replace_file()."""
+    return replace_file(path, program.run, backup)
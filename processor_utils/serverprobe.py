@@ -0,0 +1,154 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cached probe of the OS X and OS X Server versions used by OSXServerOnly.
+
+The probe reads SystemVersion.plist and Server.app's Info.plist under a root
+folder, "/" on a real system and a fake tree in tests. Its result is kept in
+memory and in an optional JSON file, along with the inode and mtime of each
+path it looked at; it is computed again only once one of them changed.
+"""
+
+import os
+import threading
+
+SYSTEM_VERSION_PLIST = "System/Library/CoreServices/SystemVersion.plist"
+SERVER_APP_INFO_PLIST = "Applications/Server.app/Contents/Info.plist"
+SERVER_LIBRARY_FOLDER = "Library/Server"
+SNOW_SERVER_SERVERADMIN = "usr/sbin/serveradmin"
+
+CACHE_VERSION = 1
+
+_lock = threading.Lock()
+_memory = {}
+
+
+class ProbeError(Exception):
+    pass
+
+
+def probe_paths(root="/", system_version_plist=None):
+    """Paths looked at by a probe, as a {name: path} dict."""
+    return {
+        'system_version_plist': system_version_plist or os.path.join(root, SYSTEM_VERSION_PLIST),
+        'server_app_info_plist': os.path.join(root, SERVER_APP_INFO_PLIST),
+        'server_library_folder': os.path.join(root, SERVER_LIBRARY_FOLDER),
+        'serveradmin': os.path.join(root, SNOW_SERVER_SERVERADMIN),
+    }
+
+
+def path_key(path):
+    """[inode, mtime in ns] of path, None if it doesn't exist."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_ino, info.st_mtime_ns]
+
+
+def read_plist(path):
+    import plistlib
+    try:
+        with open(path, 'rb') as handle:
+            return plistlib.load(handle)
+    except (IOError, OSError, ValueError, plistlib.InvalidFileException) as err:
+        raise ProbeError("Unable to read %s: %s" % (path, err))
+
+
+def probe_system(paths, use_platform=False):
+    """Facts about the system found at paths, see probe()."""
+    system_version_plist = paths['system_version_plist']
+    if os.path.exists(system_version_plist):
+        system_version = read_plist(system_version_plist).get('ProductVersion', '')
+    elif use_platform:
+        import platform
+        system_version = platform.mac_ver()[0]
+    else:
+        raise ProbeError("No system version at %s" % system_version_plist)
+    has_server_app = (os.path.exists(paths['server_app_info_plist'])
+                      and os.path.exists(paths['server_library_folder']))
+    server_version = None
+    if has_server_app:
+        server_version = read_plist(paths['server_app_info_plist']).get('CFBundleShortVersionString')
+    return {
+        'system_version': system_version,
+        'server_version': server_version,
+        'has_server_app': has_server_app,
+        'has_serveradmin': os.path.exists(paths['serveradmin']),
+    }
+
+
+def _load_cache(cache_path):
+    import json
+    try:
+        with open(cache_path) as handle:
+            cache = json.load(handle)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache.get('entries', {})
+
+
+def _save_cache(cache_path, cache_key, entry):
+    entries = _load_cache(cache_path)
+    entries[cache_key] = entry
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary_path = "%s.%d.%d.tmp" % (cache_path, os.getpid(), threading.get_ident())
+    import json
+    with open(temporary_path, 'w') as handle:
+        json.dump({'version': CACHE_VERSION, 'entries': entries}, handle)
+    os.rename(temporary_path, cache_path)
+
+
+def probe(root="/", system_version_plist=None, cache_path=None):
+    """Facts about the OS X system under root, computed again only when the probed paths changed.
+
+    Returns a dict with system_version (like "10.9.3"), server_version
+    (Server.app's version or None), has_server_app (Info.plist and
+    /Library/Server are both here) and has_serveradmin (Snow Leopard Server).
+    With no SystemVersion.plist, "/" falls back to platform.mac_ver() and
+    other roots raise a ProbeError.
+    """
+    root = os.path.abspath(root)
+    paths = probe_paths(root, system_version_plist)
+    cache_key = "%s|%s" % (root, paths['system_version_plist'])
+    key = dict((name, path_key(path)) for name, path in paths.items())
+    with _lock:
+        entry = _memory.get(cache_key)
+        if entry is None and cache_path:
+            entry = _load_cache(cache_path).get(cache_key)
+            if entry is not None:
+                _memory[cache_key] = entry
+        if entry is not None and entry.get('key') == key:
+            return dict(entry['facts'])
+        facts = probe_system(paths, use_platform=(root == os.path.abspath(os.sep)))
+        entry = {'key': key, 'facts': facts}
+        _memory[cache_key] = entry
+        if cache_path:
+            try:
+                _save_cache(cache_path, cache_key, entry)
+            except (IOError, OSError):
+                # The cache is an optimization, the probe result stands
+                pass
+    return dict(facts)
+
+
+def forget():
+    """Drop the in-memory cache."""
+    with _lock:
+        _memory.clear()
@@ -0,0 +1,391 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming loader for large SQL files.
+
+The file is read line by line and split into statements, which are sent to a
+psql session in transactions of a fixed number of statements. COPY ... FROM
+STDIN blocks are passed through as they are read. After each committed batch
+a checkpoint records the file offset, so a failed load can resume from there.
+Transactions of the file itself and statements that can't run in a transaction
+block (VACUUM, CREATE DATABASE, CREATE INDEX CONCURRENTLY...) are sent outside
+of the batches.
+"""
+
+import json
+import os
+import re
+import time
+
+from processor_utils import psql
+
+STATEMENT = "statement"
+COPY = "copy"
+COPY_DATA = "copy_data"
+COPY_END = "copy_end"
+META = "meta"
+
+# Statements that control transactions themselves, named after the groups of _TRANSACTION_CONTROL
+TRANSACTION_BEGIN = "begin"
+TRANSACTION_END = "end"
+NO_TRANSACTION = "no_transaction"
+
+_COPY_FROM_STDIN = re.compile(br"^COPY\b.*\bFROM\s+STDIN\b", re.I | re.S)
+_LEADING_NOISE = re.compile(br"^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/)*", re.S)
+_SESSION_SET = re.compile(br"^SET\s+(?:SESSION\s+)?(?!LOCAL\b)([\w.]+)", re.I)
+_SET_CONFIG = re.compile(br"^SELECT\s+(?:pg_catalog\.)?set_config\(\s*'([\w.]+)'.*,\s*false\s*\)", re.I | re.S)
+# Rules out most statements at their first letter, before the comments are skipped
+_NOT_TRANSACTION_CONTROL = re.compile(br"\s*[^\sABCDEPRSV/-]", re.I)
+_TRANSACTION_CONTROL = re.compile(
+    br"^(?:(?P<no_transaction>VACUUM\b|(?:CREATE|DROP)\s+(?:DATABASE|TABLESPACE)\b|ALTER\s+SYSTEM\b"
+    br"|CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\b|DROP\s+INDEX\s+CONCURRENTLY\b"
+    br"|REINDEX\b(?:.*\bCONCURRENTLY\b|\s+(?:\([^)]*\)\s*)?(?:DATABASE|SYSTEM)\b)|(?:COMMIT|ROLLBACK)\s+PREPARED\b)"
+    br"|(?P<begin>BEGIN\b|START\s+TRANSACTION\b)"
+    br"|(?P<end>(?:COMMIT|ROLLBACK|ABORT)\b(?!\s+(?:(?:WORK|TRANSACTION)\s+)?TO\b)|END\b|PREPARE\s+TRANSACTION\b))",
+    re.I | re.S)
+_DOLLAR_TAG = re.compile(br"\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$")
+_NORMAL_SPECIAL = re.compile(br"[;'\"$/-]")
+_COMMENT_SPECIAL = re.compile(br"/\*|\*/")
+
+
+class LoadError(Exception):
+    pass
+
+
+class Item(object):
+    __slots__ = ('kind', 'text', 'end', 'rows')
+
+    def __init__(self, kind, text, end, rows=0):
+        self.kind = kind
+        self.text = text
+        self.end = end
+        self.rows = rows
+
+
+def strip_leading_noise(text):
+    return text[_LEADING_NOISE.match(text).end():]
+
+
+def session_setting(text):
+    """Name of the session setting changed by a statement, None for other statements."""
+    text = strip_leading_noise(text)
+    match = _SESSION_SET.match(text) or _SET_CONFIG.match(text)
+    if match:
+        return match.group(1).lower().decode('ascii')
+    return None
+
+
+def transaction_control(text):
+    """TRANSACTION_BEGIN, TRANSACTION_END or NO_TRANSACTION for a statement that can't go in a batch, None otherwise."""
+    if _NOT_TRANSACTION_CONTROL.match(text):
+        return None
+    match = _TRANSACTION_CONTROL.match(strip_leading_noise(text))
+    return match.lastgroup if match else None
+
+
+class StatementReader(object):
+    """Split a binary file object into statements, COPY data lines and psql meta-commands.
+
+    Quotes, quoted identifiers, dollar quoting and comments are tracked across
+    lines, so only a semicolon outside of them ends a statement. Offsets are
+    byte offsets in the file, all scanned delimiters being ASCII they are not
+    affected by the encoding of the data.
+    """
+
+    PLAIN, QUOTE, ESCAPE_QUOTE, IDENTIFIER, DOLLAR, COMMENT = range(6)
+
+    def __init__(self, handle, offset=0):
+        self.handle = handle
+        self.offset = offset
+
+    def __iter__(self):
+        buf = []
+        state = self.PLAIN
+        dollar_tag = None
+        comment_depth = 0
+        in_copy = False
+        offset = self.offset
+        for line in self.handle:
+            offset += len(line)
+            if in_copy:
+                if line.rstrip(b"\r\n") == b"\\.":
+                    in_copy = False
+                    yield Item(COPY_END, line, offset)
+                else:
+                    yield Item(COPY_DATA, line, offset, 1)
+                continue
+            if line.startswith(b"\\") and state == self.PLAIN and not strip_leading_noise(b"".join(buf)):
+                buf = []
+                yield Item(META, line, offset)
+                continue
+            pos = 0
+            while True:
+                if state == self.PLAIN:
+                    match = _NORMAL_SPECIAL.search(line, pos)
+                    if not match:
+                        break
+                    pos = match.start()
+                    char = match.group()
+                    if char == b";":
+                        buf.append(line[:pos + 1])
+                        text = b"".join(buf)
+                        buf = []
+                        line = line[pos + 1:]
+                        pos = 0
+                        if _COPY_FROM_STDIN.match(strip_leading_noise(text)):
+                            # The data starts on the next line
+                            yield Item(COPY, text + line, offset)
+                            in_copy = True
+                            line = b""
+                            break
+                        yield Item(STATEMENT, text, offset - len(line))
+                    elif char == b"'":
+                        before = line[max(pos - 2, 0):pos]
+                        if before[-1:] in (b"E", b"e") and not (len(before) == 2 and (before[:1].isalnum() or before[:1] == b"_")):
+                            state = self.ESCAPE_QUOTE
+                        else:
+                            state = self.QUOTE
+                        pos += 1
+                    elif char == b'"':
+                        state = self.IDENTIFIER
+                        pos += 1
+                    elif char == b"$":
+                        tag = _DOLLAR_TAG.match(line, pos)
+                        previous = line[pos - 1:pos] if pos else b""
+                        if tag and not (previous.isalnum() or previous == b"_"):
+                            state = self.DOLLAR
+                            dollar_tag = tag.group()
+                            pos = tag.end()
+                        else:
+                            pos += 1
+                    elif char == b"-":
+                        if line[pos + 1:pos + 2] == b"-":
+                            break
+                        pos += 1
+                    elif line[pos + 1:pos + 2] == b"*":
+                        state = self.COMMENT
+                        comment_depth = 1
+                        pos += 2
+                    else:
+                        pos += 1
+                elif state == self.QUOTE or state == self.IDENTIFIER:
+                    quote = b"'" if state == self.QUOTE else b'"'
+                    found = line.find(quote, pos)
+                    if found < 0:
+                        break
+                    if line[found + 1:found + 2] == quote:
+                        pos = found + 2
+                    else:
+                        state = self.PLAIN
+                        pos = found + 1
+                elif state == self.ESCAPE_QUOTE:
+                    found = pos
+                    while found < len(line) and line[found:found + 1] != b"'":
+                        found += 2 if line[found:found + 1] == b"\\" else 1
+                    if found >= len(line):
+                        break
+                    if line[found + 1:found + 2] == b"'":
+                        pos = found + 2
+                    else:
+                        state = self.PLAIN
+                        pos = found + 1
+                elif state == self.COMMENT:
+                    match = _COMMENT_SPECIAL.search(line, pos)
+                    if not match:
+                        break
+                    comment_depth += 1 if match.group() == b"/*" else -1
+                    pos = match.end()
+                    if not comment_depth:
+                        state = self.PLAIN
+                else:
+                    found = line.find(dollar_tag, pos)
+                    if found < 0:
+                        break
+                    state = self.PLAIN
+                    pos = found + len(dollar_tag)
+            if line:
+                buf.append(line)
+        text = b"".join(buf)
+        if strip_leading_noise(text):
+            yield Item(STATEMENT, text, offset)
+
+
+class StreamLoader(object):
+    """Load a SQL file through a psql session, batch_size statements per transaction.
+
+    A COPY block counts as one statement and is never split between two
+    transactions. A transaction opened by the file is left to the file, with
+    no batch commit until it ends, and a statement that can't run in a
+    transaction block is sent alone; the batch in progress is committed
+    before either. Query results are discarded. When checkpoint_path is set,
+    the offset of the last committed batch is saved there along with the
+    session settings (SET statements) seen so far, and a later load of the
+    same unchanged file restarts from that offset.
+    """
+
+    def __init__(self, session, sql_file, batch_size=1000, checkpoint_path=None,
+                 progress=None, progress_interval=5.0):
+        self.session = session
+        self.sql_file = sql_file
+        self.batch_size = max(int(batch_size), 1)
+        self.checkpoint_path = checkpoint_path
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.resumed_from = 0
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def _file_identity(self):
+        info = os.stat(self.sql_file)
+        return {'file': os.path.abspath(self.sql_file), 'size': info.st_size, 'mtime': info.st_mtime}
+
+    def read_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path) as handle:
+                checkpoint = json.load(handle)
+        except ValueError:
+            return None
+        identity = self._file_identity()
+        if any(checkpoint.get(key) != value for key, value in identity.items()):
+            return None
+        return checkpoint
+
+    def write_checkpoint(self, offset, settings):
+        if not self.checkpoint_path:
+            return
+        checkpoint = self._file_identity()
+        checkpoint.update({'offset': offset, 'statements': self.statements, 'rows': self.rows, 'settings': settings})
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, 'w') as handle:
+            json.dump(checkpoint, handle)
+        os.rename(temporary_path, self.checkpoint_path)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def report(self):
+        if not self.progress:
+            return
+        elapsed = max(self.elapsed, 1e-6)
+        self.progress("%d statements, %d rows, %.1f MB loaded in %.1fs (%.0f rows/s, %.2f MB/s)"
+                      % (self.statements, self.rows, self.bytes / 1048576.0, self.elapsed,
+                         self.rows / elapsed, self.bytes / 1048576.0 / elapsed))
+
+    def load(self, resume=False):
+        checkpoint = None
+        if resume:
+            checkpoint = self.read_checkpoint()
+            if checkpoint is None and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+                raise LoadError("%s changed since its interrupted load, the database has to be dropped to start over" % self.sql_file)
+        else:
+            self.clear_checkpoint()
+        settings = {}
+        offset = 0
+        if checkpoint:
+            offset = self.resumed_from = checkpoint['offset']
+            settings = checkpoint['settings']
+            self.statements = checkpoint['statements']
+            self.rows = checkpoint['rows']
+        session = self.session
+        started = time.time()
+        last_report = started
+        committed = offset
+        session.send("\\o /dev/null\n")
+        for text in settings.values():
+            session.send(text + "\n")
+        in_transaction = False
+        # Offset of the BEGIN of a transaction opened by the file, until its end
+        file_transaction = None
+        previous_end = offset
+        pending = 0
+        try:
+            with open(self.sql_file, 'rb') as handle:
+                handle.seek(offset)
+                for item in StatementReader(handle, offset):
+                    if item.kind == META:
+                        if in_transaction:
+                            session.send("COMMIT;\n")
+                            in_transaction = False
+                        session.send(item.text.decode('utf-8', 'surrogateescape'))
+                        previous_end = item.end
+                        continue
+                    control = transaction_control(item.text) if item.kind == STATEMENT else None
+                    if control == NO_TRANSACTION and file_transaction is not None:
+                        session.send("ROLLBACK;\n")
+                        session.sync()
+                        raise LoadError("%s: the statement ending at offset %d can't run in the transaction opened at offset %d"
+                                        % (self.sql_file, item.end, file_transaction))
+                    if control and in_transaction:
+                        session.send("COMMIT;\n")
+                        in_transaction = False
+                        session.sync()
+                        committed = previous_end
+                        pending = 0
+                        self.write_checkpoint(committed, settings)
+                    if control == TRANSACTION_BEGIN:
+                        file_transaction = previous_end
+                    elif not control and not in_transaction and file_transaction is None:
+                        session.send("BEGIN;\n")
+                        in_transaction = True
+                    text = item.text.decode('utf-8', 'surrogateescape')
+                    session.send(text if item.kind in (COPY, COPY_DATA, COPY_END) else text + "\n")
+                    self.rows += item.rows
+                    self.bytes = item.end - self.resumed_from
+                    previous_end = item.end
+                    if item.kind == STATEMENT:
+                        setting = session_setting(item.text)
+                        if setting:
+                            settings[setting] = text.strip()
+                    if item.kind in (STATEMENT, COPY_END):
+                        self.statements += 1
+                        pending += 1
+                    if control == TRANSACTION_END:
+                        file_transaction = None
+                    if control in (TRANSACTION_END, NO_TRANSACTION) or (
+                            in_transaction and pending >= self.batch_size and item.kind != COPY and item.kind != COPY_DATA):
+                        if in_transaction:
+                            session.send("COMMIT;\n")
+                            in_transaction = False
+                        session.sync()
+                        committed = item.end
+                        pending = 0
+                        self.write_checkpoint(committed, settings)
+                        self.elapsed = time.time() - started
+                        if time.time() - last_report >= self.progress_interval:
+                            last_report = time.time()
+                            self.report()
+            if file_transaction is not None:
+                session.send("ROLLBACK;\n")
+                session.sync()
+                raise LoadError("%s ends in the transaction opened at offset %d, which is rolled back"
+                                % (self.sql_file, file_transaction))
+            if in_transaction:
+                session.send("COMMIT;\n")
+            session.send("\\o\n")
+            session.sync()
+        except psql.PsqlError as err:
+            raise LoadError("%s failed after offset %d, %d statements committed: %s"
+                            % (self.sql_file, committed, self.statements - pending, err))
+        self.elapsed = time.time() - started
+        self.clear_checkpoint()
+        self.report()
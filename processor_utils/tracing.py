@@ -0,0 +1,264 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timing spans of the processor phases.
+
+A Tracer hands out spans, context managers timing a named phase and carrying
+metadata such as bytes, rows or entries. A span opened while another one is
+open on the same thread is its child; spans of worker threads are children
+of the root span, which covers the whole run. A disabled tracer hands out a
+single shared span that does nothing, so the instrumented code costs a call
+when tracing is off.
+
+The traced decorator sets up the tracer of Processor.main from the
+processor_trace and processor_trace_file inputs, and at the end of the run
+gives the spans to the processor_trace_spans output and appends them, one JSON
+object per line, to the trace file under a lock, so that concurrent runs can
+share it. Run this module with trace files as arguments to see where the
+time goes across all the runs they record:
+
+    python -m processor_utils.tracing trace.jsonl ...
+"""
+
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+
+
+class TraceError(Exception):
+    pass
+
+
+class _NullSpan(object):
+    """Span of a disabled tracer."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **metadata):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+
+    __slots__ = ('tracer', 'name', 'id', 'parent', 'metadata', 'started', 'duration', 'error', 'thread')
+
+    def __init__(self, tracer, name, metadata):
+        self.tracer = tracer
+        self.name = name
+        self.id = next(tracer.ids)
+        self.parent = None
+        self.metadata = metadata
+        self.started = None
+        self.duration = None
+        self.error = None
+        self.thread = None
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.tracer._pop(self)
+        return False
+
+    def set(self, **metadata):
+        self.metadata.update(metadata)
+
+    def add(self, key, amount=1):
+        self.metadata[key] = self.metadata.get(key, 0) + amount
+
+    def as_dict(self, origin):
+        return {
+            'name': self.name,
+            'id': self.id,
+            'parent': self.parent,
+            'start': self.started - origin,
+            'duration': self.duration,
+            'thread': self.thread,
+            'error': self.error,
+            'metadata': self.metadata,
+        }
+
+
+class Tracer(object):
+
+    def __init__(self, name, enabled=True, trace_file=None, context=None):
+        self.name = name
+        self.enabled = enabled
+        self.trace_file = trace_file
+        self.context = dict(context or {})
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.finished = []
+        self.root = None
+        if enabled:
+            from processor_utils import entropy
+            self.run_id = entropy.token_hex(8)
+            self.wall_clock = time.time()
+            self.origin = time.perf_counter()
+            self.root = Span(self, name, {})
+            self.root.__enter__()
+
+    def span(self, name, **metadata):
+        """Context timing the phase name, metadata can be completed with set() and add() of the span."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, metadata)
+
+    def _push(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        if stack:
+            span.parent = stack[-1].id
+        elif self.root is not None and span is not self.root:
+            span.parent = self.root.id
+        span.thread = threading.current_thread().name
+        stack.append(span)
+
+    def _pop(self, span):
+        stack = self.local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+        with self.lock:
+            self.finished.append(span)
+
+    def records(self):
+        """Finished spans as dictionaries, in start order."""
+        if not self.enabled:
+            return []
+        with self.lock:
+            spans = list(self.finished)
+        return [span.as_dict(self.origin) for span in sorted(spans, key=lambda span: span.started)]
+
+    def finish(self, exc_type=None):
+        """Close the root span, failed with exc_type if given, append the spans to the trace file if any and return them."""
+        if not self.enabled:
+            return []
+        if self.root.duration is None:
+            self.root.__exit__(exc_type, None, None)
+        records = self.records()
+        if self.trace_file:
+            self.write(self.trace_file, records)
+        return records
+
+    def write(self, path, records):
+        import fcntl
+        import json
+        lines = []
+        for record in records:
+            line = dict(self.context, processor=self.name, run=self.run_id, pid=os.getpid(),
+                        time=self.wall_clock + record['start'])
+            line.update(record)
+            lines.append(json.dumps(line, sort_keys=True, default=str) + "\n")
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'a') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                handle.write("".join(lines))
+        except (IOError, OSError) as err:
+            raise TraceError("Unable to write trace file %s: %s" % (path, err))
+
+
+DISABLED = Tracer(None, enabled=False)
+
+
+def from_settings(settings, name):
+    """Tracer of the processor name, enabled by the processor_trace or processor_trace_file keys of settings."""
+    trace_file = settings.get('processor_trace_file') or None
+    enabled = bool(settings.get('processor_trace')) or bool(trace_file)
+    if not enabled:
+        return DISABLED
+    return Tracer(name, trace_file=trace_file, context={'recipe': settings.get('RECIPE_PATH')})
+
+
+def traced(main):
+    """Decorator of Processor.main, setting self.tracer up and processor_trace_spans from it."""
+    @functools.wraps(main)
+    def wrapper(processor):
+        processor.tracer = from_settings(processor.env, processor.__class__.__name__)
+        exc_type = None
+        try:
+            return main(processor)
+        except BaseException as err:
+            exc_type = err.__class__
+            raise
+        finally:
+            try:
+                processor.env['processor_trace_spans'] = processor.tracer.finish(exc_type)
+            except TraceError as err:
+                processor.env['processor_trace_spans'] = processor.tracer.records()
+                processor.output(str(err))
+    return wrapper
+
+
+def summarize(records):
+    """Count, total, mean and maximum duration and metadata totals of records, per processor and span name."""
+    summary = {}
+    for record in records:
+        key = (record.get('processor'), record['name'])
+        entry = summary.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0, 'errors': 0, 'metadata': {}})
+        entry['count'] += 1
+        entry['total'] += record['duration']
+        entry['max'] = max(entry['max'], record['duration'])
+        entry['errors'] += 1 if record.get('error') else 0
+        for name, value in (record.get('metadata') or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                entry['metadata'][name] = entry['metadata'].get(name, 0) + value
+    for entry in summary.values():
+        entry['mean'] = entry['total'] / entry['count']
+    return summary
+
+
+def main(paths):
+    import json
+    records = []
+    for path in paths:
+        with open(path) as handle:
+            records.extend(json.loads(line) for line in handle if line.strip())
+    summary = summarize(records)
+    print("%-22s %-20s %8s %10s %10s %10s %7s  %s" % ("processor", "span", "count", "total", "mean", "max", "errors", "metadata"))
+    for (processor, name), entry in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        print("%-22s %-20s %8d %9.3fs %8.1fms %8.1fms %7d  %s" % (
+            processor, name, entry['count'], entry['total'], entry['mean'] * 1000, entry['max'] * 1000,
+            entry['errors'], ", ".join("%s=%s" % item for item in sorted(entry['metadata'].items()))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
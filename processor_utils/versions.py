@@ -0,0 +1,96 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Version parsing and comparison, in place of distutils' StrictVersion.
+
+A version is any number of dot separated integers, optionally followed by a
+pre-release tag (a, alpha, b, beta, c, rc, with an optional number) which
+sorts before the release itself. Anything after that, like the build of
+"10.13.6 (17G65)" or "5.10-1234", is ignored. Trailing zeros don't count:
+10.7 and 10.7.0 are equal. Parsed versions are cached.
+"""
+
+import re
+
+from functools import lru_cache
+
+_VERSION = re.compile(r'\s*v?(\d+(?:\.\d+)*)(?:[-.]?(a|alpha|b|beta|c|rc)(\d*)(?![A-Za-z]))?', re.IGNORECASE)
+_PRE_RELEASES = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2}
+# Sorts after every pre-release of the same version
+_RELEASE = (3, 0)
+
+
+class VersionError(Exception):
+    pass
+
+
+@lru_cache(maxsize=1024)
+def parse_version(text):
+    """Sort key of a version string: (release numbers without trailing zeros, (pre-release rank, number))."""
+    match = _VERSION.match(str(text))
+    if not match:
+        raise VersionError("Invalid version %r" % (text,))
+    release = [int(number) for number in match.group(1).split('.')]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    if match.group(2):
+        pre_release = (_PRE_RELEASES[match.group(2).lower()], int(match.group(3) or 0))
+    else:
+        pre_release = _RELEASE
+    return tuple(release), pre_release
+
+
+@lru_cache(maxsize=1024)
+def _written_length(text):
+    """Number of release numbers of a valid version as written, trailing zeros included."""
+    return len(_VERSION.match(str(text)).group(1).split('.'))
+
+
+def compare(first, second):
+    """-1, 0 or 1 as the first version is older than, the same as or newer than the second."""
+    first = parse_version(first)
+    second = parse_version(second)
+    return (first > second) - (first < second)
+
+
+def at_least(version, minimum):
+    return parse_version(version) >= parse_version(minimum)
+
+
+def at_most(version, maximum):
+    """Whether version isn't newer than maximum, updates included: 10.9.5 is at most 10.9.
+
+    Only the numbers written in maximum are compared, so 10.0.5 is at most
+    10.0 but 10.1 isn't, while 10.1 is at most 10.
+    """
+    release, pre_release = parse_version(version)
+    maximum_release, maximum_pre_release = parse_version(maximum)
+    length = _written_length(maximum)
+    if len(release) > length and maximum_pre_release == _RELEASE:
+        release = list(release[:length])
+        while len(release) > 1 and release[-1] == 0:
+            release.pop()
+        release = tuple(release)
+        pre_release = _RELEASE
+    return (release, pre_release) <= (maximum_release, maximum_pre_release)
+
+
+def in_range(version, minimum=None, maximum=None):
+    """Whether version is within the inclusive bounds given, see at_most for the upper one."""
+    if minimum and not at_least(version, minimum):
+        return False
+    if maximum and not at_most(version, maximum):
+        return False
+    return True
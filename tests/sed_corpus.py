@@ -0,0 +1,97 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conformance corpus of the builtin sed engine: every script runs on every input.
+
+INPUTS cover ASCII, UTF-8, Latin-1 and invalid UTF-8 text, a missing final
+newline and an empty file; SCRIPTS are lists of sed commands, as given to
+the Sed processor in sed_commands.
+"""
+
+INPUTS = {
+    'ascii': b"alpha beta\nGamma delta 42\n\nfoo=bar baz\n# comment\naa ab abc\nlast line",
+    'utf8': u"café ok\nnaïve Straße\nÉcole 123 été\n"
+            u"Αθήνα ελληνικά\n"
+            u"日本語のテキスト ok\n".encode('utf-8'),
+    'latin1': u"café naïve ok\nÉté abc\n".encode('latin-1'),
+    'invalid_utf8': b"ok \xff\xfe bad\ncaf\xc3\xa9 ok\nabc \xc3\n",
+    'empty': b"",
+}
+
+SCRIPTS = [
+    # Substitutions
+    ['s/a/A/'],
+    ['s/a/A/g'],
+    ['s/a/A/2'],
+    ['s/a/A/2g'],
+    ['s/^/> /'],
+    ['s/$/ </'],
+    ['s/ok/KO/'],
+    ['s/ok/KO/I'],
+    ['s/OK/ko/Ig'],
+    ['s|/|:|g'],
+    ['s/[0-9]\\+/<&>/g'],
+    ['s/x*/-/g'],
+    ['s/a*/X/2'],
+    ['s/f./F_/'],
+    ['s/.$//'],
+    ['s/^.\\{3\\}/<&>/'],
+    ['s/\\(.\\)\\1/DD/g'],
+    ['s/\\(a\\)\\(b\\)*/[\\1|\\2]/g'],
+    [u's/é/e/g'],
+    [u's/[éè]/e/g'],
+    ['s/[^a-z ]/?/g'],
+    ['s/[a-c]\\+/R/g'],
+    ['s/ab\\|abc\\|a/Z/g'],
+    ['s/.*/\\U&/'],
+    ['s/.*/\\L&/'],
+    ['s/\\(.\\)\\(.*\\)/\\u\\1\\U\\2\\E!/'],
+    ['s/ \\(.\\)/ \\l\\1/g'],
+    ['s/a/\\n/', 's/\\t/TAB/'],
+    # Character classes
+    ['s/[[:alpha:]]\\+/W/g'],
+    ['s/[[:upper:]]/_/g'],
+    ['s/[[:space:]]/_/g'],
+    ['s/[[:digit:][:punct:]]/#/g'],
+    ['s/\\w\\+/\\u&/g'],
+    ['s/\\W/./g'],
+    ['s/\\bb/B/g'],
+    ['s/\\<./X/g'],
+    ['s/\\s\\+/ /g'],
+    # Transliteration
+    ['y/abc/xyz/'],
+    [u'y/éa/eA/'],
+    # Addresses and other commands
+    ['/^#/d'],
+    ['#n', '/a/p'],
+    ['2,3d'],
+    ['$d'],
+    ['1~2d'],
+    ['0,/a/d'],
+    ['/beta/,/foo/s/^/|/'],
+    ['2,+1s/$/ +/'],
+    ['/ok/!d'],
+    ['/OK/Id'],
+    [u'/É/d'],
+    ['/./!d'],
+    ['2i\\', 'inserted'],
+    ['$a\\', 'appended'],
+    ['1c\\', 'changed'],
+    ['='],
+    ['3q'],
+    ['2Q'],
+    ['/a/{', 's/a/A/', 's/e/E/', '}'],
+    ['/a/{s/a/1/;s/a/2/;}', 'p'],
+]
@@ -0,0 +1,143 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retention and deduplication of processor_utils.backups.
+
+    python -m unittest discover tests
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import backups
+
+
+class BackupStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.root = os.path.join(self.directory, 'store')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        # Replaced like the Sed processor does, so a hard linked backup keeps the previous content
+        with open(path + '.new', 'w') as handle:
+            handle.write(content)
+        os.rename(path + '.new', path)
+        return path
+
+    def backup(self, store, name, content):
+        path = self.write(name, content)
+        return store.add(path, hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+    def objects(self):
+        objects = os.path.join(self.root, 'objects')
+        return sorted(name for prefix in os.listdir(objects) for name in os.listdir(os.path.join(objects, prefix)))
+
+    def contents(self, store, name):
+        history = store.history(os.path.join(self.directory, name))
+        result = []
+        for backup in history:
+            with open(backup['object']) as handle:
+                result.append(handle.read())
+        return result
+
+    def test_object_is_a_hard_link(self):
+        store = backups.BackupStore(self.root)
+        object_path = self.backup(store, 'a', "one")
+        self.assertTrue(os.path.samefile(object_path, os.path.join(self.directory, 'a')))
+        self.write('a', "two")
+        self.assertEqual(self.contents(store, 'a'), ["one"])
+
+    def test_copy_when_links_fail(self):
+        store = backups.BackupStore(self.root)
+        with mock.patch.object(backups.os, 'link', side_effect=OSError(18, "Invalid cross-device link")):
+            object_path = self.backup(store, 'a', "one")
+        self.assertFalse(os.path.samefile(object_path, os.path.join(self.directory, 'a')))
+        self.assertEqual(self.contents(store, 'a'), ["one"])
+
+    def test_same_content_is_stored_once(self):
+        store = backups.BackupStore(self.root)
+        first = self.backup(store, 'a', "same")
+        self.assertEqual(self.backup(store, 'b', "same"), first)
+        self.backup(store, 'a', "same")
+        self.assertEqual(len(self.objects()), 1)
+        self.assertEqual(self.contents(store, 'a'), ["same", "same"])
+        self.assertEqual(self.contents(store, 'b'), ["same"])
+
+    def test_keep(self):
+        store = backups.BackupStore(self.root, keep=2)
+        for content in ("one", "two", "three", "four"):
+            self.backup(store, 'a', content)
+        self.assertEqual(self.contents(store, 'a'), ["three", "four"])
+        self.assertEqual(len(self.objects()), 2)
+
+    def test_max_age(self):
+        store = backups.BackupStore(self.root, max_age=100)
+        now = time.time()
+        with mock.patch.object(backups.time, 'time', return_value=now - 150):
+            self.backup(store, 'a', "old")
+        self.backup(store, 'a', "new")
+        self.assertEqual(self.contents(store, 'a'), ["new"])
+        self.assertEqual(len(self.objects()), 1)
+
+    def test_shared_object_outlives_the_pruning_of_one_file(self):
+        store = backups.BackupStore(self.root, keep=1)
+        self.backup(store, 'a', "shared")
+        self.backup(store, 'b', "shared")
+        self.backup(store, 'a', "other")
+        self.assertEqual(self.contents(store, 'a'), ["other"])
+        self.assertEqual(self.contents(store, 'b'), ["shared"])
+        self.assertEqual(len(self.objects()), 2)
+
+    def test_keep_nothing(self):
+        store = backups.BackupStore(self.root, keep=0)
+        self.backup(store, 'a', "one")
+        self.assertEqual(store.history(os.path.join(self.directory, 'a')), [])
+        self.assertEqual(self.objects(), [])
+
+    def test_collect_garbage(self):
+        store = backups.BackupStore(self.root)
+        self.backup(store, 'a', "kept")
+        orphan = store.object_path('0' * 64)
+        os.makedirs(os.path.dirname(orphan))
+        with open(orphan, 'w') as handle:
+            handle.write("orphan")
+        self.assertEqual(store.collect_garbage(), ['0' * 64])
+        self.assertEqual(self.contents(store, 'a'), ["kept"])
+
+    def test_unreadable_index(self):
+        store = backups.BackupStore(self.root)
+        self.backup(store, 'a', "one")
+        with open(store.index_path(os.path.join(self.directory, 'a')), 'w') as handle:
+            handle.write("{")
+        self.assertEqual(store.history(os.path.join(self.directory, 'a')), [])
+        self.backup(store, 'a', "two")
+        self.assertEqual(self.contents(store, 'a'), ["two"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Input parsing, ordering and errors of processor_utils.batch.
+
+    python -m unittest discover tests
+
+The runs use BatchEcho, a processor written to a temporary folder, over
+AutoPKG's autopkglib when installed or the stand-in of benchmarks/stubs.
+"""
+
+import io
+import json
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+try:
+    import autopkglib
+except ImportError:
+    sys.path.append(os.path.join(ROOT, 'benchmarks', 'stubs'))
+
+from processor_utils import batch
+
+ECHO = '''
+import os
+import threading
+import time
+
+from autopkglib import Processor, ProcessorError
+
+
+class BatchEcho(Processor):
+    input_variables = {"value": {"required": False}}
+    output_variables = {"echoed": {}, "worker": {}}
+
+    def main(self):
+        time.sleep(self.env.get("delay", 0))
+        if self.env.get("fail"):
+            raise ProcessorError("failed on %s" % self.env["value"])
+        self.env["echoed"] = self.env["value"]
+        self.env["worker"] = [os.getpid(), threading.get_ident(), id(self)]
+'''
+
+
+def setUpModule():
+    global PROCESSOR_DIR
+    PROCESSOR_DIR = tempfile.mkdtemp()
+    with open(os.path.join(PROCESSOR_DIR, 'BatchEcho.py'), 'w') as handle:
+        handle.write(ECHO)
+
+
+def tearDownModule():
+    shutil.rmtree(PROCESSOR_DIR)
+
+
+def read(data):
+    return list(batch.read_items(io.BufferedReader(io.BytesIO(data))))
+
+
+class ReadItemsTest(unittest.TestCase):
+
+    def test_json_lines(self):
+        items = read(b'{"value": 1}\n\n{"value": "two"}\n[1]\n{broken\n{"value": 3}\n')
+        self.assertEqual(items[:2], [{'value': 1}, {'value': 'two'}])
+        self.assertEqual(items[4], {'value': 3})
+        self.assertIsInstance(items[2], batch.BatchError)
+        self.assertIn("Line 4 isn't a dictionary", str(items[2]))
+        self.assertIn("Line 5 isn't valid JSON", str(items[3]))
+
+    def test_plist(self):
+        for data in (plistlib.dumps([{'value': 1}, 'text']), plistlib.dumps([{'value': 1}, 'text'], fmt=plistlib.FMT_BINARY)):
+            items = read(data)
+            self.assertEqual(items[0], {'value': 1})
+            self.assertIn("Item 2 isn't a dictionary", str(items[1]))
+        with self.assertRaisesRegex(batch.BatchError, r'must be an array'):
+            read(plistlib.dumps({'value': 1}))
+        with self.assertRaisesRegex(batch.BatchError, r'Invalid plist input'):
+            read(b'<?xml version="1.0"?><plist><array><dict>')
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def run_batch(self, items, **options):
+        options.setdefault('paths', [PROCESSOR_DIR])
+        return list(batch.run_batch('BatchEcho', items, **options))
+
+    def items(self, count):
+        # The first ones take longest, to finish last
+        return [{'value': index, 'delay': 0.01 * (count - index)} for index in range(count)]
+
+    def test_results_in_input_order(self):
+        for pool, workers in ((batch.THREAD_POOL, 1), (batch.THREAD_POOL, 4), (batch.PROCESS_POOL, 3)):
+            with self.subTest(pool=pool, workers=workers):
+                results = self.run_batch(self.items(12), workers=workers, pool=pool)
+                self.assertEqual([result['index'] for result in results], list(range(12)))
+                self.assertEqual([result['outputs']['echoed'] for result in results], list(range(12)))
+                self.assertEqual(set(result['status'] for result in results), set(['ok']))
+
+    def test_errors_stay_with_their_item(self):
+        items = self.items(6)
+        items[1]['fail'] = True
+        items[3] = batch.BatchError("Line 4 isn't valid JSON")
+        del items[4]['value']
+        for pool in (batch.THREAD_POOL, batch.PROCESS_POOL):
+            with self.subTest(pool=pool):
+                results = self.run_batch(items, workers=3, pool=pool)
+                self.assertEqual([result['status'] for result in results], ['ok', 'error', 'ok', 'error', 'error', 'ok'])
+                self.assertEqual(results[1]['error'], "failed on 1")
+                self.assertEqual(results[3]['error'], "Line 4 isn't valid JSON")
+                self.assertEqual(results[4]['error'], "KeyError: 'value'")
+                self.assertEqual(results[5]['outputs']['echoed'], 5)
+
+    def test_processor_created_once_per_thread(self):
+        results = self.run_batch(self.items(20), workers=4)
+        workers = set(tuple(result['outputs']['worker']) for result in results)
+        self.assertLessEqual(len(workers), 4)
+        self.assertEqual(len(workers), len(set(worker[1] for worker in workers)))
+
+    def test_defaults(self):
+        results = self.run_batch([{}, {'value': 'own'}], defaults={'value': 'default'}, workers=2)
+        self.assertEqual([result['outputs']['echoed'] for result in results], ['default', 'own'])
+
+    def test_items_are_read_ahead_by_a_window(self):
+        consumed = []
+
+        def items():
+            for index in range(1000):
+                consumed.append(index)
+                yield {'value': index}
+
+        results = batch.run_batch('BatchEcho', items(), workers=2, paths=[PROCESSOR_DIR])
+        self.assertEqual(next(results)['index'], 0)
+        self.assertLessEqual(len(consumed), 2 * 4 + 1)
+        results.close()
+
+    def test_unknown_pool_and_processor(self):
+        with self.assertRaisesRegex(batch.BatchError, r'Unknown pool'):
+            self.run_batch([{}], pool='fiber')
+        with self.assertRaisesRegex(batch.BatchError, r'Unable to load processor Missing'):
+            list(batch.run_batch('Missing', [{}], workers=2))
+
+
+class MainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_results_file_and_exit_status(self):
+        input_path = os.path.join(self.directory, 'input.jsonl')
+        output_path = os.path.join(self.directory, 'results.jsonl')
+        with open(input_path, 'w') as handle:
+            handle.write('{"value": 1}\n{"fail": true}\n{}\n')
+        status = batch.main(['BatchEcho', input_path, '--path', PROCESSOR_DIR, '--set', 'value=[2]',
+                             '--output', output_path, '--workers', '2'])
+        self.assertEqual(status, 1)
+        with open(output_path) as handle:
+            results = [json.loads(line) for line in handle]
+        self.assertEqual([result['status'] for result in results], ['ok', 'error', 'ok'])
+        self.assertEqual(results[0]['outputs']['echoed'], 1)
+        self.assertEqual(results[2]['outputs']['echoed'], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
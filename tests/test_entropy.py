@@ -0,0 +1,60 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Random strings of processor_utils.entropy.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import entropy
+
+
+class RandomStringsTest(unittest.TestCase):
+
+    def test_lengths(self):
+        for count, length in ((1, 42), (5, 1), (3, 100)):
+            with self.subTest(count=count, length=length):
+                strings = entropy.random_strings(count, length, 'hex')
+                self.assertEqual([len(string) for string in strings], [length] * count)
+                self.assertTrue(set(''.join(strings)) <= set('0123456789abcdef'))
+
+    def test_empty_strings(self):
+        # random_string_length 0 gives empty strings, as it did before the strings were batched
+        self.assertEqual(entropy.random_strings(3, 0), ['', '', ''])
+        self.assertEqual(entropy.random_characters(0), '')
+
+    def test_custom_alphabet(self):
+        strings = entropy.random_strings(4, 50, 'custom:xy')
+        self.assertEqual(set(''.join(strings)), set('xy'))
+
+    def test_unknown_alphabet(self):
+        # Taken as the custom set "hexx", it would give strings of 3 characters
+        for name in ('hexx', 'Hex', 'abcdef', ''):
+            with self.subTest(name=name):
+                self.assertRaises(entropy.EntropyError, entropy.random_strings, 1, 8, name)
+        self.assertRaises(entropy.EntropyError, entropy.random_strings, 1, 8, 'custom:a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,303 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process mode and owner changes of processor_utils.permissions.
+
+    python -m unittest discover tests
+    python tests/test_permissions.py -v
+
+GnuChmodTest compares every mode of MODES applied to every start mode of
+START_MODES, on files and directories, with GNU chmod. RandomTreeTest runs
+random chmod_list/chown_list entries, nested and overlapping, on random
+trees, once with GNU chmod/chown (-R) run in plan order and once with
+apply_plan, with and without a manifest. Both are skipped when chmod isn't
+GNU chmod, owner changes when not running as root.
+"""
+
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import permissions
+
+UMASK = 0o022
+
+MODES = [
+    # Octal, 5 digits and more also clear the set-user-ID and set-group-ID bits of directories
+    '0', '644', '755', '700', '4755', '2750', '1777', '6711', '00755', '000644',
+    # Symbolic
+    'u+x', 'g-w', 'o=r', 'a+X', '+X', '+x', '-w', '=r', 'go-rwx', 'u=rwx,g=rx,o=',
+    'ug+rwX', 'o-X', 'a=r,u+w', 'u+s', 'g+s', 'u-s,g-s', '+t', 'a-st', 'g=u', 'o=u',
+    'go=u-w', 'u=g', 'g+X,o+t', '+rw', '=',
+]
+START_MODES = [0o000, 0o644, 0o755, 0o600, 0o4755, 0o2750, 0o1777, 0o6711, 0o070]
+# Random trees: modes and owners given to chmod_list and chown_list entries
+TREE_MODES = ['644', '755', '700', '2755', 'u+x', 'g-w', 'go-rwx', 'a+X', 'u=rwX,go=rX', 'o+t', 'g+s', '-x']
+TREE_OWNERS = ['0', '1000', '1000:50', ':50', 'root:', '1001:1001']
+SEEDS = range(40)
+
+
+def mode_of(path):
+    return stat.S_IMODE(os.lstat(path).st_mode)
+
+
+def gnu_chmod():
+    try:
+        return b'GNU' in subprocess.run(['chmod', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    except OSError:
+        return False
+
+
+def run_with_umask(args):
+    """Run a coreutils command under UMASK, ignoring its status: chmod fails when the umask left bits unset."""
+    subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, preexec_fn=lambda: os.umask(UMASK))
+
+
+def tree_state(root, set_id=True):
+    """(type, mode, uid, gid) of every entry under root, by relative path.
+
+    Without set_id, the set-user-ID and set-group-ID bits of files are left
+    out: Linux clears them on every chown, even by root to the same owner,
+    where macOS, which the processor is for, keeps them.
+    """
+    state = {}
+    for directory, names, files in os.walk(root):
+        for name in names + files:
+            path = os.path.join(directory, name)
+            info = os.lstat(path)
+            mode = stat.S_IMODE(info.st_mode)
+            if not set_id and stat.S_ISREG(info.st_mode):
+                mode &= ~(stat.S_ISUID | stat.S_ISGID)
+            state[os.path.relpath(path, root)] = (stat.S_IFMT(info.st_mode), mode, info.st_uid, info.st_gid)
+    return state
+
+
+class TreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def make_tree(self, files, directories=()):
+        for name in directories:
+            os.makedirs(self.path(name))
+        for name in files:
+            directory = os.path.dirname(self.path(name))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            open(self.path(name), 'w').close()
+
+    def apply(self, operations, **options):
+        plan = permissions.compile_plan([dict(operation, path=self.path(operation['path'])) for operation in operations])
+        return permissions.apply_plan(plan, UMASK, **options)
+
+
+class ManifestTest(TreeTestCase):
+
+    def test_rules_inside_skipped_directory_keep_inherited_rules(self):
+        self.make_tree(['a/f', 'a/g'], ['a/d'])
+        plan = [
+            {'path': 'a/f', 'mode': 'u+x'},
+            {'path': 'a', 'mode': '600', 'recursive': True},
+            {'path': 'a/d', 'mode': 'g+w'},
+        ]
+        manifest = self.path('manifest')
+        first = self.apply(plan, manifest_path=manifest)
+        self.assertEqual(first['errors'], [])
+        expected = dict((name, mode_of(self.path(name))) for name in ('a', 'a/f', 'a/g', 'a/d'))
+        self.assertEqual(expected['a/f'], 0o600)
+        for run in range(2):
+            result = self.apply(plan, manifest_path=manifest)
+            self.assertGreater(result['unchanged_directories'], 0)
+            self.assertEqual(result['changed'], 0)
+            self.assertEqual(dict((name, mode_of(self.path(name))) for name in expected), expected)
+
+    def test_changed_directory_is_listed_again(self):
+        self.make_tree(['a/f'])
+        plan = [{'path': 'a', 'mode': 'go-rwx', 'recursive': True}]
+        manifest = self.path('manifest')
+        self.apply(plan, manifest_path=manifest)
+        self.make_tree(['a/new'])
+        result = self.apply(plan, manifest_path=manifest)
+        self.assertEqual(result['unchanged_directories'], 0)
+        self.assertEqual(mode_of(self.path('a/new')), 0o600)
+
+
+class ConcurrencyTest(TreeTestCase):
+
+    def test_concurrent_runs(self):
+        # Without "who", these modes depend on the umask
+        modes = ['+x', '=r', 'a+X', '+rw', '-w', '=rwX']
+        umask = permissions.current_umask()
+        self.make_tree(['t%d/d/f%d' % (index, number) for index in range(len(modes)) for number in range(20)])
+        # As root, run_plan runs in-process, where it reads the umask
+        apply = permissions.run_plan if os.geteuid() == 0 else (
+            lambda operations: permissions.apply_plan(permissions.compile_plan(operations), umask))
+        errors = []
+        created = []
+        done = threading.Event()
+
+        def change(index):
+            try:
+                for run in range(30):
+                    mode = modes[(index + run) % len(modes)]
+                    operations = [{'path': self.path('t%d' % index), 'mode': mode, 'recursive': True}]
+                    before = dict((name, os.lstat(os.path.join(directory, name)).st_mode)
+                                  for directory, names, files in os.walk(self.path('t%d' % index)) for name in names + files)
+                    apply(operations)
+                    changes = permissions.parse_mode(mode)
+                    for directory, names, files in os.walk(self.path('t%d' % index)):
+                        for name in names + files:
+                            start = before[name]
+                            expected = permissions.adjust_mode(changes, start, stat.S_ISDIR(start), umask)
+                            if mode_of(os.path.join(directory, name)) != expected:
+                                errors.append((mode, name))
+            except Exception as err:
+                errors.append(err)
+
+        def create():
+            number = 0
+            while not done.is_set():
+                path = self.path('created%d' % number)
+                open(path, 'w').close()
+                created.append(mode_of(path))
+                number += 1
+
+        # A slow os.umask() widens the window a reading that changes the umask would leave open
+        real_umask = os.umask
+
+        def slow_umask(mask):
+            previous = real_umask(mask)
+            time.sleep(0.001)
+            return previous
+
+        os.umask = slow_umask
+        self.addCleanup(setattr, os, 'umask', real_umask)
+        creator = threading.Thread(target=create)
+        creator.start()
+        threads = [threading.Thread(target=change, args=(index,)) for index in range(len(modes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        creator.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(set(created), set([0o666 & ~umask]))
+
+
+@unittest.skipUnless(gnu_chmod(), "modes are checked against GNU chmod")
+class GnuChmodTest(TreeTestCase):
+
+    def test_modes(self):
+        paths = {}
+        for index, start in enumerate(START_MODES):
+            for is_dir in (False, True):
+                path = self.path('%s%d' % ('d' if is_dir else 'f', index))
+                if is_dir:
+                    os.mkdir(path)
+                else:
+                    open(path, 'w').close()
+                paths[path] = (start, is_dir)
+        for mode in MODES:
+            changes = permissions.parse_mode(mode)
+            for path, (start, is_dir) in paths.items():
+                os.chmod(path, start)
+            run_with_umask(['chmod', '--', mode] + sorted(paths))
+            for path, (start, is_dir) in sorted(paths.items()):
+                with self.subTest(mode=mode, start=oct(start), directory=is_dir):
+                    self.assertEqual(oct(permissions.adjust_mode(changes, start, is_dir, UMASK)), oct(mode_of(path)))
+
+
+@unittest.skipUnless(gnu_chmod(), "trees are checked against GNU chmod and chown")
+class RandomTreeTest(TreeTestCase):
+
+    def make_random_tree(self, root, seed):
+        generator = random.Random(seed)
+        directories = ['']
+        entries = []
+        for index in range(generator.randint(6, 16)):
+            parent = generator.choice(directories)
+            name = os.path.join(parent, 'e%d' % index)
+            kind = generator.choice('ffdddl')
+            path = os.path.join(root, name)
+            if kind == 'd':
+                os.mkdir(path)
+                directories.append(name)
+            elif kind == 'l':
+                os.symlink(generator.choice(['e0', '../e1', 'missing']), path)
+            else:
+                open(path, 'w').close()
+            # Links are only met inside trees, chmod doesn't change them and chown -R changes them
+            if kind != 'l':
+                os.chmod(path, generator.choice(START_MODES))
+                entries.append(name)
+        return entries
+
+    def random_operations(self, entries, seed):
+        generator = random.Random(-seed - 1)
+        operations = []
+        for index in range(generator.randint(2, 6)):
+            path = generator.choice([''] + entries)
+            recursive = generator.random() < 0.6
+            if os.geteuid() == 0 and generator.random() < 0.4:
+                operations.append({'path': path, 'owner': generator.choice(TREE_OWNERS), 'recursive': recursive})
+            else:
+                operations.append({'path': path, 'mode': generator.choice(TREE_MODES), 'recursive': recursive})
+        return operations
+
+    def test_random_trees(self):
+        for seed in SEEDS:
+            expected_root = self.path('gnu%d' % seed)
+            actual_root = self.path('plan%d' % seed)
+            for root in (expected_root, actual_root):
+                os.mkdir(root)
+                entries = self.make_random_tree(root, seed)
+            operations = self.random_operations(entries, seed)
+            for operation in operations:
+                command = ['chmod', '--', operation['mode']] if 'mode' in operation else ['chown', operation['owner']]
+                if operation['recursive']:
+                    command.insert(1, '-R')
+                run_with_umask(command + [os.path.join(expected_root, operation['path'])])
+            set_id = not any('owner' in operation for operation in operations)
+            expected = tree_state(expected_root, set_id)
+            plan = permissions.compile_plan([dict(operation, path=os.path.join(actual_root, operation['path']))
+                                             for operation in operations])
+            manifest = self.path('manifest%d' % seed)
+            for run in range(3):
+                with self.subTest(seed=seed, operations=operations, run=run):
+                    result = permissions.apply_plan(plan, UMASK, manifest_path=manifest if run else None)
+                    self.assertEqual(result['errors'], [])
+                    if run:
+                        self.assertEqual(result['changed'], 0)
+                    self.assertEqual(tree_state(actual_root, set_id), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
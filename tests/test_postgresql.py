@@ -0,0 +1,371 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""PostgreSQL processor runs against the psql stand-in of the benchmarks.
+
+    python -m unittest discover tests
+
+The stand-in keeps roles, databases, their tables, template comments and
+ledgers in a JSON file, see benchmarks/fakes/psql. AutoPKG's autopkglib is
+used when installed, the stand-in of benchmarks/stubs otherwise.
+"""
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+try:
+    import autopkglib
+except ImportError:
+    sys.path.append(os.path.join(ROOT, 'benchmarks', 'stubs'))
+
+import PostgreSQL
+
+from autopkglib import ProcessorError
+
+FAKES = os.path.join(ROOT, 'benchmarks', 'fakes')
+
+
+class PostgreSQLTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ['FAKE_PSQL_STATE'] = os.path.join(self.workdir, 'psql.json')
+
+    def path(self, *names):
+        return os.path.join(self.workdir, *names)
+
+    def write(self, name, text):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as handle:
+            handle.write(text)
+        return path
+
+    def processor_env(self, **settings):
+        env = {
+            'postgre_sql_psql_path': os.path.join(FAKES, 'psql'),
+            'postgre_sql_start_os_x_server_service': False,
+            'postgre_sql_admin_name': 'postgres',
+            'postgre_sql_role_name': 'app',
+            'postgre_sql_role_password': 'secret',
+            'RECIPE_CACHE_DIR': self.path('cache'),
+            'verbose': 0,
+        }
+        env.update(settings)
+        return env
+
+    def run_processor(self, **settings):
+        processor = PostgreSQL.PostgreSQL(env=self.processor_env(**settings))
+        processor.process()
+        return processor.env
+
+    def state(self):
+        with open(os.environ['FAKE_PSQL_STATE']) as handle:
+            return json.load(handle)
+
+    def databases(self):
+        return self.state()['databases']
+
+    def change_state(self, change):
+        state = self.state()
+        change(state)
+        with open(os.environ['FAKE_PSQL_STATE'], 'w') as handle:
+            json.dump(state, handle)
+
+
+class ServiceTest(PostgreSQLTestCase):
+
+    def setUp(self):
+        super(ServiceTest, self).setUp()
+        os.environ['FAKE_SERVERADMIN_STATE'] = self.path('serveradmin')
+        self.settings = dict(postgre_sql_database='app', postgre_sql_plan_cache='',
+                             postgre_sql_start_os_x_server_service=True,
+                             postgre_sql_service_controller=os.path.join(FAKES, 'serveradmin'))
+
+    def test_running_service_is_not_started(self):
+        open(self.path('serveradmin.postgres'), 'w').close()
+        env = self.run_processor(**self.settings)
+        self.assertNotIn('start_service', [action['action'] for action in env['postgre_sql_plan']])
+        self.assertEqual(env['postgre_sql_ready_wait'], 0)
+
+    def test_started_service_is_waited_for(self):
+        os.environ['FAKE_PSQL_ACCEPTING_AFTER'] = str(time.time() + 0.5)
+        env = self.run_processor(**self.settings)
+        self.assertEqual(env['postgre_sql_plan'][0], {'action': 'start_service'})
+        self.assertGreaterEqual(env['postgre_sql_ready_wait'], 0.5)
+        self.assertTrue(os.path.exists(self.path('serveradmin.postgres')))
+        self.assertIn('app', self.databases())
+
+    def test_server_never_ready(self):
+        os.environ['FAKE_PSQL_ACCEPTING_AFTER'] = str(time.time() + 60)
+        started = time.time()
+        with self.assertRaisesRegex(ProcessorError, r'Impossible to connect to database server after'):
+            self.run_processor(postgre_sql_ready_timeout=1, **self.settings)
+        self.assertLess(time.time() - started, 10)
+
+    def test_backoff(self):
+        clock = [1000.0]
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            clock[0] += delay
+
+        processor = PostgreSQL.PostgreSQL(env={'verbose': 0})
+        processor.psql_session = mock.Mock()
+        processor.psql_session.query.side_effect = [PostgreSQL.psql.PsqlError("refused")] * 6 + ['']
+        with mock.patch.object(PostgreSQL.time, 'time', lambda: clock[0]), \
+                mock.patch.object(PostgreSQL.time, 'sleep', sleep):
+            waited = processor.wait_for_db_service_or_die(60)
+            self.assertEqual(delays, [0.25, 0.5, 1, 2, 4, 5])
+            self.assertEqual(waited, sum(delays))
+            delays[:] = []
+            processor.psql_session.query.side_effect = PostgreSQL.psql.PsqlError("refused")
+            with self.assertRaisesRegex(ProcessorError, r'after 7.8 seconds'):
+                processor.wait_for_db_service_or_die(10)
+            # The next delay would go past the timeout
+            self.assertEqual(delays, [0.25, 0.5, 1, 2, 4])
+
+
+class LedgerTest(PostgreSQLTestCase):
+
+    def test_migrations_are_applied_once(self):
+        for name in ('0001.sql', '0002.sql'):
+            self.write(os.path.join('migrations', name), "CREATE TABLE t%s (id int);\n" % name[:4])
+        env = self.run_processor(postgre_sql_database='app', postgre_sql_update_directory=self.path('migrations'),
+                                 postgre_sql_plan_cache='')
+        self.assertEqual(len(env['postgre_sql_applied_scripts']), 2)
+        self.assertEqual(sorted(self.databases()['app']['ledger']), ['0001.sql', '0002.sql'])
+        self.write(os.path.join('migrations', '0003.sql'), "CREATE TABLE t0003 (id int);\n")
+        env = self.run_processor(postgre_sql_database='app', postgre_sql_update_directory=self.path('migrations'),
+                                 postgre_sql_plan_cache='')
+        self.assertEqual([os.path.basename(path) for path in env['postgre_sql_applied_scripts']], ['0003.sql'])
+        self.assertEqual(len(env['postgre_sql_skipped_scripts']), 2)
+
+    def test_moved_directory_keeps_its_ledger(self):
+        self.write(os.path.join('migrations', '0001.sql'), "CREATE TABLE t1 (id int);\n")
+        self.run_processor(postgre_sql_database='app', postgre_sql_update_directory=self.path('migrations'),
+                           postgre_sql_plan_cache='')
+        os.rename(self.path('migrations'), self.path('moved'))
+        env = self.run_processor(postgre_sql_database='app', postgre_sql_update_directory=self.path('moved'),
+                                 postgre_sql_plan_cache='')
+        self.assertEqual(env['postgre_sql_applied_scripts'], [])
+        self.assertEqual(env['postgre_sql_skipped_scripts'], [self.path('moved', '0001.sql')])
+
+    def test_changed_update_input_is_applied_again(self):
+        update = self.write('update.sql', "CREATE TABLE a (id int);\n")
+        settings = dict(postgre_sql_database='app', postgre_sql_update_input=update, postgre_sql_ledger=True,
+                        postgre_sql_plan_cache='')
+        self.run_processor(**settings)
+        self.assertEqual(self.run_processor(**settings)['postgre_sql_applied_scripts'], [update])
+        self.assertEqual(self.run_processor(**settings)['postgre_sql_skipped_scripts'], [update])
+        self.write('update.sql', "CREATE TABLE b (id int);\n")
+        self.assertEqual(self.run_processor(**settings)['postgre_sql_applied_scripts'], [update])
+
+
+class TemplateTest(PostgreSQLTestCase):
+
+    def template_settings(self, creation_input, **settings):
+        settings.update(postgre_sql_creation_input=creation_input, postgre_sql_template_cache=True,
+                        postgre_sql_plan_cache='')
+        return settings
+
+    def building(self, template):
+        if not os.path.exists(os.environ['FAKE_PSQL_STATE']):
+            return False
+        return any(name.startswith(template) and 'first' in database.get('tables', [])
+                   for name, database in self.databases().items())
+
+    def test_databases_are_cloned_from_the_template(self):
+        creation = self.write('create.sql', "CREATE TABLE first (id int);\nCREATE TABLE second (id int);\n")
+        self.run_processor(postgre_sql_database='one', **self.template_settings(creation))
+        self.run_processor(postgre_sql_database='two', **self.template_settings(creation))
+        databases = self.databases()
+        template = PostgreSQL.PostgreSQL.template_prefix + PostgreSQL.psql.file_checksum(creation)[:32]
+        self.assertEqual([name for name in databases if name.startswith(PostgreSQL.PostgreSQL.template_prefix)], [template])
+        self.assertEqual(databases[template]['comment'], "autopkg template of %s" % creation)
+        for name in (template, 'one', 'two'):
+            self.assertEqual(databases[name]['tables'], ['first', 'second'])
+
+    def test_interrupted_build_is_not_cloned(self):
+        creation = self.write('create.sql', "CREATE TABLE first (id int);\nSELECT pg_sleep(1);\n"
+                                            "CREATE TABLE second (id int);\n")
+        template = PostgreSQL.PostgreSQL.template_prefix + PostgreSQL.psql.file_checksum(creation)[:32]
+        settings = self.template_settings(creation, postgre_sql_database='one', postgre_sql_template_cache_limit=1)
+        script = ("import sys\nsys.path[:0] = %r\nimport PostgreSQL\nPostgreSQL.PostgreSQL(env=%r).process()\n"
+                  % (sys.path, self.processor_env(**settings)))
+        # Killed with its psql in the middle of the template load
+        process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.DEVNULL, start_new_session=True)
+        self.addCleanup(process.wait)
+        deadline = time.time() + 10
+        while not self.building(template):
+            self.assertLess(time.time(), deadline, "the template build didn't start")
+            time.sleep(0.01)
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        databases = self.databases()
+        self.assertNotIn(template, databases)
+        self.assertNotIn('one', databases)
+        self.run_processor(**settings)
+        databases = self.databases()
+        self.assertEqual(databases['one']['tables'], ['first', 'second'])
+        self.assertEqual([name for name in databases if name.startswith(PostgreSQL.PostgreSQL.template_prefix)], [template])
+
+
+class StreamTest(PostgreSQLTestCase):
+
+    def test_new_database_ignores_a_stale_checkpoint(self):
+        creation = self.write('create.sql', "CREATE TABLE first (id int);\nSELECT 1/0;\n")
+        settings = dict(postgre_sql_database='app', postgre_sql_creation_input=creation, postgre_sql_plan_cache='',
+                        postgre_sql_stream_batch_size=1, postgre_sql_stream_checkpoint_dir=self.path('checkpoints'))
+        with self.assertRaisesRegex(ProcessorError, r'the next run will resume'):
+            self.run_processor(**settings)
+        self.assertEqual(len(os.listdir(self.path('checkpoints'))), 1)
+        # Dropped and cloned from a template, the database has nothing to resume
+        self.write('create.sql', "CREATE TABLE first (id int);\nCREATE TABLE second (id int);\n")
+        env = self.run_processor(postgre_sql_drop_db_if_exist=True, postgre_sql_template_cache=True, **settings)
+        self.assertNotIn('resume_load', [action['action'] for action in env['postgre_sql_plan']])
+        self.assertEqual(self.databases()['app']['tables'], ['first', 'second'])
+        self.assertEqual(os.listdir(self.path('checkpoints')), [])
+
+
+class PlanCacheTest(PostgreSQLTestCase):
+
+    def setUp(self):
+        super(PlanCacheTest, self).setUp()
+        self.write(os.path.join('migrations', '0001.sql'), "CREATE TABLE first (id int);\n")
+        self.settings = dict(postgre_sql_database='app', postgre_sql_update_directory=self.path('migrations'))
+
+    def cache_contents(self):
+        directory = self.path('cache', 'PostgreSQL')
+        contents = ''
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name)) as handle:
+                contents += handle.read()
+        return contents
+
+    def test_unchanged_run_is_skipped(self):
+        env = self.run_processor(**self.settings)
+        self.assertFalse(env['postgre_sql_plan_skipped'])
+        env = self.run_processor(**self.settings)
+        self.assertTrue(env['postgre_sql_plan_skipped'])
+        self.assertEqual(env['postgre_sql_plan'], [])
+        self.assertEqual(env['postgre_sql_ouput_password'], 'secret')
+        self.assertEqual(env['postgre_sql_skipped_scripts'], [self.path('migrations', '0001.sql')])
+        self.assertFalse(env['postgre_sql_database_created'])
+        self.assertNotIn('secret', self.cache_contents())
+
+    def test_generated_password_is_not_saved(self):
+        env = self.processor_env(**self.settings)
+        del env['postgre_sql_role_password']
+        PostgreSQL.PostgreSQL(env=env).process()
+        password = env['postgre_sql_ouput_password']
+        self.assertTrue(password)
+        self.assertNotIn(password, self.cache_contents())
+        env = self.processor_env(**self.settings)
+        del env['postgre_sql_role_password']
+        PostgreSQL.PostgreSQL(env=env).process()
+        self.assertTrue(env['postgre_sql_plan_skipped'])
+        self.assertIsNone(env['postgre_sql_ouput_password'])
+
+    def test_changed_sql_file(self):
+        self.run_processor(**self.settings)
+        self.write(os.path.join('migrations', '0001.sql'), "CREATE TABLE second (id int);\n")
+        env = self.run_processor(**self.settings)
+        self.assertFalse(env['postgre_sql_plan_skipped'])
+        self.assertEqual(env['postgre_sql_applied_scripts'], [self.path('migrations', '0001.sql')])
+        self.assertTrue(self.run_processor(**self.settings)['postgre_sql_plan_skipped'])
+
+    def test_server_restart(self):
+        self.run_processor(**self.settings)
+        self.change_state(lambda state: state.update(started_at='2014-06-02 09:00:00.000000+00'))
+        self.assertFalse(self.run_processor(**self.settings)['postgre_sql_plan_skipped'])
+        self.assertTrue(self.run_processor(**self.settings)['postgre_sql_plan_skipped'])
+
+    def test_database_dropped_behind_the_cache(self):
+        self.run_processor(**self.settings)
+        self.change_state(lambda state: state['databases'].pop('app'))
+        env = self.run_processor(**self.settings)
+        self.assertFalse(env['postgre_sql_plan_skipped'])
+        self.assertTrue(env['postgre_sql_database_created'])
+        self.assertEqual(env['postgre_sql_applied_scripts'], [self.path('migrations', '0001.sql')])
+        self.assertEqual(self.databases()['app']['tables'], ['first'])
+
+
+class MultipleDatabasesTest(PostgreSQLTestCase):
+
+    def setUp(self):
+        super(MultipleDatabasesTest, self).setUp()
+        self.creation = self.write('create.sql', "CREATE TABLE first (id int);\n")
+
+    def items(self, failing_creation):
+        return [{'database': 'm1', 'role_name': 'app', 'creation_input': self.creation},
+                {'database': 'm2', 'role_name': 'app', 'creation_input': self.creation},
+                {'database': 'm3', 'role_name': 'app', 'creation_input': failing_creation}]
+
+    def test_failed_load_drops_the_created_database(self):
+        failing = self.write('failing.sql', "CREATE TABLE first (id int);\nSELECT pg_sleep(5);\n")
+        with self.assertRaisesRegex(ProcessorError, r'Provisioning failed for m3 '):
+            self.run_processor(postgre_sql_databases=self.items(failing), command_timeout=1)
+        databases = self.databases()
+        self.assertEqual(databases['m1']['tables'], ['first'])
+        self.assertEqual(databases['m2']['tables'], ['first'])
+        self.assertNotIn('m3', databases)
+        # Loaded by the next run once the file is fixed
+        self.write('failing.sql', "CREATE TABLE first (id int);\nCREATE TABLE second (id int);\n")
+        env = self.run_processor(postgre_sql_databases=self.items(failing), command_timeout=1)
+        self.assertEqual([result['database_created'] for result in env['postgre_sql_results']], [False, False, True])
+        self.assertEqual(self.databases()['m3']['tables'], ['first', 'second'])
+
+    def test_partial_failure_keeps_the_other_outputs(self):
+        failing = self.write('failing.sql', "SELECT 1/0;\n")
+        env = self.run_processor(postgre_sql_databases=self.items(failing), postgre_sql_stream_batch_size=10,
+                                 postgre_sql_allow_partial_failure=True)
+        results = env['postgre_sql_results']
+        self.assertEqual([result['status'] for result in results], ['ok', 'ok', 'failed'])
+        self.assertTrue(results[0]['database_created'])
+        self.assertEqual(results[0]['password'], 'secret')
+        self.assertIn('division by zero', results[2]['error'])
+        self.assertNotIn('m3', self.databases())
+        self.assertFalse(os.path.exists(self.path('cache')) and os.listdir(self.path('cache')))
+
+    def test_resumable_load_keeps_the_database(self):
+        failing = self.write('failing.sql', "CREATE TABLE first (id int);\nSELECT 1/0;\n")
+        with self.assertRaisesRegex(ProcessorError, r'the next run will resume'):
+            self.run_processor(postgre_sql_databases=self.items(failing), postgre_sql_stream_batch_size=1,
+                               postgre_sql_stream_checkpoint_dir=self.path('checkpoints'))
+        self.assertEqual(self.databases()['m3']['tables'], ['first'])
+        self.assertEqual(len(os.listdir(self.path('checkpoints'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
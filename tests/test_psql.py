@@ -0,0 +1,70 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""psql sessions of processor_utils.psql, against the psql stand-in of the benchmarks.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import psql
+from processor_utils import runner as runners
+
+FAKE_PSQL = os.path.join(ROOT, 'benchmarks', 'fakes', 'psql')
+
+
+class SessionErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.clear)
+        self.addCleanup(os.environ.update, environ)
+        os.environ['FAKE_PSQL_STATE'] = os.path.join(directory, 'state.json')
+        self.runner = runners.Runner(timeout=30)
+        self.session = psql.PsqlSession([sys.executable, FAKE_PSQL], 'postgres', runner=self.runner)
+        self.addCleanup(self.session.close)
+
+    def test_failed_statement_is_reported(self):
+        self.session.query("CREATE ROLE alice")
+        with self.assertRaises(psql.PsqlError) as context:
+            self.session.query("CREATE ROLE alice")
+        self.assertIn('role "alice" already exists', str(context.exception))
+        record = self.runner.log()[-1]
+        self.assertEqual(record['status'], 3)
+        self.assertIn('role "alice" already exists', record['stderr'])
+
+    def test_session_reopens_after_error(self):
+        with self.assertRaises(psql.PsqlError):
+            self.session.connect('missing')
+            self.session.query("SELECT 1")
+        self.session.query("CREATE ROLE bob")
+        self.session.close()
+        self.assertNotIn('stderr', self.runner.log()[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
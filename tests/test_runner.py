@@ -0,0 +1,187 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timeouts, deadlines and records of processor_utils.runner.
+
+    python -m unittest discover tests
+"""
+
+import os
+import signal
+import sys
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import runner as runners
+
+
+def python(code, *args):
+    return [sys.executable, '-c', code] + list(args)
+
+
+SLEEP = "import time; time.sleep(%s)"
+# Ignores SIGTERM, only SIGKILL stops it
+STUBBORN = "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print('ready', flush=True); time.sleep(30)"
+
+
+class RunTest(unittest.TestCase):
+
+    def test_output_and_record(self):
+        runner = runners.Runner()
+        result = runner.run(python("import sys; print('out'); sys.stderr.write('err')"))
+        self.assertEqual(result.stdout, "out\n")
+        self.assertEqual(result.stderr, "err")
+        self.assertEqual(result.status, 0)
+        [record] = runner.log()
+        self.assertEqual(record['command'][0], sys.executable)
+        self.assertFalse(record['timed_out'])
+        self.assertIsNone(record['error'])
+
+    def test_failure(self):
+        runner = runners.Runner()
+        code = "import sys; sys.stderr.write('first\\nlast\\n'); sys.exit(3)"
+        with self.assertRaises(runners.CommandError) as context:
+            runner.run(python(code))
+        self.assertIn("exited with status 3: last", str(context.exception))
+        self.assertEqual(context.exception.record['stderr'], "first\nlast\n")
+        self.assertEqual(runner.run(python(code), check=False).status, 3)
+
+    def test_streamed_output(self):
+        blocks = []
+        result = runners.Runner().run(python("print('a' * 100000)"), stdout=blocks.append)
+        self.assertIsNone(result.stdout)
+        self.assertEqual(b"".join(blocks), b"a" * 100000 + b"\n")
+
+    def test_arguments_checked(self):
+        runner = runners.Runner(secrets=['hunter2'])
+        with self.assertRaisesRegex(runners.CommandError, r'not shell strings: echo \*\*\*\*\*\*\*\*'):
+            runner.run("echo hunter2")
+        with self.assertRaises(runners.CommandError):
+            runner.run([])
+        with self.assertRaisesRegex(runners.CommandError, r'Unable to start /nonexistent'):
+            runner.run(['/nonexistent'])
+
+    def test_secrets_are_masked(self):
+        runner = runners.Runner(secrets=['hunter2', 'hunter22'])
+        with self.assertRaises(runners.CommandError) as context:
+            runner.run(python("import sys; sys.stderr.write(sys.argv[1]); sys.exit(1)", 'hunter22'))
+        self.assertNotIn('hunter2', str(context.exception))
+        record = runner.log()[-1]
+        self.assertEqual(record['command'][-1], runners.MASK)
+        self.assertEqual(record['stderr'], runners.MASK)
+
+
+class TimeoutTest(unittest.TestCase):
+
+    def test_timeout(self):
+        runner = runners.Runner(timeout=0.3)
+        started = time.monotonic()
+        with self.assertRaisesRegex(runners.CommandTimeout, r'timed out after 0.3 seconds'):
+            runner.run(python(SLEEP % 30))
+        self.assertLess(time.monotonic() - started, 5)
+        record = runner.log()[-1]
+        self.assertTrue(record['timed_out'])
+        self.assertEqual(record['status'], -signal.SIGTERM)
+
+    def test_call_timeout_overrides_the_runner(self):
+        runner = runners.Runner(timeout=0.2)
+        self.assertEqual(runner.run(python(SLEEP % 0.5), timeout=10).status, 0)
+
+    def test_streamed_timeout(self):
+        with self.assertRaises(runners.CommandTimeout):
+            runners.Runner(timeout=0.3).run(python(SLEEP % 30), stdout=lambda block: None)
+
+    def test_killed_when_sigterm_is_ignored(self):
+        with mock.patch.object(runners, 'KILL_DELAY', 0.3):
+            started = time.monotonic()
+            runner = runners.Runner(timeout=0.5)
+            with self.assertRaises(runners.CommandTimeout):
+                runner.run(python(STUBBORN))
+            self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(runner.log()[-1]['status'], -signal.SIGKILL)
+
+    def test_deadline(self):
+        runner = runners.Runner(timeout=10, deadline=0.5)
+        self.assertLessEqual(runner.call_timeout(), 0.5)
+        started = time.monotonic()
+        with self.assertRaises(runners.CommandTimeout):
+            runner.run(python(SLEEP % 30))
+        self.assertLess(time.monotonic() - started, 5)
+        with self.assertRaisesRegex(runners.CommandTimeout, r'deadline for running commands has passed'):
+            runner.run(python("pass"))
+        with self.assertRaises(runners.CommandTimeout):
+            runner.start(python("pass"))
+
+    def test_guard(self):
+        runner = runners.Runner(timeout=0.3)
+        process = runner.start(python("import sys; sys.stdin.read()"), stdin=-1, stdout=-1)
+        with self.assertRaises(runners.CommandTimeout):
+            with runner.guard(process):
+                process.stdout.read()
+        process.stdin.close()
+        process.stdout.close()
+        record = runner.finish(process, timed_out=True)
+        self.assertTrue(record['timed_out'])
+        self.assertEqual(record['error'], "%s timed out" % sys.executable)
+
+    def test_guard_left_in_time(self):
+        runner = runners.Runner(timeout=5)
+        process = runner.start(python("print('hello')"), stdout=-1, universal_newlines=True)
+        with runner.guard(process):
+            self.assertEqual(process.stdout.readline(), "hello\n")
+        process.stdout.close()
+        self.assertEqual(runner.finish(process)['status'], 0)
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_results_in_order_with_errors(self):
+        runner = runners.Runner()
+        commands = [python("import time; time.sleep(%s); print(%d)" % (0.05 * (5 - index), index)) for index in range(5)]
+        commands[2] = {'args': python("import sys; sys.exit(4)")}
+        results = runner.run_batch(commands, max_workers=5)
+        self.assertEqual([result.stdout for result in results], ["0\n", "1\n", None, "3\n", "4\n"])
+        self.assertIn("exited with status 4", results[2].error)
+        self.assertEqual(results[2].status, 4)
+        self.assertEqual(len(runner.log()), 5)
+
+    def test_max_concurrent(self):
+        runner = runners.Runner(max_concurrent=1)
+        runner.run_batch([python(SLEEP % 0.1)] * 4, max_workers=4)
+        records = sorted(runner.log(), key=lambda record: record['started'])
+        for before, after in zip(records, records[1:]):
+            self.assertLessEqual(before['started'] + before['duration'], after['started'] + 0.05)
+
+
+class SettingsTest(unittest.TestCase):
+
+    def test_from_settings(self):
+        runner = runners.from_settings({'command_timeout': '2.5', 'command_deadline': '', 'command_max_concurrent': 3})
+        self.assertEqual(runner.timeout, 2.5)
+        self.assertIsNone(runner.deadline)
+        self.assertIsNotNone(runner.slots)
+        for settings in ({'command_timeout': 'soon'}, {'command_deadline': 0}, {'command_max_concurrent': -1}):
+            with self.subTest(settings=settings):
+                with self.assertRaises(runners.CommandError):
+                    runners.from_settings(settings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sed processor runs over several targets, and the backups of the files it changes.
+
+    python -m unittest discover tests
+
+AutoPKG's autopkglib is used when installed, the stand-in of
+benchmarks/stubs otherwise.
+"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+try:
+    import autopkglib
+except ImportError:
+    sys.path.append(os.path.join(ROOT, 'benchmarks', 'stubs'))
+
+import Sed
+from processor_utils import backups
+
+from autopkglib import ProcessorError
+
+
+class SedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def path(self, *names):
+        return os.path.join(self.workdir, *names)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as handle:
+            handle.write(text)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name)) as handle:
+            return handle.read()
+
+    def run_processor(self, target_file, sed_commands, **settings):
+        env = {'target_file': target_file, 'sed_commands': sed_commands, 'verbose': 0}
+        env.update(settings)
+        Sed.Sed(env=env).process()
+        return env
+
+
+class TargetsTest(SedTestCase):
+
+    def test_globs_and_paths(self):
+        for name in ('b.txt', 'a.txt', 'c.conf', 'd.conf'):
+            self.write(name, "version=1\n")
+        env = self.run_processor([self.path('*.txt'), self.path('c.conf'), self.path('a.txt')],
+                                 ['s/version=1/version=2/'], sed_backup='none')
+        self.assertEqual(env['sed_changed_files'], [self.path('a.txt'), self.path('b.txt'), self.path('c.conf')])
+        self.assertEqual(env['sed_unchanged_files'], [])
+        self.assertTrue(env['sed_changed'])
+        self.assertEqual(self.read('c.conf'), "version=2\n")
+        self.assertEqual(self.read('d.conf'), "version=1\n")
+
+    def test_results_keep_the_order_of_the_targets(self):
+        for index in range(40):
+            self.write("file%02d.txt" % index, "line\n" * (40 - index) if index % 3 else "other\n")
+        targets = sorted(glob.glob(self.path('*.txt')))
+        for workers in (1, 8):
+            with self.subTest(workers=workers):
+                env = self.run_processor(self.path('*.txt'), ['s/line/LINE/', 's/LINE/line/'], sed_backup='none',
+                                         sed_max_workers=workers)
+                self.assertEqual(env['sed_changed_files'], [])
+                self.assertEqual(env['sed_unchanged_files'], targets)
+                env = self.run_processor(self.path('*.txt'), ['y/lo/LO/'], sed_backup='none', sed_max_workers=workers)
+                self.assertEqual(env['sed_changed_files'], targets)
+                self.assertEqual(self.read('file01.txt'), "Line\n" * 39)
+                self.run_processor(self.path('*.txt'), ['y/LO/lo/'], sed_backup='none', sed_max_workers=workers)
+
+    def test_failed_target_does_not_stop_the_others(self):
+        self.write('a.txt', "x\n")
+        os.mkdir(self.path('directory'))
+        self.write('b.txt', "x\n")
+        with self.assertRaisesRegex(ProcessorError, r'Editing failed for %s \(' % self.path('directory')):
+            self.run_processor([self.path('a.txt'), self.path('directory'), self.path('b.txt')], ['s/x/y/'],
+                               sed_backup='none')
+        self.assertEqual(self.read('a.txt'), "y\n")
+        self.assertEqual(self.read('b.txt'), "y\n")
+
+    def test_missing_targets(self):
+        with self.assertRaisesRegex(ProcessorError, r'No file matches'):
+            self.run_processor(self.path('*.none'), ['s/x/y/'])
+        with self.assertRaisesRegex(ProcessorError, r"target file don't exist"):
+            self.run_processor(self.path('missing'), ['s/x/y/'])
+
+    @unittest.skipUnless(shutil.which('sed'), "sed isn't installed")
+    def test_external_engine(self):
+        for index in range(10):
+            self.write("file%d.txt" % index, "value %d\n" % index)
+        env = self.run_processor(self.path('*.txt'), ['s/value/VALUE/'], sed_engine='external', sed_backup='none',
+                                 sed_max_workers=4)
+        self.assertEqual(env['sed_engine_used'], 'external')
+        self.assertEqual(len(env['sed_changed_files']), 10)
+        self.assertEqual(self.read('file7.txt'), "VALUE 7\n")
+        self.assertEqual(len(env['command_log']), 10)
+
+
+class BackupTest(SedTestCase):
+
+    def history(self, path):
+        store = backups.BackupStore(self.path('cache', 'SedBackups'))
+        contents = []
+        for backup in store.history(path):
+            with open(backup['object']) as handle:
+                contents.append(handle.read())
+        return contents
+
+    def test_unchanged_file_is_left_untouched(self):
+        path = self.write('a.txt', "nothing to replace\n")
+        before = os.stat(path)
+        env = self.run_processor(path, ['s/missing/found/'], RECIPE_CACHE_DIR=self.path('cache'))
+        after = os.stat(path)
+        self.assertEqual((after.st_ino, after.st_mtime_ns), (before.st_ino, before.st_mtime_ns))
+        self.assertEqual(env['sed_unchanged_files'], [path])
+        self.assertFalse(env['sed_changed'])
+        self.assertEqual(self.history(path), [])
+
+    def test_previous_contents_are_kept_in_the_store(self):
+        path = self.write('a.txt', "version=1\n")
+        for version in range(2, 5):
+            self.run_processor(path, ['s/version=%d/version=%d/' % (version - 1, version)],
+                               RECIPE_CACHE_DIR=self.path('cache'), sed_backup_keep=2)
+        self.assertEqual(self.read('a.txt'), "version=4\n")
+        self.assertEqual(self.history(path), ["version=2\n", "version=3\n"])
+
+    def test_sibling_backup(self):
+        path = self.write('a.txt', "one\n")
+        self.run_processor(path, ['s/one/two/'], sed_backup='sibling')
+        [backup] = glob.glob(self.path('a.txt.*'))
+        with open(backup) as handle:
+            self.assertEqual(handle.read(), "one\n")
+
+    def test_unknown_backup_mode(self):
+        path = self.write('a.txt', "one\n")
+        with self.assertRaisesRegex(ProcessorError, r'Unknown sed_backup'):
+            self.run_processor(path, ['s/one/two/'], sed_backup='elsewhere')
+
+
+if __name__ == '__main__':
+    unittest.main()
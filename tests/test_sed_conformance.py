@@ -0,0 +1,125 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builtin sed engine against GNU sed on the corpus of sed_corpus.py.
+
+    python -m unittest discover tests
+    python tests/test_sed_conformance.py -v
+
+Every script runs on every input, in the C locale and in a UTF-8 locale
+when one is installed. The output of the builtin engine must be byte for
+byte the one of sed run in the same locale, unless the engine declines the
+script (SedError when compiling) or the file (LocaleError), in which case
+the Sed processor uses the sed binary itself. Skipped when sed isn't GNU sed.
+"""
+
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_utils import sed
+
+import sed_corpus
+
+
+def gnu_sed():
+    try:
+        return b'GNU' in subprocess.run(['sed', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    except OSError:
+        return False
+
+
+def utf8_locale():
+    try:
+        names = subprocess.run(['locale', '-a'], stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    except OSError:
+        return None
+    for name in ('C.UTF-8', 'C.utf8', 'en_US.UTF-8', 'en_US.utf8'):
+        if name in names:
+            return name
+    return None
+
+
+class SedConformanceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if not gnu_sed():
+            raise unittest.SkipTest("the corpus is checked against GNU sed")
+        cls.workdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(cls.workdir)
+
+    def run_sed(self, commands, data, locale):
+        script_path = os.path.join(self.workdir, 'script.sed')
+        input_path = os.path.join(self.workdir, 'input')
+        with open(script_path, 'wb') as handle:
+            handle.write(('\n'.join(commands) + '\n').encode('utf-8'))
+        with open(input_path, 'wb') as handle:
+            handle.write(data)
+        process = subprocess.run(['sed', '-f', script_path, input_path], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, env=dict(os.environ, LC_ALL=locale))
+        return process.returncode, process.stdout
+
+    def run_builtin(self, commands, data, locale):
+        """Output of the builtin engine, None when it leaves the script or the file to sed."""
+        program, reason = sed.load_program(commands, sed.locale_charset({'LC_ALL': locale}))
+        if program is None:
+            return None
+        output = []
+        try:
+            program.run(io.BytesIO(data), output.append)
+        except sed.LocaleError:
+            return None
+        return b''.join(output)
+
+    def check_locale(self, locale):
+        handled = 0
+        for commands in sed_corpus.SCRIPTS:
+            for name, data in sorted(sed_corpus.INPUTS.items()):
+                with self.subTest(locale=locale, script=commands, input=name):
+                    actual = self.run_builtin(commands, data, locale)
+                    if actual is None:
+                        continue
+                    status, expected = self.run_sed(commands, data, locale)
+                    self.assertEqual(status, 0, "sed failed where the builtin engine didn't")
+                    self.assertEqual(actual, expected)
+                    handled += 1
+        # Declining everything would pass too
+        self.assertGreater(handled, len(sed_corpus.SCRIPTS) * len(sed_corpus.INPUTS) * 3 // 4)
+
+    def test_c_locale(self):
+        self.check_locale('C')
+
+    def test_utf8_locale(self):
+        locale = utf8_locale()
+        if locale is None:
+            self.skipTest("no UTF-8 locale installed")
+        self.check_locale(locale)
+
+
+if __name__ == '__main__':
+    unittest.main()
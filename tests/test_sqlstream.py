@@ -0,0 +1,215 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Statement splitting and batched loads of processor_utils.sqlstream.
+
+    python -m unittest discover tests
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import psql
+from processor_utils import sqlstream
+
+
+def read(data, offset=0):
+    return list(sqlstream.StatementReader(io.BytesIO(data[offset:]), offset))
+
+
+class RecordingSession(object):
+    """Keeps the statements a loader sends, sync() fails once a statement containing fail_on was sent."""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.sent = []
+        self.synced = 0
+
+    def send(self, text):
+        self.sent.append(text)
+
+    def sync(self):
+        if self.fail_on and any(self.fail_on in text for text in self.sent[self.synced:]):
+            raise psql.PsqlError("ERROR:  %s failed" % self.fail_on)
+        self.synced = len(self.sent)
+        return ''
+
+    def statements(self):
+        return [text.strip() for text in self.sent if not text.startswith("\\o")]
+
+
+class StatementReaderTest(unittest.TestCase):
+
+    def assertStatements(self, data, expected):
+        items = read(data)
+        self.assertEqual([item.kind for item in items], [sqlstream.STATEMENT] * len(expected))
+        self.assertEqual([sqlstream.strip_leading_noise(item.text).strip() for item in items], expected)
+
+    def test_semicolons_in_quotes(self):
+        self.assertStatements(b"SELECT 'a;b', \"c;d\";\nSELECT 'it''s;';\n",
+                              [b"SELECT 'a;b', \"c;d\";", b"SELECT 'it''s;';"])
+
+    def test_escape_strings(self):
+        self.assertStatements(b"SELECT E'it\\'s;', e'\\\\';\nSELECT 'E';\n",
+                              [b"SELECT E'it\\'s;', e'\\\\';", b"SELECT 'E';"])
+
+    def test_dollar_quotes(self):
+        self.assertStatements(b"CREATE FUNCTION f() RETURNS int AS $body$\nSELECT 1;\n$body$ LANGUAGE sql;\n"
+                              b"DO $$ BEGIN PERFORM 1; END $$;\nSELECT a$b, $1;\n",
+                              [b"CREATE FUNCTION f() RETURNS int AS $body$\nSELECT 1;\n$body$ LANGUAGE sql;",
+                               b"DO $$ BEGIN PERFORM 1; END $$;", b"SELECT a$b, $1;"])
+
+    def test_comments(self):
+        items = read(b"-- a; comment\nSELECT 1; /* x; /* nested; */ still; */ SELECT 2 -- c;\n;\n")
+        self.assertEqual([item.text.strip() for item in items],
+                         [b"-- a; comment\nSELECT 1;", b"/* x; /* nested; */ still; */ SELECT 2 -- c;\n;"])
+
+    def test_statement_across_lines_and_without_semicolon(self):
+        self.assertStatements(b"SELECT\n1;SELECT 2; SELECT\n3", [b"SELECT\n1;", b"SELECT 2;", b"SELECT\n3"])
+
+    def test_copy_data_and_meta_commands(self):
+        data = b"\\connect app\nCOPY t (a) FROM stdin;\n1;\n2\n\\.\nSELECT 1;\n"
+        items = read(data)
+        self.assertEqual([item.kind for item in items], [sqlstream.META, sqlstream.COPY, sqlstream.COPY_DATA,
+                                                         sqlstream.COPY_DATA, sqlstream.COPY_END, sqlstream.STATEMENT])
+        self.assertEqual(sum(item.rows for item in items), 2)
+        self.assertEqual(items[2].text, b"1;\n")
+
+    def test_offsets(self):
+        data = b"SELECT 1;\nSELECT 2; SELECT 3;\n\\echo done\nSELECT 4;\n"
+        items = read(data)
+        self.assertEqual([data[item.end - 1:item.end] for item in items], [b";", b";", b";", b"\n", b";"])
+        # Reading from the end of an item goes on with the next one
+        self.assertEqual([item.text for item in read(data, items[1].end)], [item.text for item in items[2:]])
+
+    def test_transaction_control(self):
+        cases = [
+            (b"BEGIN;", sqlstream.TRANSACTION_BEGIN),
+            (b"-- comment\n begin isolation level serializable;", sqlstream.TRANSACTION_BEGIN),
+            (b"START TRANSACTION;", sqlstream.TRANSACTION_BEGIN),
+            (b"COMMIT;", sqlstream.TRANSACTION_END),
+            (b"end;", sqlstream.TRANSACTION_END),
+            (b"ROLLBACK WORK;", sqlstream.TRANSACTION_END),
+            (b"ABORT;", sqlstream.TRANSACTION_END),
+            (b"PREPARE TRANSACTION 'x';", sqlstream.TRANSACTION_END),
+            (b"ROLLBACK TO SAVEPOINT a;", None),
+            (b"ROLLBACK WORK TO a;", None),
+            (b"COMMIT PREPARED 'x';", sqlstream.NO_TRANSACTION),
+            (b"VACUUM ANALYZE t;", sqlstream.NO_TRANSACTION),
+            (b"CREATE DATABASE other;", sqlstream.NO_TRANSACTION),
+            (b"DROP TABLESPACE space;", sqlstream.NO_TRANSACTION),
+            (b"ALTER SYSTEM SET work_mem = '1GB';", sqlstream.NO_TRANSACTION),
+            (b"CREATE UNIQUE INDEX CONCURRENTLY i ON t (a);", sqlstream.NO_TRANSACTION),
+            (b"DROP INDEX CONCURRENTLY i;", sqlstream.NO_TRANSACTION),
+            (b"REINDEX (VERBOSE) TABLE CONCURRENTLY t;", sqlstream.NO_TRANSACTION),
+            (b"REINDEX DATABASE app;", sqlstream.NO_TRANSACTION),
+            (b"REINDEX TABLE t;", None),
+            (b"CREATE INDEX i ON t (a);", None),
+            (b"CREATE TABLE beginning (a int);", None),
+            (b"SELECT 'BEGIN';", None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(sqlstream.transaction_control(text), expected)
+
+
+class StreamLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+
+    def load(self, text, batch_size=2, fail_on=None, resume=False):
+        sql_file = os.path.join(self.directory, 'load.sql')
+        if not resume:
+            with open(sql_file, 'w') as handle:
+                handle.write(text)
+        session = RecordingSession(fail_on)
+        loader = sqlstream.StreamLoader(session, sql_file, batch_size, self.checkpoint_path)
+        checkpoints = []
+        write_checkpoint = loader.write_checkpoint
+        loader.write_checkpoint = lambda offset, settings: (checkpoints.append(offset), write_checkpoint(offset, settings))
+        try:
+            loader.load(resume)
+        finally:
+            self.statements = session.statements()
+            self.checkpoints = [text[:offset].rsplit(";", 2)[-2].strip() if offset else "" for offset in checkpoints]
+        return loader
+
+    def test_batches(self):
+        loader = self.load("SELECT 1;\nSELECT 2;\nSELECT 3;\n")
+        self.assertEqual(self.statements, ["BEGIN;", "SELECT 1;", "SELECT 2;", "COMMIT;", "BEGIN;", "SELECT 3;", "COMMIT;"])
+        self.assertEqual(self.checkpoints, ["SELECT 2"])
+        self.assertEqual(loader.statements, 3)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_resume_after_last_committed_batch(self):
+        text = "SET search_path TO app;\nSELECT 1;\nSELECT 2;\nSELECT 3;\nSELECT 4;\n"
+        with self.assertRaises(sqlstream.LoadError) as context:
+            self.load(text, fail_on="SELECT 3")
+        self.assertIn("2 statements committed", str(context.exception))
+        self.assertEqual(self.checkpoints, ["SELECT 1"])
+        loader = self.load(text, resume=True)
+        # The session settings of the skipped part come first
+        self.assertEqual(self.statements, ["SET search_path TO app;", "BEGIN;", "SELECT 2;", "SELECT 3;", "COMMIT;",
+                                           "BEGIN;", "SELECT 4;", "COMMIT;"])
+        self.assertEqual(loader.resumed_from, text.index("\nSELECT 2"))
+        self.assertEqual(loader.statements, 5)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_changed_file_is_not_resumed(self):
+        with self.assertRaises(sqlstream.LoadError):
+            self.load("SELECT 1;\nSELECT 2;\nSELECT 3;\n", fail_on="SELECT 3")
+        with open(os.path.join(self.directory, 'load.sql'), 'a') as handle:
+            handle.write("SELECT 4;\n")
+        with self.assertRaisesRegex(sqlstream.LoadError, r'changed since its interrupted load'):
+            self.load("", resume=True)
+
+    def test_transaction_of_the_file(self):
+        self.load("SELECT 1;\nBEGIN;\nSELECT 2;\nSELECT 3;\nSELECT 4;\nCOMMIT;\nSELECT 5;\n")
+        self.assertEqual(self.statements, ["BEGIN;", "SELECT 1;", "COMMIT;", "BEGIN;", "SELECT 2;", "SELECT 3;",
+                                           "SELECT 4;", "COMMIT;", "BEGIN;", "SELECT 5;", "COMMIT;"])
+        # No checkpoint in the middle of the transaction of the file
+        self.assertEqual(self.checkpoints, ["SELECT 1", "COMMIT"])
+
+    def test_statements_outside_of_transactions(self):
+        self.load("SELECT 1;\nVACUUM t;\nCREATE INDEX CONCURRENTLY i ON t (a);\nSELECT 2;\n", batch_size=10)
+        self.assertEqual(self.statements, ["BEGIN;", "SELECT 1;", "COMMIT;", "VACUUM t;",
+                                           "CREATE INDEX CONCURRENTLY i ON t (a);", "BEGIN;", "SELECT 2;", "COMMIT;"])
+        self.assertEqual(self.checkpoints, ["SELECT 1", "VACUUM t", "CREATE INDEX CONCURRENTLY i ON t (a)"])
+
+    def test_statement_outside_of_transactions_in_a_transaction(self):
+        with self.assertRaisesRegex(sqlstream.LoadError, r"can't run in the transaction opened at offset 9"):
+            self.load("SELECT 1;\nBEGIN;\nVACUUM t;\nCOMMIT;\n")
+        self.assertEqual(self.statements[-1], "ROLLBACK;")
+        self.assertEqual(self.checkpoints, ["SELECT 1"])
+
+    def test_unfinished_transaction(self):
+        with self.assertRaisesRegex(sqlstream.LoadError, r'ends in the transaction opened at offset 0'):
+            self.load("BEGIN;\nSELECT 1;\n")
+        self.assertEqual(self.statements, ["BEGIN;", "SELECT 1;", "ROLLBACK;"])
+
+
+if __name__ == '__main__':
+    unittest.main()
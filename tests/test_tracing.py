@@ -0,0 +1,195 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spans, trace files and summaries of processor_utils.tracing.
+
+    python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+try:
+    import autopkglib
+except ImportError:
+    sys.path.append(os.path.join(ROOT, 'benchmarks', 'stubs'))
+
+from processor_utils import tracing
+
+
+class Traced(object):
+    """Enough of a processor for tracing.traced."""
+
+    def __init__(self, env, fail=False):
+        self.env = env
+        self.fail = fail
+        self.messages = []
+
+    def output(self, message, verbose_level=1):
+        self.messages.append(message)
+
+    @tracing.traced
+    def main(self):
+        with self.tracer.span('phase', files=2):
+            if self.fail:
+                raise ValueError("failed")
+
+
+class TracerTest(unittest.TestCase):
+
+    def by_name(self, records):
+        return dict((record['name'], record) for record in records)
+
+    def test_disabled(self):
+        tracer = tracing.Tracer('Test', enabled=False)
+        with tracer.span('phase') as span:
+            span.set(bytes=1)
+            span.add('rows')
+        self.assertIs(span, tracing.NULL_SPAN)
+        self.assertEqual(tracer.records(), [])
+        self.assertEqual(tracer.finish(), [])
+        self.assertIs(tracing.from_settings({}, 'Test'), tracing.DISABLED)
+
+    def test_nesting_and_threads(self):
+        tracer = tracing.Tracer('Test')
+        with tracer.span('outer', bytes=1) as outer:
+            outer.set(bytes=10)
+            with tracer.span('inner') as inner:
+                inner.add('rows')
+                inner.add('rows', 2)
+
+            def work():
+                with tracer.span('worker'):
+                    pass
+
+            thread = threading.Thread(target=work, name='worker-thread')
+            thread.start()
+            thread.join()
+        records = self.by_name(tracer.finish())
+        root = records['Test']
+        self.assertIsNone(root['parent'])
+        self.assertEqual(records['outer']['parent'], root['id'])
+        self.assertEqual(records['inner']['parent'], records['outer']['id'])
+        # Spans of other threads hang from the root
+        self.assertEqual(records['worker']['parent'], root['id'])
+        self.assertEqual(records['worker']['thread'], 'worker-thread')
+        self.assertEqual(records['outer']['metadata'], {'bytes': 10})
+        self.assertEqual(records['inner']['metadata'], {'rows': 3})
+        self.assertLessEqual(records['inner']['duration'], records['outer']['duration'])
+        starts = [record['start'] for record in tracer.records()]
+        self.assertEqual(starts, sorted(starts))
+
+    def test_error_is_recorded(self):
+        tracer = tracing.Tracer('Test')
+        with self.assertRaises(KeyError):
+            with tracer.span('failing'):
+                raise KeyError('missing')
+        with tracer.span('next'):
+            pass
+        records = self.by_name(tracer.finish())
+        self.assertEqual(records['failing']['error'], 'KeyError')
+        self.assertIsNone(records['next']['error'])
+        self.assertEqual(records['next']['parent'], records['Test']['id'])
+
+
+class TraceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.trace_file = os.path.join(self.directory, 'traces', 'trace.jsonl')
+
+    def read(self):
+        with open(self.trace_file) as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_runs_append_to_the_trace_file(self):
+        for recipe in ('first.recipe', 'second.recipe'):
+            tracer = tracing.from_settings({'processor_trace_file': self.trace_file, 'RECIPE_PATH': recipe}, 'Test')
+            with tracer.span('phase'):
+                pass
+            tracer.finish()
+        lines = self.read()
+        self.assertEqual([(line['recipe'], line['name']) for line in lines],
+                         [('first.recipe', 'Test'), ('first.recipe', 'phase'), ('second.recipe', 'Test'), ('second.recipe', 'phase')])
+        self.assertEqual(len(set(line['run'] for line in lines)), 2)
+        self.assertEqual(set(line['processor'] for line in lines), set(['Test']))
+        self.assertEqual(set(line['pid'] for line in lines), set([os.getpid()]))
+
+    def test_traced(self):
+        processor = Traced({'processor_trace': True})
+        processor.main()
+        self.assertEqual([span['name'] for span in processor.env['processor_trace_spans']], ['Traced', 'phase'])
+        processor = Traced({}, fail=True)
+        with self.assertRaises(ValueError):
+            processor.main()
+        self.assertEqual(processor.env['processor_trace_spans'], [])
+
+    def test_traced_with_an_unwritable_trace_file(self):
+        blocker = os.path.join(self.directory, 'file')
+        open(blocker, 'w').close()
+        processor = Traced({'processor_trace_file': os.path.join(blocker, 'trace.jsonl')}, fail=True)
+        with self.assertRaises(ValueError):
+            processor.main()
+        spans = processor.env['processor_trace_spans']
+        self.assertEqual([span['error'] for span in spans], ['ValueError', 'ValueError'])
+        self.assertIn("Unable to write trace file", processor.messages[-1])
+
+    def test_summary(self):
+        for fail in (False, True, False):
+            processor = Traced({'processor_trace_file': self.trace_file}, fail=fail)
+            try:
+                processor.main()
+            except ValueError:
+                pass
+        summary = tracing.summarize(self.read())
+        phase = summary[('Traced', 'phase')]
+        self.assertEqual((phase['count'], phase['errors'], phase['metadata']), (3, 1, {'files': 6}))
+        self.assertAlmostEqual(phase['mean'], phase['total'] / 3)
+        self.assertLessEqual(phase['max'], phase['total'])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            tracing.main([self.trace_file])
+        self.assertEqual(len(output.getvalue().splitlines()), 3)
+        self.assertIn("files=6", output.getvalue())
+
+    def test_processor_spans(self):
+        import Sed
+        target = os.path.join(self.directory, 'target.txt')
+        with open(target, 'w') as handle:
+            handle.write("one\n")
+        env = {'target_file': target, 'sed_commands': ['s/one/two/'], 'sed_backup': 'none',
+               'processor_trace': True, 'verbose': 0}
+        Sed.Sed(env=env).process()
+        names = [span['name'] for span in env['processor_trace_spans']]
+        self.assertEqual(names[0], 'Sed')
+        self.assertIn('edit', names)
+        edit = [span for span in env['processor_trace_spans'] if span['name'] == 'edit'][0]
+        self.assertEqual(edit['metadata']['changed'], True)
+        self.assertEqual(edit['metadata']['bytes'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
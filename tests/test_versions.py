@@ -0,0 +1,50 @@
+#
+# Copyright 2014 Yoann Gini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Version comparisons of processor_utils.versions.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from processor_utils import versions
+
+
+class AtMostTest(unittest.TestCase):
+
+    def check(self, cases, expected):
+        for version, maximum in cases:
+            with self.subTest(version=version, maximum=maximum):
+                self.assertEqual(versions.at_most(version, maximum), expected)
+
+    def test_updates_of_the_maximum(self):
+        self.check([('10.9.5', '10.9'), ('10.0.5', '10.0'), ('11.0.1', '11.0'), ('10.1', '10'),
+                    ('10.9', '10.9.0'), ('10.9b1', '10.9')], True)
+
+    def test_written_zeros_are_compared(self):
+        self.check([('10.1', '10.0'), ('11.5', '11.0'), ('10.9.1', '10.9.0'), ('10.10', '10.9'),
+                    ('11.0', '10'), ('10.9.5', '10.9rc1')], False)
+
+
+if __name__ == '__main__':
+    unittest.main()